@@ -1,14 +1,28 @@
 from flask import Flask, request, jsonify, send_from_directory
 from flask_cors import CORS
 import os
+import json
+import multiprocessing
 import uuid
+import threading
+from contextlib import contextmanager
 from datetime import datetime
 import numpy as np
 
 # Import models and ensure they're loaded
 import models
-from embeddings import get_image_embedding, get_audio_embedding, get_text_embedding
-from database import add_embedding, search_similar, faiss_index
+from embeddings import (get_image_embedding, get_image_embeddings, get_audio_embedding, get_audio_segment_embeddings,
+                        get_text_embedding, get_text_embeddings, get_text_cache_stats)
+from database import (add_embedding, add_embeddings, flush_log, search_similar, search_similar_batch,
+                      get_index_size, get_index_info, find_by_content_hash, merge_duplicate, get_metadata_stats,
+                      get_recent_items, get_item, delete_item as delete_indexed_item, update_item as update_indexed_item)
+import multi_database
+import metadata_store
+import embedding_store
+import audio_decode
+import image_decode
+import jobs
+from query_batcher import QueryBatcher
 
 app = Flask(__name__)
 
@@ -19,6 +33,12 @@ origins = [
 
 CORS(app, resources={r"/*": {"origins": origins}}, supports_credentials=True)
 
+# Models load lazily on first use; start loading the configured ones now without
+# holding up startup (see models.WARM_UP_MODELS). Not in audio decode workers, which
+# import this module again when the server is run as a script.
+if multiprocessing.current_process().name == "MainProcess":
+    models.start_warm_up()
+
 @app.route('/')
 def index():
     return 'Backend is running.'
@@ -28,8 +48,36 @@ STATIC_FOLDER = "static"
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(STATIC_FOLDER, exist_ok=True)
 
-# Progress tracking for batch uploads
+# Progress tracking for batch uploads, written by background ingestion jobs
 upload_progress = {}
+progress_lock = threading.Lock()
+
+# Files per embed-and-insert step inside a batch job; progress and cancellation
+# are checked between chunks
+BATCH_JOB_CHUNK_SIZE = 64
+
+# What to do when uploaded content is already in the index: "allow" a second copy,
+# "reject" it, or "merge" it into the existing item. Requests can override this
+# with an on_duplicate form field.
+DUPLICATE_POLICY = "allow"
+DUPLICATE_POLICIES = ("allow", "reject", "merge")
+dedup_stats = {"rejected": 0, "merged": 0}
+dedup_lock = threading.Lock()  # Counted from request threads and batch jobs
+
+# Query files up to this size are decoded straight from memory; larger ones are
+# spilled to UPLOAD_FOLDER so concurrent queries can't exhaust RAM
+QUERY_MAX_IN_MEMORY_MB = 16
+
+def search_many(embeddings, num_results=5, db_name=None, **search_params):
+    """Searches the named database if db_name is given, otherwise the global index"""
+    if db_name:
+        return multi_database.search_in_db_batch(db_name, embeddings, num_results, **search_params)
+    return search_similar_batch(embeddings, num_results, **search_params)
+
+# Micro-batchers for search queries (see query_batcher.py for the wait/size limits).
+# db_name is part of the search params, so each batch searches each database once.
+text_query_batcher = QueryBatcher("text", get_text_embeddings, search_many)
+image_query_batcher = QueryBatcher("image", get_image_embeddings, search_many)
 
 def validate_file(file, max_size_mb=50):
     """Validate uploaded files"""
@@ -53,6 +101,197 @@ def validate_file(file, max_size_mb=50):
     
     return True, "Valid"
 
+def get_search_params(source):
+    """
+    Reads optional per-query ANN tunables (nprobe for IVF, ef_search for HNSW) and metadata
+    filters from JSON or form data. Form data carries filters as a JSON string, e.g.
+    {"file_type": ["audio"], "model_used": "CLAP", "batch_id": "...", "added_after": "2024-01-01"}
+    """
+    params = {}
+    for key in ("nprobe", "ef_search"):
+        value = source.get(key)
+        if value is not None and value != "":
+            params[key] = int(value)
+            if params[key] <= 0:
+                raise ValueError(f"{key} must be a positive integer")
+    
+    filters = source.get("filters")
+    if isinstance(filters, str):
+        filters = json.loads(filters) if filters.strip() else None
+    filters = metadata_store.normalize_filters(filters)
+    if filters:
+        params["filters"] = filters
+    return params
+
+def get_db_name(source):
+    """Reads an optional db_name from JSON or form data. Raises LookupError for unknown databases."""
+    db_name = source.get("db_name") or None
+    if db_name is not None and not multi_database.database_exists(db_name):
+        raise LookupError(f"Database '{db_name}' not found")
+    return db_name
+
+def detect_file_type(filename):
+    """Maps a file extension to "image" or "audio", None if unsupported"""
+    file_ext = os.path.splitext(filename)[1].lower()
+    if file_ext in ['.jpg', '.jpeg', '.png', '.gif', '.bmp']:
+        return "image"
+    if file_ext in ['.mp3', '.wav', '.m4a', '.ogg']:
+        return "audio"
+    return None
+
+def get_progress_snapshot(batch_id):
+    """Returns a copy of a batch's progress that is safe to serialize while the job runs"""
+    with progress_lock:
+        progress = upload_progress.get(batch_id)
+        if progress is None:
+            return None
+        return {**progress, "results": list(progress["results"])}
+
+def get_duplicate_policy(source):
+    """Reads the on_duplicate override from form data, falling back to DUPLICATE_POLICY"""
+    policy = (source.get("on_duplicate") or DUPLICATE_POLICY).lower()
+    if policy not in DUPLICATE_POLICIES:
+        raise ValueError(f"on_duplicate must be one of {', '.join(DUPLICATE_POLICIES)}")
+    return policy
+
+def check_duplicate(content_hash, filename, policy):
+    """
+    Applies the duplicate policy to content that is already indexed.
+    Returns None when the upload should be indexed, otherwise ("rejected" | "merged", existing_metadata).
+    """
+    if policy == "allow":
+        return None
+    
+    existing = find_by_content_hash(content_hash)
+    if existing is None:
+        return None
+    
+    if policy == "reject":
+        _count_duplicate("rejected")
+        return "rejected", existing
+    
+    merged = merge_duplicate(content_hash, {"original_filename": filename})
+    if merged is None:
+        # The match was deleted since the lookup
+        return None
+    _count_duplicate("merged")
+    return "merged", merged
+
+def _count_duplicate(outcome):
+    with dedup_lock:
+        dedup_stats[outcome] += 1
+
+def _existing_file_info(metadata):
+    """File info for an item that is already in the index"""
+    filename = metadata.get('filename', 'unknown')
+    return {
+        "item_id": metadata.get('item_id'),
+        "filename": filename,
+        "original_name": metadata.get('original_filename', filename),
+        "type": metadata.get('file_type', 'unknown'),
+        "url": f"/static/{filename}",
+        "thumbnail_url": f"/static/{filename}?thumbnail=1" if metadata.get('thumbnail_path') else None,
+        "model_used": metadata.get('model_used', 'unknown')
+    }
+
+def _remove_static_file(file_path):
+    """Removes an item's stored upload and its thumbnail, refusing paths outside STATIC_FOLDER"""
+    static_root = os.path.abspath(STATIC_FOLDER)
+    path = os.path.abspath(file_path or "")
+    if os.path.dirname(path) == static_root and os.path.exists(path):
+        os.remove(path)
+        image_decode.remove_thumbnail(path)
+
+def _thumbnail_metadata(image_path):
+    """Saves the thumbnail of a newly stored image if image_decode.SAVE_THUMBNAILS is on"""
+    if not image_decode.SAVE_THUMBNAILS:
+        return {}
+    thumbnail_path = image_decode.save_thumbnail(image_path)
+    return {"thumbnail_path": thumbnail_path} if thumbnail_path else {}
+
+def _embed_with_store(entries, store_key, embed_many):
+    """
+    Embeds saved batch files, reusing stored embeddings by content hash and only
+    running embed_many on the files that haven't been seen before.
+    """
+    embeddings = [embedding_store.get(entry["content_hash"], store_key) for entry in entries]
+    missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+    
+    if missing:
+        computed = embed_many([entries[i]["static_path"] for i in missing])
+        for i, embedding in zip(missing, computed):
+            embeddings[i] = embedding
+            embedding_store.put(entries[i]["content_hash"], store_key, embedding)
+    
+    return embeddings
+
+def _embed_audio_for_index(audio_path):
+    """Indexing embedding of one audio file: a single row, or one row per segment of long audio"""
+    return get_audio_segment_embeddings([audio_path])[0]
+
+@contextmanager
+def query_file_source(file):
+    """
+    Yields an uploaded query file as bytes when it is at most QUERY_MAX_IN_MEMORY_MB,
+    otherwise as the path of a temporary copy that is removed afterwards
+    """
+    file.seek(0, 2)
+    file_size = file.tell()
+    file.seek(0)
+    
+    if file_size <= QUERY_MAX_IN_MEMORY_MB * 1024 * 1024:
+        yield file.read()
+        return
+    
+    temp_path = os.path.join(UPLOAD_FOLDER, str(uuid.uuid4()) + os.path.splitext(file.filename)[1])
+    try:
+        file.save(temp_path)
+        yield temp_path
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def _embed_uploaded_file(file, query_type):
+    """Embeds an uploaded query image or audio file, reusing stored embeddings by content hash"""
+    model_used = "CLIP" if query_type == "image" else "CLAP"
+    content_hash = embedding_store.hash_stream(file)
+    embedding = embedding_store.get(content_hash, model_used)
+    if embedding is not None:
+        return embedding
+    
+    with query_file_source(file) as source:
+        if query_type == "image":
+            embedding = get_image_embedding(source)
+        else:
+            embedding = get_audio_embedding(source, suffix=os.path.splitext(file.filename)[1])
+    embedding_store.put(content_hash, model_used, embedding)
+    return embedding
+
+def _search_uploaded_file(file, query_type, num_results, search_params):
+    """
+    Embeds an uploaded query image or audio file and searches with it.
+    search_params may include db_name to search a named database. Returns (embedding, results).
+    """
+    model_used = "CLIP" if query_type == "image" else "CLAP"
+    
+    # Repeat queries with the same file skip the model entirely
+    content_hash = embedding_store.hash_stream(file)
+    embedding = embedding_store.get(content_hash, model_used)
+    if embedding is not None:
+        return embedding, search_many(np.asarray(embedding).reshape(1, -1), num_results, **search_params)[0]
+    
+    with query_file_source(file) as source:
+        if query_type == "image":
+            # Concurrent image queries share one CLIP batch and one FAISS search
+            embedding, results = image_query_batcher.search(source, num_results, **search_params)
+        else:
+            embedding = get_audio_embedding(source, suffix=os.path.splitext(file.filename)[1])
+            results = None
+            if embedding is not None:
+                results = search_many(np.asarray(embedding).reshape(1, -1), num_results, **search_params)[0]
+    embedding_store.put(content_hash, model_used, embedding)
+    return embedding, results
+
 @app.route("/upload", methods=["POST"])
 def upload_image():
     """Upload image for search (temporary - not added to index)"""
@@ -63,17 +302,16 @@ def upload_image():
     if file.filename == '':
         return jsonify({"error": "No file selected"}), 400
     
-    file_extension = os.path.splitext(file.filename)[1]
-    secure_filename = str(uuid.uuid4()) + file_extension
-    temp_path = os.path.join(UPLOAD_FOLDER, secure_filename)
-    file.save(temp_path)
-
     try:
-        embedding = get_image_embedding(temp_path)
+        search_params = get_search_params(request.form)
+    except ValueError as e:
+        return jsonify({"error": f"Invalid search parameters: {e}"}), 400
+    
+    try:
+        embedding, results = _search_uploaded_file(file, "image", 5, search_params)
         if embedding is None:
             return jsonify({"error": "Failed to generate image embedding"}), 500
         
-        results = search_similar(embedding, num_results=5)
         return jsonify({
             "status": "Image processed and searched", 
             "results": results,
@@ -81,9 +319,6 @@ def upload_image():
         })
     except Exception as e:
         return jsonify({"error": str(e)}), 500
-    finally:
-        if os.path.exists(temp_path):
-            os.remove(temp_path)
 
 @app.route("/upload_audio", methods=["POST"])
 def upload_audio():
@@ -95,18 +330,17 @@ def upload_audio():
     if file.filename == '':
         return jsonify({"error": "No file selected"}), 400
     
-    file_extension = os.path.splitext(file.filename)[1]
-    secure_filename = str(uuid.uuid4()) + file_extension
-    temp_path = os.path.join(UPLOAD_FOLDER, secure_filename)
-    file.save(temp_path)
-
+    try:
+        search_params = get_search_params(request.form)
+    except ValueError as e:
+        return jsonify({"error": f"Invalid search parameters: {e}"}), 400
+    
     try:
         # Now using CLAP for cross-modal compatibility
-        embedding = get_audio_embedding(temp_path)
+        embedding, results = _search_uploaded_file(file, "audio", 5, search_params)
         if embedding is None:
             return jsonify({"error": "Failed to generate audio embedding with CLAP"}), 500
         
-        results = search_similar(embedding, num_results=5)
         return jsonify({
             "status": "Audio processed and searched with CLAP", 
             "results": results,
@@ -115,9 +349,49 @@ def upload_audio():
         })
     except Exception as e:
         return jsonify({"error": str(e)}), 500
-    finally:
-        if os.path.exists(temp_path):
-            os.remove(temp_path)
+
+def _search_file_in_db(query_type):
+    """Shared body of /search_image and /search_audio"""
+    if query_type not in request.files:
+        return jsonify({"error": f"No {query_type} uploaded"}), 400
+    
+    file = request.files[query_type]
+    if file.filename == '':
+        return jsonify({"error": "No file selected"}), 400
+    
+    try:
+        num_results = int(request.form.get("num_results", 5))
+        search_params = get_search_params(request.form)
+        db_name = get_db_name(request.form)
+    except LookupError as e:
+        return jsonify({"error": str(e)}), 404
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": f"Invalid search parameters: {e}"}), 400
+    
+    try:
+        embedding, results = _search_uploaded_file(file, query_type, num_results, {**search_params, "db_name": db_name})
+        if embedding is None:
+            return jsonify({"error": f"Failed to generate {query_type} embedding"}), 500
+        
+        return jsonify({
+            "status": f"{query_type.capitalize()} processed and searched",
+            "results": results,
+            "query_type": query_type,
+            "db_name": db_name,
+            "num_results": num_results
+        })
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/search_image", methods=["POST"])
+def search_image():
+    """Search a named database (or the global index) with an uploaded image"""
+    return _search_file_in_db("image")
+
+@app.route("/search_audio", methods=["POST"])
+def search_audio():
+    """Search a named database (or the global index) with an uploaded audio clip"""
+    return _search_file_in_db("audio")
 
 @app.route("/add_to_index", methods=["POST"])
 def add_to_index():
@@ -137,33 +411,61 @@ def add_to_index():
     if not is_valid:
         return jsonify({"error": error_msg}), 400
     
+    try:
+        duplicate_policy = get_duplicate_policy(request.form)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    # Byte-identical content is detected before anything is written to static/
+    content_hash = embedding_store.hash_stream(file)
+    duplicate = check_duplicate(content_hash, file.filename, duplicate_policy)
+    if duplicate:
+        outcome, existing = duplicate
+        if outcome == "rejected":
+            return jsonify({
+                "error": "This file is already indexed",
+                "duplicate_of": _existing_file_info(existing)
+            }), 409
+        return jsonify({
+            "status": "success",
+            "message": "Identical file already indexed, merged into the existing item",
+            "merged_into": _existing_file_info(existing),
+            "file_info": _existing_file_info(existing),
+            "index_stats": {
+                "total_items": get_index_size()
+            }
+        })
+    
     # Auto-detect file type if not provided
     if not file_type:
-        file_ext = os.path.splitext(file.filename)[1].lower()
-        if file_ext in ['.jpg', '.jpeg', '.png', '.gif', '.bmp']:
-            file_type = "image"
-        elif file_ext in ['.mp3', '.wav', '.m4a', '.ogg']:
-            file_type = "audio"
-        else:
+        file_type = detect_file_type(file.filename)
+        if not file_type:
             return jsonify({"error": "Unsupported file type"}), 400
     
+    if file_type.lower() == "image":
+        model_used = store_key = "CLIP"
+        embed = get_image_embedding
+    elif file_type.lower() == "audio":
+        # Now using CLAP for audio embeddings, one per segment for long recordings
+        model_used, store_key = "CLAP", "CLAP_SEGMENTS"
+        embed = _embed_audio_for_index
+    else:
+        return jsonify({"error": "Unsupported file type"}), 400
+    
     file_extension = os.path.splitext(file.filename)[1]
     secure_filename = str(uuid.uuid4()) + file_extension
     static_path = os.path.join(STATIC_FOLDER, secure_filename)
     file.save(static_path)
     
     try:
-        if file_type.lower() == "image":
-            embedding = get_image_embedding(static_path)
-            model_used = "CLIP"
-        elif file_type.lower() == "audio":
-            # Now using CLAP for audio embeddings
-            embedding = get_audio_embedding(static_path)
-            model_used = "CLAP"
-        else:
-            return jsonify({"error": "Unsupported file type"}), 400
+        # Re-ingesting known content reuses the stored embedding
+        embedding = embedding_store.get(content_hash, store_key)
+        if embedding is None:
+            embedding = embed(static_path)
+            embedding_store.put(content_hash, store_key, embedding)
         
         if embedding is None:
+            _remove_static_file(static_path)
             return jsonify({"error": f"Failed to generate embedding using {model_used}"}), 500
         
         # Enhanced metadata
@@ -171,8 +473,13 @@ def add_to_index():
             "original_filename": file.filename,
             "description": description,
             "file_size": os.path.getsize(static_path),
-            "model_used": model_used
+            "model_used": model_used,
+            "content_hash": content_hash
         }
+        if file_type.lower() == "audio":
+            extra_metadata.update(audio_decode.segment_metadata(static_path, len(embedding)))
+        else:
+            extra_metadata.update(_thumbnail_metadata(static_path))
         
         success = add_embedding(static_path, embedding, file_type, extra_metadata)
         
@@ -185,55 +492,225 @@ def add_to_index():
                     "original_name": file.filename,
                     "type": file_type,
                     "url": f"/static/{secure_filename}",
+                    "thumbnail_url": f"/static/{secure_filename}?thumbnail=1" if extra_metadata.get("thumbnail_path") else None,
                     "description": description,
                     "model_used": model_used
                 },
                 "index_stats": {
-                    "total_items": faiss_index.ntotal if faiss_index else 0
+                    "total_items": get_index_size()
                 }
             })
         else:
+            _remove_static_file(static_path)
             return jsonify({"error": "Failed to add to index"}), 500
             
     except Exception as e:
-        if os.path.exists(static_path):
-            os.remove(static_path)
+        _remove_static_file(static_path)
         return jsonify({"error": str(e)}), 500
 
+def _index_batch_entries(entries, embeddings, batch_id):
+    """
+    Adds a group of embedded batch files to the index with one bulk insert.
+    Returns a per-file result for every entry, in the same order.
+    """
+    results = [None] * len(entries)
+    embedded = []
+    
+    for i, (entry, embedding) in enumerate(zip(entries, embeddings)):
+        if embedding is None:
+            if os.path.exists(entry["static_path"]):
+                os.remove(entry["static_path"])
+            results[i] = {
+                "filename": entry["filename"], 
+                "status": "error", 
+                "error": f"Failed to generate embedding with {entry['model_used']}"
+            }
+        else:
+            embedded.append(i)
+    
+    if not embedded:
+        return results
+    
+    images = [i for i in embedded if entries[i]["file_type"] == "image"]
+    if images and image_decode.SAVE_THUMBNAILS:
+        thumbnails = image_decode.save_thumbnails([entries[i]["static_path"] for i in images])
+        for i, thumbnail_path in zip(images, thumbnails):
+            entries[i]["thumbnail_path"] = thumbnail_path
+    
+    try:
+        matrices = [np.atleast_2d(embeddings[i]) for i in embedded]
+        metadata_list = []
+        for i, matrix in zip(embedded, matrices):
+            metadata = {
+                "original_filename": entries[i]["filename"],
+                "file_size": os.path.getsize(entries[i]["static_path"]),
+                "batch_id": batch_id,
+                "model_used": entries[i]["model_used"],
+                "content_hash": entries[i]["content_hash"]
+            }
+            # Identical files merged within this batch
+            if entries[i]["duplicates"]:
+                metadata["duplicates"] = [
+                    {"original_filename": duplicate["filename"], "added_at": datetime.now().isoformat()}
+                    for duplicate in entries[i]["duplicates"]
+                ]
+            if entries[i]["file_type"] == "audio":
+                metadata.update(audio_decode.segment_metadata(entries[i]["static_path"], len(matrix)))
+            if entries[i].get("thumbnail_path"):
+                metadata["thumbnail_path"] = entries[i]["thumbnail_path"]
+            metadata_list.append(metadata)
+        
+        # The caller saves the index once the whole batch is in
+        success = add_embeddings(
+            [entries[i]["static_path"] for i in embedded],
+            np.concatenate(matrices),
+            [entries[i]["file_type"] for i in embedded],
+            metadata_list,
+            persist=False,
+            vector_counts=[len(matrix) for matrix in matrices]
+        )
+        error = None if success else "Failed to add to index"
+    except Exception as e:
+        success = False
+        error = str(e)
+    
+    for i in embedded:
+        entry = entries[i]
+        if success:
+            results[i] = {
+                "filename": entry["filename"],
+                "status": "success",
+                "indexed_as": entry["secure_filename"],
+                "type": entry["file_type"],
+                "model_used": entry["model_used"]
+            }
+        else:
+            if os.path.exists(entry["static_path"]):
+                os.remove(entry["static_path"])
+            image_decode.remove_thumbnail(entry["static_path"])
+            results[i] = {"filename": entry["filename"], "status": "error", "error": error}
+    
+    return results
+
+def _record_result(batch_id, position, result):
+    """Stores one file's outcome in the batch progress entry"""
+    with progress_lock:
+        progress = upload_progress.get(batch_id)
+        if progress is None:
+            return
+        progress["completed"] += 1
+        if result["status"] == "success":
+            progress["successful"] += 1
+        else:
+            progress["failed"] += 1
+        progress["results"].append({"position": position, **result})
+
+def _record_entry(batch_id, entry, result):
+    """Stores a saved file's outcome, plus the identical files merged into it within the batch"""
+    _record_result(batch_id, entry["position"], result)
+    for duplicate in entry["duplicates"]:
+        if result["status"] == "success":
+            _record_result(batch_id, duplicate["position"], {
+                "filename": duplicate["filename"],
+                "status": "success",
+                "merged_into": entry["secure_filename"],
+                "type": entry["file_type"],
+                "model_used": entry["model_used"]
+            })
+        else:
+            _record_result(batch_id, duplicate["position"], {
+                "filename": duplicate["filename"],
+                "status": "error",
+                "error": f"Identical to {entry['filename']}, which failed: {result.get('error')}"
+            })
+
+def _set_batch_status(batch_id, status, **fields):
+    with progress_lock:
+        if batch_id in upload_progress:
+            upload_progress[batch_id]["status"] = status
+            upload_progress[batch_id].update(fields)
+
+def _run_batch_job(batch_id, pending_images, pending_audio):
+    """
+    Background part of /batch_index: embeds the saved files chunk by chunk, adds them to
+    the index and updates upload_progress as it goes. Checks for cancellation between chunks.
+    """
+    _set_batch_status(batch_id, "processing", started_at=datetime.now().isoformat())
+    
+    # Images go through CLIP and audio through CLAP, both in batches and skipping content embedded before
+    work = [(pending_images, "CLIP", get_image_embeddings), (pending_audio, "CLAP_SEGMENTS", get_audio_segment_embeddings)]
+    
+    try:
+        for entries, store_key, embed_many in work:
+            for start in range(0, len(entries), BATCH_JOB_CHUNK_SIZE):
+                chunk = entries[start:start + BATCH_JOB_CHUNK_SIZE]
+                
+                if jobs.is_cancelled(batch_id):
+                    for entry in chunk:
+                        if os.path.exists(entry["static_path"]):
+                            os.remove(entry["static_path"])
+                        _record_entry(batch_id, entry, {"filename": entry["filename"], "status": "error", "error": "Cancelled"})
+                    continue
+                
+                embeddings = _embed_with_store(chunk, store_key, embed_many)
+                chunk_results = _index_batch_entries(chunk, embeddings, batch_id)
+                for entry, result in zip(chunk, chunk_results):
+                    _record_entry(batch_id, entry, result)
+    
+    except Exception as e:
+        _set_batch_status(batch_id, "failed", error=str(e), finished_at=datetime.now().isoformat())
+        raise
+    
+    finally:
+        # Make the whole batch durable with one log fsync
+        flush_log()
+    
+    final_status = "cancelled" if jobs.is_cancelled(batch_id) else "completed"
+    _set_batch_status(batch_id, final_status, finished_at=datetime.now().isoformat(), index_stats={"total_items": get_index_size()})
+
 @app.route("/batch_index", methods=["POST"])
 def batch_index():
-    """Upload multiple files at once - Now with CLAP support"""
+    """
+    Upload multiple files at once. Files are validated and saved during the request, then
+    embedded in CLIP/CLAP batches by a background job; poll /upload_progress/<batch_id>.
+    """
     files = request.files.getlist("files")
     if not files:
         return jsonify({"error": "No files uploaded"}), 400
     
+    try:
+        duplicate_policy = get_duplicate_policy(request.form)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
     # Generate batch ID for progress tracking
     batch_id = str(uuid.uuid4())
-    upload_progress[batch_id] = {
-        "status": "processing",
-        "total": len(files),
-        "completed": 0,
-        "successful": 0,
-        "failed": 0,
-        "results": []
-    }
+    with progress_lock:
+        upload_progress[batch_id] = {
+            "status": "queued",
+            "total": len(files),
+            "completed": 0,
+            "successful": 0,
+            "failed": 0,
+            "results": [],
+            "created_at": datetime.now().isoformat()
+        }
     
-    results = []
-    successful = 0
-    failed = 0
+    # Validate and save every file now, the request's file streams are gone once we return
+    pending_images = []
+    pending_audio = []
+    batch_hashes = {}  # content_hash -> entry, for duplicates within this batch
     
     for i, file in enumerate(files):
         if file.filename == '':
-            failed += 1
-            results.append({"filename": "unnamed", "status": "error", "error": "No filename"})
+            _record_result(batch_id, i, {"filename": "unnamed", "status": "error", "error": "No filename"})
             continue
         
         try:
             # Validate file
             is_valid, error_msg = validate_file(file)
             if not is_valid:
-                failed += 1
-                results.append({"filename": file.filename, "status": "error", "error": error_msg})
+                _record_result(batch_id, i, {"filename": file.filename, "status": "error", "error": error_msg})
                 continue
             
             # Auto-detect file type
@@ -245,8 +722,43 @@ def batch_index():
                 file_type = "audio"
                 model_used = "CLAP"  # Now using CLAP for audio
             else:
-                failed += 1
-                results.append({"filename": file.filename, "status": "error", "error": "Unsupported file type"})
+                _record_result(batch_id, i, {"filename": file.filename, "status": "error", "error": "Unsupported file type"})
+                continue
+            
+            content_hash = embedding_store.hash_stream(file)
+            
+            duplicate = check_duplicate(content_hash, file.filename, duplicate_policy)
+            if duplicate:
+                outcome, existing = duplicate
+                if outcome == "rejected":
+                    _record_result(batch_id, i, {
+                        "filename": file.filename,
+                        "status": "error",
+                        "error": "This file is already indexed",
+                        "duplicate_of": _existing_file_info(existing)
+                    })
+                else:
+                    _record_result(batch_id, i, {
+                        "filename": file.filename,
+                        "status": "success",
+                        "merged_into": existing.get('filename'),
+                        "type": existing.get('file_type', file_type),
+                        "model_used": existing.get('model_used', model_used)
+                    })
+                continue
+            
+            if duplicate_policy != "allow" and content_hash in batch_hashes:
+                first = batch_hashes[content_hash]
+                if duplicate_policy == "reject":
+                    _count_duplicate("rejected")
+                    _record_result(batch_id, i, {
+                        "filename": file.filename,
+                        "status": "error",
+                        "error": f"Identical to {first['filename']} in this batch"
+                    })
+                else:
+                    _count_duplicate("merged")
+                    first["duplicates"].append({"position": i, "filename": file.filename})
                 continue
             
             # Save file
@@ -255,80 +767,74 @@ def batch_index():
             static_path = os.path.join(STATIC_FOLDER, secure_filename)
             file.save(static_path)
             
-            # Generate embedding using appropriate model
-            if file_type == "image":
-                embedding = get_image_embedding(static_path)
-            else:  # audio - using CLAP
-                embedding = get_audio_embedding(static_path)
-            
-            if embedding is None:
-                failed += 1
-                results.append({
-                    "filename": file.filename, 
-                    "status": "error", 
-                    "error": f"Failed to generate embedding with {model_used}"
-                })
-                if os.path.exists(static_path):
-                    os.remove(static_path)
-                continue
-            
-            # Add to index
-            extra_metadata = {
-                "original_filename": file.filename,
-                "file_size": os.path.getsize(static_path),
-                "batch_id": batch_id,
-                "model_used": model_used
+            entry = {
+                "position": i,
+                "filename": file.filename,
+                "secure_filename": secure_filename,
+                "static_path": static_path,
+                "file_type": file_type,
+                "model_used": model_used,
+                "content_hash": content_hash,
+                "duplicates": []
             }
-            
-            success = add_embedding(static_path, embedding, file_type, extra_metadata)
-            
-            if success:
-                successful += 1
-                results.append({
-                    "filename": file.filename,
-                    "status": "success",
-                    "indexed_as": secure_filename,
-                    "type": file_type,
-                    "model_used": model_used
-                })
+            batch_hashes[content_hash] = entry
+            if file_type == "image":
+                pending_images.append(entry)
             else:
-                failed += 1
-                results.append({"filename": file.filename, "status": "error", "error": "Failed to add to index"})
-                if os.path.exists(static_path):
-                    os.remove(static_path)
+                pending_audio.append(entry)
                     
         except Exception as e:
-            failed += 1
-            results.append({"filename": file.filename, "status": "error", "error": str(e)})
-        
-        # Update progress
-        upload_progress[batch_id]["completed"] = i + 1
-        upload_progress[batch_id]["successful"] = successful
-        upload_progress[batch_id]["failed"] = failed
-        upload_progress[batch_id]["results"] = results
+            _record_result(batch_id, i, {"filename": file.filename, "status": "error", "error": str(e)})
     
-    # Mark as complete
-    upload_progress[batch_id]["status"] = "completed"
+    try:
+        jobs.submit_job(batch_id, _run_batch_job, batch_id, pending_images, pending_audio)
+    except jobs.JobQueueFull as e:
+        for entry in pending_images + pending_audio:
+            if os.path.exists(entry["static_path"]):
+                os.remove(entry["static_path"])
+        with progress_lock:
+            upload_progress.pop(batch_id, None)
+        return jsonify({"error": f"Ingestion queue is full, try again later ({e})"}), 503
+    
+    with progress_lock:
+        progress = upload_progress[batch_id]
+        rejected_early = progress["completed"]
     
     return jsonify({
-        "status": "batch_complete",
+        "status": "batch_queued",
         "batch_id": batch_id,
         "total_files": len(files),
-        "successful": successful,
-        "failed": failed,
-        "results": results,
+        "queued_files": len(pending_images) + len(pending_audio),
+        "completed_during_upload": rejected_early,
+        "progress_url": f"/upload_progress/{batch_id}",
+        "cancel_url": f"/cancel_batch/{batch_id}",
         "models_used": {"image": "CLIP", "audio": "CLAP"},
-        "cross_modal_search": "enabled",
-        "index_stats": {"total_items": faiss_index.ntotal if faiss_index else 0}
-    })
+        "cross_modal_search": "enabled"
+    }), 202
 
 @app.route("/upload_progress/<batch_id>")
 def get_upload_progress(batch_id):
     """Get upload progress for batch operations"""
-    if batch_id not in upload_progress:
+    progress = get_progress_snapshot(batch_id)
+    if progress is None:
         return jsonify({"error": "Batch ID not found"}), 404
     
-    return jsonify(upload_progress[batch_id])
+    return jsonify(progress)
+
+@app.route("/cancel_batch/<batch_id>", methods=["POST"])
+def cancel_batch(batch_id):
+    """Cancel a queued or running batch; files already indexed stay in the index"""
+    progress = get_progress_snapshot(batch_id)
+    if progress is None:
+        return jsonify({"error": "Batch ID not found"}), 404
+    
+    if not jobs.cancel_job(batch_id):
+        return jsonify({"error": f"Batch is already {progress['status']}"}), 409
+    
+    with progress_lock:
+        if upload_progress.get(batch_id, {}).get("status") in ("queued", "processing"):
+            upload_progress[batch_id]["status"] = "cancelling"
+    return jsonify({"status": "cancelling", "batch_id": batch_id})
 
 # Keep the original index_file endpoint for backward compatibility
 @app.route("/index_file", methods=["POST"])
@@ -347,27 +853,200 @@ def search_text():
     
     if not text.strip():
         return jsonify({"error": "Empty text provided"}), 400
+    
+    try:
+        num_results = int(num_results)
+        search_params = get_search_params(data)
+        db_name = get_db_name(data)
+    except LookupError as e:
+        return jsonify({"error": str(e)}), 404
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": f"Invalid search parameters: {e}"}), 400
 
     try:
-        embedding = get_text_embedding(text)
+        # Concurrent text queries share one CLIP batch and one FAISS search per database
+        embedding, results = text_query_batcher.search(text, num_results, db_name=db_name, **search_params)
         if embedding is None:
             return jsonify({"error": "Failed to generate text embedding"}), 500
         
-        results = search_similar(embedding, num_results=num_results)
         return jsonify({
             "status": "Text processed and searched", 
             "results": results,
             "query_type": "text",
             "query": text,
             "num_results": num_results,
+            "db_name": db_name,
             "cross_modal_enabled": "Text can find both images (CLIP) and audio (CLAP)"
         })
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route("/search_multi", methods=["POST"])
+def search_multi():
+    """
+    Federated search: embeds the query once and searches several named databases in parallel.
+    Takes JSON {"text", "db_names", "num_results"} or form data with an image/audio file,
+    db_names (repeated or comma-separated) and num_results. No db_names searches every database.
+    """
+    data = request.get_json(silent=True) if request.is_json else request.form
+    if data is None:
+        return jsonify({"error": "No query provided"}), 400
+    
+    if request.is_json:
+        if not isinstance(data, dict):
+            return jsonify({"error": "Expected a JSON object"}), 400
+        db_names = data.get("db_names") or []
+        if not isinstance(db_names, list) or not all(isinstance(name, str) for name in db_names):
+            return jsonify({"error": "db_names must be a list of database names"}), 400
+    else:
+        db_names = [name.strip() for value in data.getlist("db_names") for name in value.split(",") if name.strip()]
+    if not db_names:
+        db_names = sorted(multi_database.list_databases())
+    
+    missing = [db_name for db_name in db_names if not multi_database.database_exists(db_name)]
+    if missing:
+        return jsonify({"error": f"Databases not found: {', '.join(missing)}"}), 404
+    
+    try:
+        num_results = int(data.get("num_results", 5))
+        search_params = get_search_params(data)
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": f"Invalid search parameters: {e}"}), 400
+    
+    try:
+        if data.get("text"):
+            query_type = "text"
+            embedding = get_text_embedding(data["text"])
+        elif "image" in request.files or "audio" in request.files:
+            query_type = "image" if "image" in request.files else "audio"
+            file = request.files[query_type]
+            if file.filename == '':
+                return jsonify({"error": "No file selected"}), 400
+            embedding = _embed_uploaded_file(file, query_type)
+        else:
+            return jsonify({"error": "Provide text, image or audio to search with"}), 400
+        
+        if embedding is None:
+            return jsonify({"error": f"Failed to generate {query_type} embedding"}), 500
+        
+        results, per_db = multi_database.federated_search(db_names, embedding, num_results, **search_params)
+        return jsonify({
+            "status": "Searched across databases",
+            "results": results,
+            "query_type": query_type,
+            "db_names": db_names,
+            "per_database": per_db,
+            "num_results": num_results
+        })
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/create_database", methods=["POST"])
+def create_database():
+    """Create a named database with its own index"""
+    data = request.get_json(silent=True) or {}
+    db_name = data.get("db_name")
+    if not db_name:
+        return jsonify({"success": False, "message": "No database name provided"}), 400
+    
+    success, message = multi_database.create_database(db_name)
+    if success:
+        print(f"📂 Created database '{db_name}'")
+    return jsonify({"success": success, "message": message}), (200 if success else 400)
+
+@app.route("/list_databases", methods=["GET"])
+def list_databases():
+    """List named databases with their sizes"""
+    databases = []
+    for db_name in sorted(multi_database.list_databases()):
+        info = multi_database.db_info(db_name)
+        if info is not None:
+            databases.append(info)
+    return jsonify(databases)
+
+@app.route("/database_stats/<db_name>", methods=["GET"])
+def database_stats(db_name):
+    """Detailed statistics for one named database"""
+    stats = multi_database.db_stats(db_name)
+    if stats is None:
+        return jsonify({"error": f"Database '{db_name}' not found"}), 404
+    return jsonify(stats)
+
+@app.route("/upload_file", methods=["POST"])
+def upload_file():
+    """Add a file to a named database"""
+    if "file" not in request.files:
+        return jsonify({"success": False, "error": "No file uploaded"}), 400
+    
+    file = request.files["file"]
+    db_name = request.form.get("db_name")
+    if not db_name:
+        return jsonify({"success": False, "error": "No database name provided"}), 400
+    if not multi_database.database_exists(db_name):
+        return jsonify({"success": False, "error": f"Database '{db_name}' not found"}), 404
+    
+    is_valid, error_msg = validate_file(file)
+    if not is_valid:
+        return jsonify({"success": False, "error": error_msg}), 400
+    
+    file_type = (request.form.get("type") or detect_file_type(file.filename) or "").lower()
+    if file_type == "image":
+        model_used, embed = "CLIP", get_image_embedding
+    elif file_type == "audio":
+        model_used, embed = "CLAP", get_audio_embedding
+    else:
+        return jsonify({"success": False, "error": "Unsupported file type"}), 400
+    
+    content_hash = embedding_store.hash_stream(file)
+    secure_filename = str(uuid.uuid4()) + os.path.splitext(file.filename)[1]
+    static_path = os.path.join(STATIC_FOLDER, secure_filename)
+    file.save(static_path)
+    
+    try:
+        embedding = embedding_store.get(content_hash, model_used)
+        if embedding is None:
+            embedding = embed(static_path)
+            embedding_store.put(content_hash, model_used, embedding)
+        
+        if embedding is None:
+            os.remove(static_path)
+            return jsonify({"success": False, "error": f"Failed to generate embedding using {model_used}"}), 500
+        
+        success, message = multi_database.add_embedding_to_db(db_name, static_path, embedding, file_type, {
+            "original_filename": file.filename,
+            "file_size": os.path.getsize(static_path),
+            "model_used": model_used,
+            "content_hash": content_hash
+        })
+        if not success:
+            os.remove(static_path)
+            return jsonify({"success": False, "error": message}), 500
+        
+        info = multi_database.db_info(db_name)
+        return jsonify({
+            "success": True,
+            "message": f"File added to '{db_name}' with {model_used}",
+            "file_info": {
+                "filename": secure_filename,
+                "original_name": file.filename,
+                "type": file_type,
+                "url": f"/static/{secure_filename}",
+                "model_used": model_used
+            },
+            "db_stats": {"ntotal": info["ntotal"] if info else None}
+        })
+    except Exception as e:
+        if os.path.exists(static_path):
+            os.remove(static_path)
+        return jsonify({"success": False, "error": str(e)}), 500
+
 @app.route('/static/<filename>')
 def serve_static_file(filename):
-    """Serve static files from the static directory"""
+    """Serve static files from the static directory. ?thumbnail=1 serves an image's thumbnail if it has one."""
+    if request.args.get("thumbnail"):
+        thumbnail = os.path.basename(image_decode.thumbnail_path(filename))
+        if os.path.exists(os.path.join(STATIC_FOLDER, thumbnail)):
+            return send_from_directory(STATIC_FOLDER, thumbnail)
     return send_from_directory(STATIC_FOLDER, filename)
 
 @app.route('/status')
@@ -375,23 +1054,30 @@ def status():
     """Get system status with CLAP integration info"""
     model_status = models.get_model_status()
     
-    # Import faiss_index properly from database module
-    from database import faiss_index
-    
     # Get indexed items count safely
     try:
-        indexed_count = faiss_index.ntotal if faiss_index is not None else 0
+        indexed_count = get_index_size()
     except:
         indexed_count = 0
     
     return jsonify({
         "status": "running",
+        "ready": model_status["ready"],
         "models_loaded": model_status,
         "cross_modal_search": {
             "enabled": model_status.get("clip_loaded", False) and model_status.get("clap_loaded", False),
             "description": "Images and audio can find each other through shared embedding space"
         },
         "indexed_items": indexed_count,
+        "index": get_index_info(),
+        "text_embedding_cache": get_text_cache_stats(),
+        "audio_decode": audio_decode.get_stats(),
+        "ingest_jobs": jobs.get_job_stats(),
+        "databases": multi_database.get_registry_stats(),
+        "query_batching": {
+            "text": text_query_batcher.get_stats(),
+            "image": image_query_batcher.get_stats()
+        },
         "upload_folder": UPLOAD_FOLDER,
         "static_folder": STATIC_FOLDER,
         "supported_formats": {
@@ -409,27 +1095,26 @@ def status():
 @app.route('/index_stats')
 def index_stats():
     """Get detailed index statistics"""
-    from database import file_metadata, file_paths
+    # Counts come from incrementally maintained counters, recent items from the added_at order
+    metadata_stats = get_metadata_stats()
+    with dedup_lock:
+        duplicates = dict(dedup_stats)
     
     stats = {
-        "total_items": faiss_index.ntotal if faiss_index else 0,
-        "file_types": {},
-        "models_used": {},
+        "total_items": get_index_size(),
+        "index": get_index_info(),
+        "embedding_cache": embedding_store.get_stats(),
+        "duplicates": {**duplicates, "policy": DUPLICATE_POLICY},
+        "file_types": metadata_stats["file_types"],
+        "models_used": metadata_stats["models_used"],
         "recent_additions": []
     }
     
-    # Count by file type and model used
-    for metadata in file_metadata:
-        file_type = metadata.get('file_type', 'unknown')
-        model_used = metadata.get('model_used', 'unknown')
-        
-        stats["file_types"][file_type] = stats["file_types"].get(file_type, 0) + 1
-        stats["models_used"][model_used] = stats["models_used"].get(model_used, 0) + 1
-    
     # Get recent additions (last 10)
-    recent = sorted(file_metadata, key=lambda x: x.get('added_at', ''), reverse=True)[:10]
+    recent = get_recent_items(10)
     stats["recent_additions"] = [
         {
+            "item_id": item.get('item_id'),
             "filename": item.get('filename', 'unknown'),
             "type": item.get('file_type', 'unknown'),
             "added_at": item.get('added_at', 'unknown'),
@@ -452,17 +1137,20 @@ def test_cross_modal():
         
         results = search_similar(text_embedding, num_results=10)
         
-        # Count by file type
+        # Search each modality on its own, so one dominating type can't hide the others
         type_counts = {}
-        for result in results:
-            file_type = result.get('file_type', 'unknown')
-            type_counts[file_type] = type_counts.get(file_type, 0) + 1
+        top_by_type = {}
+        for file_type in get_metadata_stats()["file_types"]:
+            typed_results = search_similar(text_embedding, num_results=10, filters={"file_type": [file_type]})
+            type_counts[file_type] = len(typed_results)
+            top_by_type[file_type] = typed_results[:1]
         
         return jsonify({
             "status": "success",
             "test_query": "dog barking",
             "total_results": len(results),
             "results_by_type": type_counts,
+            "top_result_by_type": top_by_type,
             "cross_modal_working": len(type_counts) > 1,
             "explanation": "With CLAP, audio embeddings are now compatible with CLIP image/text space",
             "expected_behavior": "Should find both images and audio when searching with text",
@@ -497,13 +1185,17 @@ def verify_embeddings():
 @app.route('/reset_index', methods=['POST'])
 def reset_index():
     """Reset the FAISS index for testing"""
-    from database import reset_index
+    from database import reset_index, ReadOnlyIndexError
     
-    # Clear progress tracking
-    global upload_progress
-    upload_progress = {}
+    # Stop background ingestion and clear progress tracking
+    jobs.cancel_all()
+    with progress_lock:
+        upload_progress.clear()
     
-    reset_index()
+    try:
+        reset_index()
+    except ReadOnlyIndexError as e:
+        return jsonify({"error": str(e)}), 503
     return jsonify({
         "status": "Index reset successfully", 
         "note": "Rebuild index with CLAP-enabled embeddings for cross-modal search"
@@ -512,27 +1204,28 @@ def reset_index():
 @app.route('/upload_status/<task_id>')
 def upload_status(task_id):
     """Get real-time upload and indexing status"""
-    if task_id not in upload_progress:
+    progress = get_progress_snapshot(task_id)
+    if progress is None:
         return jsonify({"error": "Task not found"}), 404
     
-    return jsonify(upload_progress[task_id])
+    return jsonify(progress)
 
 @app.route('/recent_uploads', methods=['GET'])
 def recent_uploads():
     """Get recently uploaded and indexed files"""
-    from database import file_metadata
-    
     try:
         # Get last 20 uploads, sorted by most recent
-        recent = sorted(file_metadata, key=lambda x: x.get('added_at', ''), reverse=True)[:20]
+        recent = get_recent_items(20)
         
         uploads = []
         for item in recent:
             uploads.append({
+                "item_id": item.get('item_id'),
                 "filename": item.get('original_filename', item.get('filename', 'unknown')),
                 "type": item.get('file_type', 'unknown'),
                 "added_at": item.get('added_at', 'unknown'),
                 "file_url": f"/static/{item.get('filename', '')}",
+                "thumbnail_url": f"/static/{item.get('filename', '')}?thumbnail=1" if item.get('thumbnail_path') else None,
                 "model_used": item.get('model_used', 'unknown'),
                 "file_size": item.get('file_size', 0)
             })
@@ -540,7 +1233,7 @@ def recent_uploads():
         return jsonify({
             "status": "success",
             "recent_uploads": uploads,
-            "total_count": len(file_metadata)
+            "total_count": get_index_size()
         })
         
     except Exception as e:
@@ -549,11 +1242,117 @@ def recent_uploads():
 
 @app.route('/delete_item/<int:item_id>', methods=['DELETE'])
 def delete_item(item_id):
-    """Delete a specific item from the index (Note: FAISS doesn't support deletion, so this is a placeholder)"""
+    """Delete an item from the index; its vector is tombstoned and dropped at the next compaction"""
+    try:
+        metadata = delete_indexed_item(item_id)
+        if metadata is None:
+            return jsonify({"error": f"Item {item_id} not found"}), 404
+        
+        _remove_static_file(metadata.get('file_path'))
+        return jsonify({
+            "status": "success",
+            "message": f"Item {item_id} deleted",
+            "deleted": _existing_file_info(metadata),
+            "index_stats": {
+                "total_items": get_index_size()
+            }
+        })
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/update_item/<int:item_id>', methods=['POST', 'PUT'])
+def update_item(item_id):
+    """
+    Re-embed one item in place, keeping its id. With a "file" upload the item's content is
+    replaced; without one the stored file (or, for images, its thumbnail) is re-embedded
+    with the current model.
+    """
+    current = get_item(item_id)
+    if current is None:
+        return jsonify({"error": f"Item {item_id} not found"}), 404
+    
+    file = request.files.get("file")
+    extra_metadata = {}
+    if "description" in request.form:
+        extra_metadata["description"] = request.form["description"]
+    
+    new_path = None
+    if file is not None:
+        is_valid, error_msg = validate_file(file)
+        if not is_valid:
+            return jsonify({"error": error_msg}), 400
+        file_type = detect_file_type(file.filename)
+        content_hash = embedding_store.hash_stream(file)
+        secure_filename = str(uuid.uuid4()) + os.path.splitext(file.filename)[1]
+        new_path = os.path.join(STATIC_FOLDER, secure_filename)
+        file.save(new_path)
+        source_path = new_path
+        extra_metadata.update({
+            "file_path": new_path,
+            "filename": secure_filename,
+            "file_type": file_type,
+            "original_filename": file.filename,
+            "file_size": os.path.getsize(new_path),
+            "content_hash": content_hash
+        })
+    else:
+        file_type = current.get('file_type')
+        source_path = current.get('file_path')
+        content_hash = current.get('content_hash')
+        thumbnail_path = current.get('thumbnail_path')
+        if thumbnail_path and os.path.exists(thumbnail_path):
+            # The thumbnail is already the size CLIP sees, no need to decode the original.
+            # Its vector is not stored under the original's hash: re-encoding the JPEG
+            # shifts it slightly, and uploads of the original would then reuse it.
+            source_path = thumbnail_path
+            content_hash = None
+        if not source_path or not os.path.exists(source_path):
+            return jsonify({"error": f"File for item {item_id} is missing, upload a replacement"}), 409
+    
+    try:
+        if file_type == "image":
+            model_used = store_key = "CLIP"
+            embed = get_image_embedding
+        elif file_type == "audio":
+            model_used, store_key = "CLAP", "CLAP_SEGMENTS"
+            embed = _embed_audio_for_index
+        else:
+            raise ValueError(f"Unsupported file type: {file_type}")
+        
+        # Always run the model: re-embedding is how items pick up a new model version
+        embedding = embed(source_path)
+        if embedding is None:
+            raise RuntimeError(f"Failed to generate embedding using {model_used}")
+        if content_hash:
+            embedding_store.put(content_hash, store_key, embedding)
+        extra_metadata["model_used"] = model_used
+        if file_type == "audio":
+            extra_metadata.update(audio_decode.segment_metadata(source_path, len(embedding)))
+        if new_path:
+            extra_metadata["thumbnail_path"] = None
+            if file_type == "image":
+                extra_metadata.update(_thumbnail_metadata(new_path))
+        
+        metadata = update_indexed_item(item_id, embedding, extra_metadata)
+        if metadata is None:
+            raise LookupError(f"Item {item_id} not found")
+    except Exception as e:
+        if new_path:
+            _remove_static_file(new_path)
+        status_code = 404 if isinstance(e, LookupError) else 500
+        return jsonify({"error": str(e)}), status_code
+    
+    if new_path:
+        _remove_static_file(current.get('file_path'))
+    
     return jsonify({
-        "error": "Individual item deletion not supported with current FAISS implementation",
-        "suggestion": "Use reset_index to clear all items and re-add desired items with CLAP support"
-    }), 501
+        "status": "success",
+        "message": f"Item {item_id} re-embedded with {model_used}",
+        "file_info": _existing_file_info(metadata),
+        "index_stats": {
+            "total_items": get_index_size()
+        }
+    })
 
 if __name__ == "__main__":
     print("Starting Flask server with CLAP support...")
@@ -566,11 +1365,14 @@ if __name__ == "__main__":
     print("  - Now you can search images with audio, audio with images, etc!")
     print("\nAvailable endpoints:")
     print("  - POST /add_to_index - Add files to searchable index (CLAP for audio)")
-    print("  - POST /batch_index - Add multiple files at once")
+    print("  - POST /batch_index - Add multiple files at once (background job)")
+    print("  - POST /cancel_batch/<batch_id> - Cancel a running batch")
     print("  - POST /upload - Search with uploaded image")
     print("  - POST /upload_audio - Search with uploaded audio (CLAP)")
     print("  - POST /search_text - Search with text query")
     print("  - GET /test_cross_modal - Test cross-modal search")
     print("  - GET /status - System status with CLAP info")
     print("  - GET /index_stats - Index statistics")
-    app.run(debug=True, port=5001, host='0.0.0.0')
+    # No reloader: its file-watching parent process imports this module too, and would
+    # become the index writer (see database.WRITER_LOCK_FILE) instead of the actual server
+    app.run(debug=True, use_reloader=False, port=5001, host='0.0.0.0')
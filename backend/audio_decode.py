@@ -0,0 +1,231 @@
+import io
+import math
+import multiprocessing
+import os
+import threading
+import numpy as np
+import librosa
+from concurrent.futures import ProcessPoolExecutor
+import embedding_store
+
+# Audio decoding for CLAP backends that take waveforms. Files are decoded and resampled
+# in one librosa.load call, on a process pool so MP3/M4A decoding runs in parallel and
+# off the request threads.
+AUDIO_DECODE_WORKERS = min(4, os.cpu_count() or 1)
+# Workers are started fresh rather than forked: forking the multi-threaded server (with
+# torch loaded) can leave locks held by other threads locked forever in the children
+AUDIO_DECODE_START_METHOD = "spawn"
+
+# Decoded waveforms are kept as .npy files keyed by content hash and sample rate, so
+# re-embedding (e.g. after a model upgrade) skips decoding entirely. They keep the file's
+# own levels: laion-clap's file loader doesn't normalize, and vectors computed from cached
+# waveforms have to match the ones it produced.
+WAVEFORM_CACHE_ENABLED = True
+WAVEFORM_CACHE_FOLDER = "waveform_cache"
+
+# Long audio is indexed as overlapping windows, one vector each, so a short event in a
+# long recording can still be found. Files shorter than LONG_AUDIO_MIN_SECONDS keep a
+# single whole-file vector. Long files are decoded once, front to back, STREAM_BLOCK_SECONDS
+# at a time, so memory doesn't grow with the length of the recording (formats libsndfile
+# can't stream, such as M4A, are decoded whole instead).
+SEGMENT_LONG_AUDIO = True
+SEGMENT_SECONDS = 10.0
+SEGMENT_HOP_SECONDS = 5.0
+LONG_AUDIO_MIN_SECONDS = 30.0
+STREAM_BLOCK_SECONDS = 120.0
+
+_pool = None
+_pool_lock = threading.Lock()
+_stats_lock = threading.Lock()
+_stats = {"decoded": 0, "cache_hits": 0, "failed": 0}
+
+def decode_audio(source, target_sr, normalize=False):
+    """Decodes a path or bytes straight to mono float32 at target_sr, peak-normalized if asked"""
+    if isinstance(source, (bytes, bytearray)):
+        source = io.BytesIO(source)
+    waveform, _ = librosa.load(source, sr=target_sr, mono=True)
+    waveform = np.asarray(waveform, dtype=np.float32)
+    max_abs_value = np.max(np.abs(waveform)) if normalize and waveform.size else 0
+    if max_abs_value > 0:
+        waveform = waveform / max_abs_value
+    return waveform
+
+def _cache_path(content_hash, target_sr):
+    # "raw": earlier caches held peak-normalized waveforms under <target_sr>/ directly
+    return os.path.join(WAVEFORM_CACHE_FOLDER, "raw", str(target_sr), content_hash[:2], f"{content_hash}.npy")
+
+def _read_cached(content_hash, target_sr):
+    path = _cache_path(content_hash, target_sr)
+    if not os.path.exists(path):
+        return None
+    try:
+        return np.load(path)
+    except Exception as e:
+        print(f"⚠️  Ignoring unreadable cached waveform {path}: {e}")
+        return None
+
+def _decode_file(path, target_sr, content_hash):
+    """Runs in a worker process: decodes one file and stores it in the waveform cache"""
+    waveform = decode_audio(path, target_sr)
+    if content_hash is not None:
+        cache_path = _cache_path(content_hash, target_sr)
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        temp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(temp_path, 'wb') as f:
+            np.save(f, waveform)
+        os.replace(temp_path, cache_path)
+    return waveform
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=AUDIO_DECODE_WORKERS,
+                                        mp_context=multiprocessing.get_context(AUDIO_DECODE_START_METHOD))
+        return _pool
+
+def _count(key, n=1):
+    with _stats_lock:
+        _stats[key] += n
+
+def decode_many(audio_paths, target_sr, content_hashes=None):
+    """
+    Decodes many audio files to target_sr in parallel, serving cached waveforms where possible.
+    Returns a list aligned with audio_paths, with None for files that failed to decode.
+    """
+    waveforms = [None] * len(audio_paths)
+    if WAVEFORM_CACHE_ENABLED and content_hashes is None:
+        content_hashes = [embedding_store.hash_file(path) if os.path.exists(path) else None for path in audio_paths]
+    if not WAVEFORM_CACHE_ENABLED:
+        content_hashes = [None] * len(audio_paths)
+
+    pending = {}
+    for i, (path, content_hash) in enumerate(zip(audio_paths, content_hashes)):
+        if content_hash is not None:
+            waveforms[i] = _read_cached(content_hash, target_sr)
+            if waveforms[i] is not None:
+                _count("cache_hits")
+                continue
+        pending[i] = (path, content_hash)
+
+    if len(pending) == 1 or AUDIO_DECODE_WORKERS <= 1:
+        # Not worth a round trip through the pool
+        futures = None
+    else:
+        pool = _get_pool()
+        futures = {i: pool.submit(_decode_file, path, target_sr, content_hash)
+                   for i, (path, content_hash) in pending.items()}
+
+    for i, (path, content_hash) in pending.items():
+        try:
+            waveforms[i] = futures[i].result() if futures else _decode_file(path, target_sr, content_hash)
+            _count("decoded")
+        except Exception as e:
+            print(f"❌ Error decoding audio {path}: {e}")
+            _count("failed")
+
+    return waveforms
+
+def get_duration(path):
+    """Length of an audio file in seconds, read from its header where the format allows; None if unreadable"""
+    try:
+        return float(librosa.get_duration(path=path))
+    except TypeError:
+        # librosa < 0.10 calls it filename
+        return float(librosa.get_duration(filename=path))
+    except Exception as e:
+        print(f"⚠️  Could not read the duration of {path}: {e}")
+        return None
+
+def is_long_audio(duration):
+    return SEGMENT_LONG_AUDIO and duration is not None and duration >= LONG_AUDIO_MIN_SECONDS
+
+def num_segments(duration):
+    """Number of SEGMENT_SECONDS windows, SEGMENT_HOP_SECONDS apart, needed to cover duration"""
+    if duration <= SEGMENT_SECONDS:
+        return 1
+    return math.ceil((duration - SEGMENT_SECONDS) / SEGMENT_HOP_SECONDS) + 1
+
+def segment_bounds(count, duration):
+    """[start, end] in seconds of the first count windows of a file"""
+    return [[round(n * SEGMENT_HOP_SECONDS, 3), round(min(n * SEGMENT_HOP_SECONDS + SEGMENT_SECONDS, duration), 3)]
+            for n in range(count)]
+
+def segment_metadata(path, count):
+    """Duration of an indexed audio file and, if it was indexed as count windows, their time ranges"""
+    duration = get_duration(path)
+    if duration is None:
+        return {}
+    metadata = {"duration": round(duration, 3)}
+    if count > 1:
+        metadata["segments"] = segment_bounds(count, duration)
+    return metadata
+
+def _stream_resampler(orig_sr, target_sr):
+    """Returns resample(block, last) for consecutive blocks of one stream"""
+    if orig_sr == target_sr:
+        return lambda block, last: block
+    try:
+        # librosa's own default resampler, with state carried across blocks
+        import soxr
+        stream = soxr.ResampleStream(orig_sr, target_sr, 1, dtype="float32")
+        return lambda block, last: stream.resample_chunk(block, last=last)
+    except ImportError:
+        return lambda block, last: librosa.resample(block, orig_sr=orig_sr, target_sr=target_sr) if len(block) else block
+
+def _iter_blocks(path, target_sr):
+    """Yields a file's mono samples at target_sr in consecutive blocks, decoding it once"""
+    block_seconds = max(STREAM_BLOCK_SECONDS, SEGMENT_SECONDS)
+    try:
+        import soundfile
+        sound_file = soundfile.SoundFile(path)
+    except Exception:
+        # Seeking with librosa.load(offset=...) would decode compressed formats from the start
+        # for every block, so files libsndfile can't read are decoded whole, once
+        waveform, _ = librosa.load(path, sr=target_sr, mono=True)
+        yield np.asarray(waveform, dtype=np.float32)
+        return
+    
+    with sound_file:
+        resample = _stream_resampler(sound_file.samplerate, target_sr)
+        blocksize = int(block_seconds * sound_file.samplerate)
+        for block in sound_file.blocks(blocksize=blocksize, dtype="float32", always_2d=True):
+            yield resample(block.mean(axis=1), False)
+        yield resample(np.zeros(0, dtype=np.float32), True)
+
+def iter_segments(path, target_sr, duration=None):
+    """
+    Yields the SEGMENT_SECONDS windows of a file at target_sr, SEGMENT_HOP_SECONDS apart,
+    decoding it STREAM_BLOCK_SECONDS at a time. The last window may be shorter. Windows are
+    not peak-normalized: the peak of the whole file isn't known while streaming, and
+    normalizing each window would blow quiet stretches up to full scale.
+    """
+    duration = get_duration(path) if duration is None else duration
+    window = int(SEGMENT_SECONDS * target_sr)
+    hop = int(SEGMENT_HOP_SECONDS * target_sr)
+    blocks = _iter_blocks(path, target_sr)
+    
+    buffer = np.zeros(0, dtype=np.float32)
+    buffer_start = 0  # Sample offset of buffer[0] in the file
+    for n in range(num_segments(duration)):
+        start = n * hop
+        # Drop samples no later window needs, then decode until this window is complete
+        buffer = buffer[start - buffer_start:]
+        buffer_start = start
+        while len(buffer) < window:
+            block = next(blocks, None)
+            if block is None:
+                break
+            buffer = np.concatenate([buffer, np.asarray(block, dtype=np.float32)])
+        if len(buffer) == 0:
+            return
+        yield buffer[:window]
+    _count("decoded")
+
+def get_stats():
+    """Returns decode / cache counters"""
+    with _stats_lock:
+        stats = dict(_stats)
+    stats["workers"] = AUDIO_DECODE_WORKERS
+    stats["cache_enabled"] = WAVEFORM_CACHE_ENABLED
+    return stats
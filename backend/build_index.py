@@ -1,8 +1,11 @@
 import requests
 import os
+import time
 from pathlib import Path
 
 BASE_URL = "http://localhost:5001"
+MODEL_READY_TIMEOUT_SECONDS = 300
+STATUS_POLL_SECONDS = 2
 
 images = ["car", "cat", 'children_play', 'dog1', 'dog2', 'piano']
 audios = ['barking', 'birds', 'meow', 'piano', 'waves']
@@ -33,26 +36,84 @@ def index_file(file_path, file_type):
         print(f"❌ Error indexing {file_path}: {e}")
         return False
 
-def check_server_status():
-    """Check if the server is running and models are loaded"""
+def wait_for_batch(batch_id, poll_interval=1.0):
+    """Poll a background batch until it finishes and return its final progress"""
+    while True:
+        response = requests.get(f"{BASE_URL}/upload_progress/{batch_id}")
+        if response.status_code != 200:
+            print(f"❌ Lost track of batch {batch_id}: {response.text}")
+            return None
+        
+        progress = response.json()
+        if progress.get('status') in ('completed', 'cancelled', 'failed'):
+            return progress
+        
+        print(f"   ⏳ {progress.get('completed', 0)}/{progress.get('total', 0)} files processed...")
+        time.sleep(poll_interval)
+
+def index_files_batch(file_paths):
+    """Index several files in one request so the server can embed them in batches"""
+    handles = []
     try:
-        response = requests.get(f"{BASE_URL}/status")
-        if response.status_code == 200:
+        for file_path in file_paths:
+            handles.append(open(file_path, 'rb'))
+        files = [('files', (os.path.basename(f.name), f)) for f in handles]
+        response = requests.post(f"{BASE_URL}/batch_index", files=files)
+        
+        if response.status_code not in (200, 202):
+            print(f"❌ Batch indexing failed: {response.text}")
+            return 0
+        
+        # The server embeds the batch in the background
+        result = wait_for_batch(response.json()['batch_id'])
+        if result is None:
+            return 0
+        
+        for item in sorted(result.get('results', []), key=lambda r: r.get('position', 0)):
+            if item.get('status') == 'success':
+                print(f"✅ Indexed: {item.get('filename')} ({item.get('model_used', 'unknown')})")
+            else:
+                print(f"❌ Failed to index {item.get('filename')}: {item.get('error')}")
+        if result.get('status') != 'completed':
+            print(f"⚠️  Batch finished with status: {result.get('status')}")
+        return result.get('successful', 0)
+    except Exception as e:
+        print(f"❌ Error batch indexing {len(file_paths)} files: {e}")
+        return 0
+    finally:
+        for f in handles:
+            f.close()
+
+def check_server_status(timeout=MODEL_READY_TIMEOUT_SECONDS):
+    """Check if the server is running and wait for its models to finish loading"""
+    deadline = time.time() + timeout
+    try:
+        while True:
+            response = requests.get(f"{BASE_URL}/status")
+            if response.status_code != 200:
+                print(f"❌ Server not responding: {response.status_code}")
+                return False
             status = response.json()
-            print("🔍 Server Status Check:")
-            print(f"   Server running: ✅")
-            print(f"   CLIP loaded: {'✅' if status['models_loaded'].get('clip_loaded') else '❌'}")
-            print(f"   CLAP loaded: {'✅' if status['models_loaded'].get('clap_loaded') else '❌'}")
-            
-            if not status['models_loaded'].get('clip_loaded'):
-                print("⚠️  CLIP model not loaded - image processing will fail")
-            if not status['models_loaded'].get('clap_loaded'):
-                print("⚠️  CLAP model not loaded - audio processing will fail")
-                
-            return status['models_loaded'].get('clip_loaded') and status['models_loaded'].get('clap_loaded')
-        else:
-            print(f"❌ Server not responding: {response.status_code}")
-            return False
+            # Models load in the background after startup; "ready" is set once the warm-up is done
+            states = status['models_loaded'].get('states', {})
+            failed = [name for name, state in states.items() if state.get('state') == 'failed']
+            if status.get('ready') or failed or time.time() >= deadline:
+                break
+            loading = [name for name, state in states.items() if state.get('state') != 'ready']
+            print(f"⏳ Waiting for models to load: {', '.join(loading)}")
+            time.sleep(STATUS_POLL_SECONDS)
+        
+        print("🔍 Server Status Check:")
+        print(f"   Server running: ✅")
+        print(f"   CLIP loaded: {'✅' if status['models_loaded'].get('clip_loaded') else '❌'}")
+        print(f"   CLAP loaded: {'✅' if status['models_loaded'].get('clap_loaded') else '❌'}")
+        
+        for name in failed:
+            print(f"⚠️  {name.upper()} model failed to load: {states[name].get('error')}")
+        if not status.get('ready') and not failed:
+            print(f"⚠️  Models still not loaded after {timeout}s")
+        
+        return bool(status.get('ready'))
     except Exception as e:
         print(f"❌ Cannot connect to server: {e}")
         print("💡 Make sure your Flask server is running on port 5001")
@@ -89,26 +150,34 @@ def create_test_index():
     
     # Index images
     print("\n📸 Indexing images...")
+    image_paths = []
     for image_name in images:
         image_path = f'index_files/images/{image_name}.jpg'
         if os.path.exists(image_path):
             print(f"Processing: {image_path}")
-            if index_file(image_path, 'image'):
-                total_indexed += 1
+            image_paths.append(image_path)
         else:
             print(f"⚠️  File not found: {image_path}")
     
+    # Images are sent together so the server can encode them in CLIP batches
+    if image_paths:
+        total_indexed += index_files_batch(image_paths)
+    
     # Index audio files  
     print("\n🎵 Indexing audio files...")
+    audio_paths = []
     for audio_name in audios:
         audio_path = f'index_files/audios/{audio_name}.mp3'
         if os.path.exists(audio_path):
             print(f"Processing: {audio_path}")
-            if index_file(audio_path, 'audio'):
-                total_indexed += 1
+            audio_paths.append(audio_path)
         else:
             print(f"⚠️  File not found: {audio_path}")
     
+    # Audio files are sent together so the server can group them into CLAP batches
+    if audio_paths:
+        total_indexed += index_files_batch(audio_paths)
+    
     # Check final status
     print("\n📊 Final Index Status:")
     try:
@@ -0,0 +1,387 @@
+import argparse
+import json
+import os
+import queue
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import numpy as np
+import database
+import embedding_store
+import audio_decode
+import image_decode
+from embeddings import get_image_embeddings, get_audio_segment_embeddings, IMAGE_BATCH_SIZE, AUDIO_BATCH_SIZE
+
+# Offline bulk indexing: walks a directory tree and streams the files through batched
+# CLIP / CLAP inference straight into the index, without going through the HTTP server.
+# Run it with the server stopped, from the directory the server runs in: it writes the
+# same index files, and refuses to start while any server process holds the index lock
+# (database.LOCK_FILE), which it takes exclusively. Every batch is made durable in the write-ahead log as it is added and
+# the index is checkpointed once at the end. Files whose content is already indexed are
+# skipped, so an interrupted run can simply be started again.
+#
+# With sync, the run instead mirrors the trees: SYNC_MANIFEST_FILE records the size,
+# mtime, content hash and item id of every indexed path. Files whose size and mtime are
+# unchanged are not even read, new files are added, modified ones re-embedded in place
+# (keeping their item id) and the items of files that are gone are deleted.
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.bmp')
+AUDIO_EXTENSIONS = ('.mp3', '.wav', '.m4a', '.ogg')
+
+# Files hashed ahead of the models, bounding memory however large the tree is
+MAX_IN_FLIGHT = 256
+HASH_WORKERS = 4
+HASH_CHUNK = 32
+PROGRESS_INTERVAL_SECONDS = 5.0
+
+STATIC_FOLDER = "static"
+SYNC_MANIFEST_FILE = "sync_manifest.json"
+
+def detect_file_type(path):
+    """"image", "audio" or None, by extension"""
+    file_ext = os.path.splitext(path)[1].lower()
+    if file_ext in IMAGE_EXTENSIONS:
+        return "image"
+    if file_ext in AUDIO_EXTENSIONS:
+        return "audio"
+    return None
+
+def walk_files(roots):
+    """Yields (absolute path, file type) for every indexable file under roots, in a stable order"""
+    for root in roots:
+        if os.path.isfile(root):
+            if detect_file_type(root):
+                yield os.path.abspath(root), detect_file_type(root)
+            continue
+        for directory, subdirectories, filenames in os.walk(root):
+            subdirectories.sort()
+            for filename in sorted(filenames):
+                file_type = detect_file_type(filename)
+                # Thumbnails written next to indexed images are not content of their own
+                if file_type and not filename.endswith(image_decode.THUMBNAIL_SUFFIX):
+                    yield os.path.abspath(os.path.join(directory, filename)), file_type
+
+def load_manifest(path=SYNC_MANIFEST_FILE):
+    """Indexed files by absolute path: {"size", "mtime_ns", "content_hash", "item_id"}"""
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f).get("files", {})
+
+def save_manifest(files, path=SYNC_MANIFEST_FILE):
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w') as f:
+        json.dump({"saved_at": datetime.now().isoformat(), "files": files}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+def _is_under(path, root):
+    return path == root or path.startswith(root.rstrip(os.sep) + os.sep)
+
+def _describe_file(path, file_type, known_files=None):
+    """Stats and hashes a file; files the manifest has at the same size and mtime are not read"""
+    try:
+        stat = os.stat(path)
+        entry = {"path": path, "file_type": file_type, "file_size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+        known = known_files.get(path) if known_files else None
+        if known and known.get("size") == stat.st_size and known.get("mtime_ns") == stat.st_mtime_ns:
+            entry["unchanged"] = True
+        else:
+            entry["content_hash"] = embedding_store.hash_file(path)
+        return entry
+    except OSError as e:
+        return {"path": path, "file_type": file_type, "error": str(e)}
+
+def _produce(files, work_queue, known_files=None, hash_workers=HASH_WORKERS):
+    """Hashes files on a thread pool and feeds them to work_queue, blocking while it is full. Ends with None."""
+    describe = lambda item: _describe_file(*item, known_files)
+    try:
+        with ThreadPoolExecutor(max_workers=hash_workers) as pool:
+            chunk = []
+            for path, file_type in files:
+                chunk.append((path, file_type))
+                if len(chunk) == HASH_CHUNK:
+                    for entry in pool.map(describe, chunk):
+                        work_queue.put(entry)
+                    chunk = []
+            for entry in pool.map(describe, chunk):
+                work_queue.put(entry)
+    finally:
+        work_queue.put(None)
+
+class BulkIndexer:
+    """
+    Collects hashed files per type and adds them to the index in model-sized batches.
+    With a manifest (see load_manifest) it syncs: files are matched by path rather than
+    content, and the manifest is kept up to date.
+    """
+
+    def __init__(self, copy_to_static=False, batch_id=None, manifest=None):
+        self.copy_to_static = copy_to_static
+        self.manifest = manifest
+        self.present = set()
+        self._sources = None
+        self.batch_id = batch_id or f"bulk-{datetime.now().strftime('%Y%m%d-%H%M%S')}"
+        self.pending = {"image": [], "audio": []}
+        self.batch_sizes = {"image": IMAGE_BATCH_SIZE, "audio": AUDIO_BATCH_SIZE}
+        self.seen_hashes = set()
+        self.stats = {"seen": 0, "indexed": 0, "updated": 0, "deleted": 0, "skipped": 0, "failed": 0}
+        self.started = time.time()
+        self._last_report = self.started
+
+    def submit(self, entry):
+        self.stats["seen"] += 1
+        self.present.add(entry["path"])
+        if "error" in entry:
+            print(f"❌ Cannot read {entry['path']}: {entry['error']}")
+            self.stats["failed"] += 1
+            return
+        if self.manifest is not None:
+            if not self._needs_sync(entry):
+                self.stats["skipped"] += 1
+                return
+        else:
+            content_hash = entry["content_hash"]
+            if content_hash in self.seen_hashes or database.find_by_content_hash(content_hash) is not None:
+                self.stats["skipped"] += 1
+                return
+            self.seen_hashes.add(content_hash)
+
+        pending = self.pending[entry["file_type"]]
+        pending.append(entry)
+        if len(pending) >= self.batch_sizes[entry["file_type"]]:
+            self.flush(entry["file_type"])
+
+    def _needs_sync(self, entry):
+        """
+        Whether a file has to be (re-)embedded. Modified files get the item_id to update.
+        """
+        known = self.manifest.get(entry["path"])
+        if known:
+            item = database.get_item(known["item_id"])
+        else:
+            # Indexed by a run that was interrupted before saving the manifest, or by a plain bulk run
+            item = database.get_item(self._indexed_sources().get(entry["path"], -1))
+        if entry.get("unchanged"):
+            if item is not None:
+                return False
+            # The item was deleted from the index since the last sync
+            entry["content_hash"] = embedding_store.hash_file(entry["path"])
+
+        if item is None:
+            return True
+        if item.get("content_hash") == entry["content_hash"]:
+            # Touched but not changed
+            self._remember(entry, item["item_id"])
+            return False
+        entry["item_id"] = item["item_id"]
+        return True
+
+    def _indexed_sources(self):
+        if self._sources is None:
+            self._sources = database.get_source_paths()
+        return self._sources
+
+    def _remember(self, entry, item_id):
+        if self.manifest is not None:
+            self.manifest[entry["path"]] = {"size": entry["file_size"], "mtime_ns": entry["mtime_ns"],
+                                            "content_hash": entry["content_hash"], "item_id": int(item_id)}
+
+    def _remove_copy(self, metadata):
+        """Removes an item's copy in STATIC_FOLDER and its thumbnail; never touches source files"""
+        file_path = metadata.get("file_path")
+        if not file_path or file_path == metadata.get("source_path"):
+            return
+        if os.path.dirname(os.path.abspath(file_path)) == os.path.abspath(STATIC_FOLDER) and os.path.exists(file_path):
+            os.remove(file_path)
+            image_decode.remove_thumbnail(file_path)
+
+    def remove_missing(self, roots):
+        """Deletes the items of manifest files under roots that were not found by this run"""
+        roots = [os.path.abspath(root) for root in roots]
+        for path in list(self.manifest):
+            if path in self.present or not any(_is_under(path, root) for root in roots):
+                continue
+            metadata = database.delete_item(self.manifest.pop(path)["item_id"])
+            if metadata is not None:
+                self._remove_copy(metadata)
+                self.stats["deleted"] += 1
+
+    def flush(self, file_type=None):
+        """Indexes the files waiting for one type (or all types)"""
+        for name in ([file_type] if file_type else list(self.pending)):
+            entries, self.pending[name] = self.pending[name], []
+            if entries:
+                self._index_batch(name, entries)
+        self.report()
+
+    def _embed(self, file_type, entries):
+        """Embeds a batch, reusing stored embeddings by content hash"""
+        store_key, embed_many = ("CLIP", get_image_embeddings) if file_type == "image" else ("CLAP_SEGMENTS", get_audio_segment_embeddings)
+        embeddings = [embedding_store.get(entry["content_hash"], store_key) for entry in entries]
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            for i, embedding in zip(missing, embed_many([entries[i]["path"] for i in missing])):
+                embeddings[i] = embedding
+                embedding_store.put(entries[i]["content_hash"], store_key, embedding)
+        return embeddings
+
+    def _stored_path(self, entry):
+        """Where the index will point for a file: the file itself, or a copy in STATIC_FOLDER"""
+        if not self.copy_to_static:
+            return entry["path"]
+        static_path = os.path.join(STATIC_FOLDER, str(uuid.uuid4()) + os.path.splitext(entry["path"])[1])
+        shutil.copyfile(entry["path"], static_path)
+        return static_path
+
+    def _index_batch(self, file_type, entries):
+        embeddings = self._embed(file_type, entries)
+        embedded = [i for i, embedding in enumerate(embeddings) if embedding is not None]
+        for i in range(len(entries)):
+            if embeddings[i] is None:
+                print(f"❌ Failed to embed {entries[i]['path']}")
+                self.seen_hashes.discard(entries[i]["content_hash"])
+        self.stats["failed"] += len(entries) - len(embedded)
+        if not embedded:
+            return
+
+        paths, matrices, metadata_list, added = [], [], [], []
+        for i in embedded:
+            entry = entries[i]
+            path = self._stored_path(entry)
+            matrix = np.atleast_2d(embeddings[i])
+            metadata = {
+                "original_filename": os.path.basename(entry["path"]),
+                "source_path": entry["path"],
+                "file_size": entry["file_size"],
+                "batch_id": self.batch_id,
+                "model_used": "CLIP" if file_type == "image" else "CLAP",
+                "content_hash": entry["content_hash"]
+            }
+            if file_type == "audio":
+                metadata.update(audio_decode.segment_metadata(entry["path"], len(matrix)))
+            elif self.copy_to_static and image_decode.SAVE_THUMBNAILS:
+                # Thumbnails only go next to copies; the source tree is left untouched
+                thumbnail_path = image_decode.save_thumbnail(path)
+                if thumbnail_path:
+                    metadata["thumbnail_path"] = thumbnail_path
+
+            if "item_id" in entry:
+                self._update(entry, path, matrix, metadata)
+                continue
+            paths.append(path)
+            matrices.append(matrix)
+            metadata_list.append(metadata)
+            added.append(entry)
+        if not added:
+            return
+
+        ids = database.add_embeddings(paths, np.concatenate(matrices), file_type, metadata_list, persist=False,
+                                      vector_counts=[len(matrix) for matrix in matrices], return_ids=True)
+        # One fsync per batch: everything added so far survives an interruption
+        database.flush_log()
+        if ids is not None:
+            self.stats["indexed"] += len(paths)
+            for entry, item_id in zip(added, ids):
+                self._remember(entry, item_id)
+        else:
+            self.stats["failed"] += len(paths)
+            for entry in added:
+                self.seen_hashes.discard(entry["content_hash"])
+
+    def _update(self, entry, path, matrix, metadata):
+        """Re-embeds the item of a modified file in place"""
+        current = database.get_item(entry["item_id"])
+        metadata.update({"file_path": path, "filename": os.path.basename(path), "thumbnail_path": metadata.get("thumbnail_path")})
+        if database.update_item(entry["item_id"], matrix, metadata) is None:
+            self.stats["failed"] += 1
+            return
+        if current is not None and current.get("file_path") != path:
+            self._remove_copy(current)
+        self._remember(entry, entry["item_id"])
+        self.stats["updated"] += 1
+
+    def files_per_second(self):
+        elapsed = time.time() - self.started
+        return self.stats["seen"] / elapsed if elapsed > 0 else 0.0
+
+    def report(self, force=False):
+        now = time.time()
+        if not force and now - self._last_report < PROGRESS_INTERVAL_SECONDS:
+            return
+        self._last_report = now
+        print(f"⏳ {self.stats['seen']} files: {self.stats['indexed']} indexed, {self.stats['updated']} updated, "
+              f"{self.stats['deleted']} deleted, {self.stats['skipped']} unchanged, {self.stats['failed']} failed "
+              f"({self.files_per_second():.1f} files/s)")
+
+def bulk_index(roots, copy_to_static=False, batch_id=None, max_in_flight=MAX_IN_FLIGHT,
+               sync=False, manifest_path=SYNC_MANIFEST_FILE):
+    """
+    Indexes every image and audio file under roots; with sync, mirrors the trees as
+    described above. Returns the run's counters, or None if a root to sync is missing
+    or another process owns the index.
+    """
+    try:
+        # Importing database took the lock shared, like a server process; upgrade it
+        database.acquire_index_lock(exclusive=True)
+    except database.IndexLockedError as e:
+        print(f"❌ {e}")
+        return None
+    if sync:
+        missing = [root for root in roots if not os.path.exists(root)]
+        if missing:
+            # An unmounted drive must not look like a tree whose files were all deleted
+            print(f"❌ Not syncing, missing: {', '.join(missing)}")
+            return None
+    if copy_to_static:
+        os.makedirs(STATIC_FOLDER, exist_ok=True)
+    manifest = load_manifest(manifest_path) if sync else None
+    indexer = BulkIndexer(copy_to_static, batch_id, manifest)
+    work_queue = queue.Queue(maxsize=max_in_flight)
+    producer = threading.Thread(target=_produce, args=(walk_files(roots), work_queue, dict(manifest or {})),
+                                name="bulk-index-hash", daemon=True)
+    producer.start()
+
+    print(f"🚀 {'Syncing' if sync else 'Bulk indexing'} {', '.join(roots)} (batch {indexer.batch_id})")
+    try:
+        while True:
+            entry = work_queue.get()
+            if entry is None:
+                break
+            indexer.submit(entry)
+            indexer.report()
+        indexer.flush()
+        if sync:
+            # Only once the whole tree has been walked
+            indexer.remove_missing(roots)
+    except KeyboardInterrupt:
+        print("\n⚠️  Interrupted, keeping what was indexed so far; run again to resume")
+    finally:
+        database.flush_log()
+        if indexer.stats["indexed"] or indexer.stats["updated"] or indexer.stats["deleted"]:
+            database.save_index()
+        if sync:
+            save_manifest(manifest, manifest_path)
+
+    elapsed = time.time() - indexer.started
+    stats = {**indexer.stats, "seconds": round(elapsed, 2), "files_per_second": round(indexer.files_per_second(), 2)}
+    indexer.report(force=True)
+    print(f"🎉 Done in {elapsed:.1f}s (Total: {database.get_index_size()} items)")
+    return stats
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Index a directory tree of images and audio without the HTTP server")
+    parser.add_argument("roots", nargs="+", help="directories (or files) to index")
+    parser.add_argument("--copy-to-static", action="store_true",
+                        help=f"copy files into {STATIC_FOLDER}/ like uploads, so the server can serve them")
+    parser.add_argument("--batch-id", help="batch_id recorded on every indexed item (default: bulk-<timestamp>)")
+    parser.add_argument("--max-in-flight", type=int, default=MAX_IN_FLIGHT, help="files hashed ahead of the models")
+    parser.add_argument("--sync", action="store_true",
+                        help="only embed new and modified files and delete the items of removed ones")
+    parser.add_argument("--manifest", default=SYNC_MANIFEST_FILE, help="sync manifest file")
+    args = parser.parse_args()
+
+    bulk_index(args.roots, args.copy_to_static, args.batch_id, args.max_in_flight, args.sync, args.manifest)
@@ -1,201 +1,1187 @@
 import numpy as np
 import faiss
 import os
+import index_factory
+import metadata_store
 import pickle
 import json
+import time
+import atexit
+import multiprocessing
+import threading
+from collections import OrderedDict
 from datetime import datetime
+from rwlock import RWLock
+from wal import WriteAheadLog, fsync_directory, read_log
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
 
 # Global variables
 faiss_index = None
-file_paths = []  # List of file paths corresponding to embeddings
-file_metadata = []  # Additional metadata for each file
+file_metadata = metadata_store.MmapMetadataList()  # Metadata for each embedding, by index position
+_content_hash_items = None  # content_hash -> ids of the live items with that content, built on first lookup
+metadata_columns = metadata_store.MetadataColumns()  # file_type / model_used / batch_id / added_at by item id
 EMBEDDING_DIM = 512
 INDEX_FILE = "faiss_index.bin"
-METADATA_FILE = "index_metadata.pkl"
+METADATA_FILE = "index_metadata.meta"
+LEGACY_METADATA_FILE = "index_metadata.pkl"  # Pickled format, read if no METADATA_FILE exists
+TOMBSTONE_FILE = "index_tombstones.npy"
+COLUMNS_FILE = "index_columns.npz"
+SEGMENTS_FILE = "index_segments.npy"
+
+# Stable ids: an item keeps the id it was added with (its position in file_metadata) and
+# the index stores that id with its vector (IndexIDMap2). Deleting or re-embedding an item
+# marks its old vector dead in _live_mask; searches skip dead vectors until compaction
+# rebuilds the index without them. Long audio is stored as one vector per time segment,
+# all under the item's id; _position_segments says which segment of the item's
+# metadata['segments'] a vector covers, -1 for whole-item vectors.
+_position_ids = np.zeros(0, dtype=np.int64)  # Storage position -> item id
+_position_segments = np.zeros(0, dtype=np.int32)  # Storage position -> segment number
+_segment_vectors = 0  # Stored vectors that cover a segment; searches only collapse hits when there are any
+_live_mask = np.zeros(0, dtype=bool)  # Storage position -> vector is current
+_dead_count = 0
+_live_selector = None  # IDSelector for _live_mask, rebuilt after it changes
+
+# Filtered searches: (mask, count, selector) over storage positions per normalized filter,
+# for the most recently used filters. Cleared whenever the index or the columns change.
+FILTER_SELECTOR_CACHE_SIZE = 32
+_filter_selectors = OrderedDict()
+
+# Searches over segmented items fetch this many vectors per wanted result, so that after
+# collapsing segments into items there are still enough items, and return each item's
+# best-matching SEGMENT_HITS_PER_ITEM time ranges
+SEGMENT_SEARCH_OVERFETCH = 4
+SEGMENT_HITS_PER_ITEM = 3
+
+# Compact once at least this many vectors, and this fraction of the index, are dead
+COMPACTION_MIN_TOMBSTONES = 100
+COMPACTION_TOMBSTONE_RATIO = 0.2
+_compaction_thread = None
+_compaction_lock = threading.Lock()
+
+# Map the index file instead of reading it into the heap. Worker processes then share
+# one page-cache copy and startup time no longer grows with the collection. A mapped
+# index is copied into memory the first time it has to be modified.
+MMAP_INDEX = True
+_index_is_mapped = False
+
+# Searches hold the read side, anything that changes faiss_index / file_metadata
+# holds the write side, so readers never see a half-applied add
+_index_lock = RWLock()
+_save_lock = threading.Lock()
+_rebuild_lock = threading.Lock()
+_content_hash_lock = threading.Lock()
+
+# Persistence: every change is appended to the write-ahead log and fsynced (in groups)
+# before it is acknowledged. The index files are only rewritten at checkpoints, which
+# run in the background once this many log records or seconds have accumulated. A
+# checkpoint writes a new versioned snapshot and then atomically points CHECKPOINT_FILE
+# at it, so a crash at any point leaves the previous snapshot plus the log intact.
+# The log and checkpoints assume a single writing process (see WRITER_LOCK_FILE).
+WAL_FILE = "index_wal.log"
+CHECKPOINT_FILE = "index_checkpoint.json"
+CHECKPOINT_EVERY_N_RECORDS = 1000
+CHECKPOINT_INTERVAL_SECONDS = 300.0
+_wal = None
+_checkpoint_lsn = 0  # Last log record covered by the snapshot on disk
+_last_checkpoint_time = time.time()
+_checkpoint_event = threading.Event()
+_checkpointer = None
+
+# The log and checkpoints have a single writer, since two processes appending to one log
+# and writing checkpoints corrupt the index. Two locks, which the OS drops when a process
+# exits, keep it that way:
+# - LOCK_FILE keeps the server and bulk_index.py apart. Server processes (e.g. several
+#   gunicorn workers) hold it shared; bulk_index.py holds it exclusively.
+# - WRITER_LOCK_FILE picks the writer among the processes sharing the index. The first to
+#   take it opens the log, applies changes and checkpoints. The others load the index
+#   read-only, follow the log every FOLLOW_INTERVAL_SECONDS to see the writer's changes,
+#   and reject changes of their own; one of them takes over when the writer exits.
+LOCK_FILE = "index.lock"
+WRITER_LOCK_FILE = "index.writer.lock"
+FOLLOW_INTERVAL_SECONDS = 1.0
+_lock_file = None
+_lock_exclusive = False
+_writer_lock_file = None
+_loaded_checkpoint = None  # Manifest of the snapshot the in-memory index was loaded from
+_applied_lsn = 0  # Last log record applied in memory, for following the writer's log
+_follower = None
+
+class IndexLockedError(Exception):
+    """Raised when another process holds LOCK_FILE the other way"""
+
+class ReadOnlyIndexError(Exception):
+    """Raised on changes in a process that follows the index instead of writing it"""
+
+def _lock_owner(path):
+    """The pid a lock holder wrote into path, for messages"""
+    try:
+        with open(path) as f:
+            return f.read().strip() or "unknown"
+    except OSError:
+        return "unknown"
+
+def acquire_index_lock(exclusive=False):
+    """
+    Takes LOCK_FILE for this process: shared for the server, exclusive for bulk_index.py
+    (no-op if it already holds it that way). Raises IndexLockedError if another process
+    holds it the other way.
+    """
+    global _lock_file, _lock_exclusive
+    if fcntl is None or (_lock_file is not None and (_lock_exclusive or not exclusive)):
+        return
+    f = _lock_file or open(LOCK_FILE, 'a+')
+    try:
+        fcntl.flock(f.fileno(), (fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH) | fcntl.LOCK_NB)
+    except OSError:
+        if f is _lock_file:
+            # A failed upgrade can drop the shared lock (flock converts non-atomically); take it back
+            fcntl.flock(f.fileno(), fcntl.LOCK_SH | fcntl.LOCK_NB)
+        else:
+            f.close()
+        if exclusive:
+            raise IndexLockedError(f"The index in {os.getcwd()} is in use by the server (writer: process "
+                                   f"{_lock_owner(WRITER_LOCK_FILE)}); stop it first")
+        raise IndexLockedError(f"The index in {os.getcwd()} is in use by bulk_index.py (process "
+                               f"{_lock_owner(LOCK_FILE)}); wait for it to finish or stop it first")
+    if exclusive:
+        f.seek(0)
+        f.truncate()
+        f.write(str(os.getpid()))
+        f.flush()
+    _lock_file, _lock_exclusive = f, exclusive
+    if exclusive and _follower is not None:
+        # No server is left to write the log, so take it over now rather than at the next poll
+        with _index_lock.write_lock():
+            _catch_up()
+
+def _acquire_writer_lock():
+    """Tries to become the index's writer (see WRITER_LOCK_FILE). Returns whether this process is it."""
+    global _writer_lock_file
+    if _writer_lock_file is not None or fcntl is None:
+        return True
+    f = open(WRITER_LOCK_FILE, 'a+')
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return False
+    f.seek(0)
+    f.truncate()
+    f.write(str(os.getpid()))
+    f.flush()
+    _writer_lock_file = f
+    return True
 
 def initialize_faiss_index():
-    """Initializes the FAISS index if it doesn't exist."""
+    """Initializes the FAISS index if it doesn't exist. Caller must hold the write lock."""
     global faiss_index
     if faiss_index is None:
-        # Use Inner Product for normalized embeddings (equivalent to cosine similarity)
-        faiss_index = faiss.IndexFlatIP(EMBEDDING_DIM)
+        # Start exact; add_embeddings migrates to index_factory.INDEX_TYPE once the
+        # collection crosses index_factory.MIGRATION_THRESHOLD
+        faiss_index = index_factory.create_id_index(EMBEDDING_DIM, "flat")
         print(f"🔧 Initialized FAISS index with dimension {EMBEDDING_DIM}")
 
+def _ensure_writable_index():
+    """Copies a memory-mapped index into the heap before its first modification. Caller must hold the write lock."""
+    global faiss_index, _index_is_mapped
+    initialize_faiss_index()
+    if not index_factory.has_ids(faiss_index):
+        # Indexes saved before stable ids: item ids are the storage positions
+        faiss_index = index_factory.rebuild(faiss_index)
+        _index_is_mapped = False
+        print(f"🔁 Converted index to stable ids ({faiss_index.ntotal} items)")
+    if _index_is_mapped:
+        faiss_index = faiss.deserialize_index(faiss.serialize_index(faiss_index))
+        _index_is_mapped = False
+        print(f"📝 Copied memory-mapped index into memory for writing ({faiss_index.ntotal} items)")
+
+def _reset_positions(index):
+    """Rebuilds the position bookkeeping for a freshly loaded index. Caller must hold the write lock."""
+    global _position_ids, _position_segments, _segment_vectors, _live_mask, _dead_count, _live_selector
+    if index is None:
+        _position_ids = np.zeros(0, dtype=np.int64)
+    else:
+        _position_ids = index_factory.get_ids(index)
+    _position_segments = np.full(len(_position_ids), -1, dtype=np.int32)
+    _segment_vectors = 0
+    _live_mask = np.ones(len(_position_ids), dtype=bool)
+    _dead_count = 0
+    _live_selector = None
+    _filter_selectors.clear()
+
+def _get_live_selector():
+    """Selector that skips dead vectors, or None when there are none. Caller must hold a lock."""
+    global _live_selector
+    if _dead_count == 0:
+        return None
+    selector = _live_selector
+    if selector is None:
+        selector = index_factory.live_selector(_live_mask)
+        _live_selector = selector
+    return selector
+
+def _get_filter_selector(filters):
+    """Storage-position mask, match count and IDSelector for live vectors passing filters. Caller must hold a lock."""
+    cached = _filter_selectors.get(filters)
+    if cached is None:
+        item_mask = metadata_columns.mask(filters)
+        mask = _live_mask & item_mask[_position_ids]
+        cached = (mask, int(mask.sum()), index_factory.live_selector(mask))
+        _filter_selectors[filters] = cached
+        while len(_filter_selectors) > FILTER_SELECTOR_CACHE_SIZE:
+            _filter_selectors.popitem(last=False)
+    return cached
+
+def get_index_size():
+    """Returns the number of live items in the current index"""
+    return metadata_columns.num_live if faiss_index is not None else 0
+
+def _live_vector_count():
+    """Live vectors in the index: one per item, or one per segment for segmented audio"""
+    return faiss_index.ntotal - _dead_count if faiss_index is not None else 0
+
+def get_index_info():
+    """Describes the current index type and the migration policy"""
+    return {
+        "index_type": index_factory.get_index_type(faiss_index),
+        "total_items": get_index_size(),
+        "ann_index_type": index_factory.INDEX_TYPE,
+        "migration_threshold": index_factory.MIGRATION_THRESHOLD,
+        "memory_mapped": _index_is_mapped,
+        "stored_vectors": faiss_index.ntotal if faiss_index is not None else 0,
+        "live_vectors": _live_vector_count(),
+        "segment_vectors": _segment_vectors,
+        "tombstones": _dead_count,
+        "compaction_running": _compaction_thread is not None and _compaction_thread.is_alive(),
+        "persistence": get_persistence_stats()
+    }
+
+SNAPSHOT_FILE_KEYS = ("index_file", "metadata_file", "tombstone_file", "columns_file", "segments_file")
+
+def _snapshot_paths(generation):
+    """Versioned file names for a snapshot, so a new one never overwrites the files the manifest points at"""
+    paths = {}
+    for key, path in zip(SNAPSHOT_FILE_KEYS, (INDEX_FILE, METADATA_FILE, TOMBSTONE_FILE, COLUMNS_FILE, SEGMENTS_FILE)):
+        root, ext = os.path.splitext(path)
+        paths[key] = f"{root}.{generation:06d}{ext}"
+    return paths
+
+def _read_checkpoint():
+    """Returns the checkpoint manifest, or None if no checkpoint has been written"""
+    if not os.path.exists(CHECKPOINT_FILE):
+        return None
+    with open(CHECKPOINT_FILE, 'r') as f:
+        return json.load(f)
+
+def _save_array(array, path):
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'wb') as f:
+        np.save(f, array)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+def _take_snapshot():
+    """
+    In-memory copy of everything a checkpoint writes, so the files can be written and
+    fsynced without holding the index lock. Caller must hold a lock.
+    """
+    return {
+        "index": faiss.serialize_index(faiss_index),
+        "tombstones": np.flatnonzero(~_live_mask).astype(np.int64),
+        "segments": _position_segments.copy(),
+        "metadata": file_metadata.snapshot(),
+        "columns": metadata_columns.snapshot()
+    }
+
+def _write_snapshot(snapshot, paths):
+    """Writes a snapshot taken with _take_snapshot to new files"""
+    index_factory.write_serialized_index(snapshot["index"], paths["index_file"])
+    _save_array(snapshot["tombstones"], paths["tombstone_file"])
+    _save_array(snapshot["segments"], paths["segments_file"])
+    metadata_store.write_metadata(paths["metadata_file"], snapshot["metadata"])
+    metadata_store.write_columns(paths["columns_file"], snapshot["columns"])
+
 def save_index():
-    """Save the FAISS index and metadata to disk"""
-    try:
-        if faiss_index is not None and faiss_index.ntotal > 0:
-            faiss.write_index(faiss_index, INDEX_FILE)
+    """
+    Checkpoint: writes a snapshot of the index and metadata, points CHECKPOINT_FILE at it
+    and drops the log records it covers
+    """
+    global _checkpoint_lsn, _last_checkpoint_time, file_metadata
+    # Only copying the index and metadata happens under the lock; the files are written and
+    # fsynced after it is released, so neither searches nor changes wait for the disk
+    with _save_lock:
+        try:
+            with _index_lock.read_lock():
+                if faiss_index is None:
+                    print("⚠️  No index to save")
+                    return False
+                if _wal is None:
+                    print("⚠️  Only the index writer saves checkpoints")
+                    return False
+                lsn = _wal.last_lsn
+                snapshot = _take_snapshot()
+                total, tombstones = get_index_size(), _dead_count
             
-            metadata = {
-                'file_paths': file_paths,
-                'file_metadata': file_metadata,
-                'embedding_dim': EMBEDDING_DIM,
-                'total_items': faiss_index.ntotal,
-                'last_updated': datetime.now().isoformat()
-            }
+            previous = _read_checkpoint()
+            generation = (previous or {}).get("generation", 0) + 1
+            paths = _snapshot_paths(generation)
+            _write_snapshot(snapshot, paths)
             
-            with open(METADATA_FILE, 'wb') as f:
-                pickle.dump(metadata, f)
+            temp_checkpoint_file = f"{CHECKPOINT_FILE}.tmp"
+            with open(temp_checkpoint_file, 'w') as f:
+                json.dump({"generation": generation, "lsn": lsn, "saved_at": datetime.now().isoformat(),
+                           "total_items": total, **paths}, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_checkpoint_file, CHECKPOINT_FILE)
+            fsync_directory(os.path.dirname(os.path.abspath(CHECKPOINT_FILE)))
             
-            print(f"💾 Saved index with {faiss_index.ntotal} items")
-        else:
-            print("⚠️  No index to save or index is empty")
-    except Exception as e:
-        print(f"❌ Error saving index: {e}")
+            # The new snapshot covers everything up to lsn
+            _wal.truncate_through(lsn)
+            _checkpoint_lsn = lsn
+            _last_checkpoint_time = time.time()
+            if previous:
+                for key in SNAPSHOT_FILE_KEYS:
+                    if previous.get(key) and os.path.exists(previous[key]):
+                        os.remove(previous[key])
+            
+            # Remap the metadata so records changed since the last load stop living in memory
+            with _index_lock.write_lock():
+                if _wal.last_lsn == lsn:
+                    file_metadata = metadata_store.load_metadata(paths["metadata_file"])
+            
+            print(f"💾 Saved index with {total} items ({tombstones} tombstones) at log position {lsn}")
+            return True
+        except Exception as e:
+            print(f"❌ Error saving index: {e}")
+            return False
+
+def _log(record, vectors=None):
+    """Appends a change to the write-ahead log. Caller must hold the write lock so log order matches apply order."""
+    if _wal is None:
+        raise ReadOnlyIndexError(f"This process only reads the index; process {_lock_owner(WRITER_LOCK_FILE)} writes it")
+    return _wal.append(record, vectors)
+
+def _commit(lsn, durable=True):
+    """Waits for a logged change to reach disk and schedules a checkpoint when the log is long"""
+    if durable:
+        _wal.wait_durable(lsn)
+    if _wal.last_lsn - _checkpoint_lsn >= CHECKPOINT_EVERY_N_RECORDS:
+        _checkpoint_event.set()
+
+def flush_log():
+    """fsyncs every logged change, for callers that added with persist=False"""
+    if _wal is not None:
+        _wal.sync()
+
+def _checkpoint_loop():
+    while True:
+        _checkpoint_event.wait(CHECKPOINT_INTERVAL_SECONDS)
+        _checkpoint_event.clear()
+        try:
+            pending = _wal.last_lsn - _checkpoint_lsn
+            if pending > 0 and (pending >= CHECKPOINT_EVERY_N_RECORDS or
+                                time.time() - _last_checkpoint_time >= CHECKPOINT_INTERVAL_SECONDS):
+                save_index()
+        except Exception as e:
+            print(f"❌ Error during background checkpoint: {e}")
+
+def _start_checkpointer():
+    global _checkpointer
+    if _checkpointer is None or not _checkpointer.is_alive():
+        _checkpointer = threading.Thread(target=_checkpoint_loop, name="index-checkpoint", daemon=True)
+        _checkpointer.start()
+
+def _catch_up():
+    """
+    Applies the writer's changes since the last call, reloading when it has checkpointed
+    past them, and takes over the log if the writer has exited. Caller must hold the write lock.
+    """
+    global _wal
+    writer = _acquire_writer_lock()
+    if _read_checkpoint() != _loaded_checkpoint or _replay_wal() is None:
+        _load_index_locked()
+    elif writer:
+        _wal = WriteAheadLog(WAL_FILE, start_lsn=_applied_lsn)
+
+def _follow_loop():
+    while _wal is None:
+        time.sleep(FOLLOW_INTERVAL_SECONDS)
+        try:
+            with _index_lock.write_lock():
+                _catch_up()
+        except Exception as e:
+            print(f"❌ Error following the index log: {e}")
+    print(f"✍️  Process {os.getpid()} is now the index writer")
+    _start_checkpointer()
+
+def _start_follower():
+    global _follower
+    if _follower is None or not _follower.is_alive():
+        _follower = threading.Thread(target=_follow_loop, name="index-follower", daemon=True)
+        _follower.start()
+
+def get_persistence_stats():
+    """Describes the write-ahead log and the last checkpoint"""
+    stats = _wal.get_stats() if _wal is not None else {}
+    stats["writer"] = _wal is not None
+    stats["checkpoint_lsn"] = _checkpoint_lsn
+    stats["records_since_checkpoint"] = (_wal.last_lsn - _checkpoint_lsn) if _wal is not None else 0
+    stats["last_checkpoint"] = datetime.fromtimestamp(_last_checkpoint_time).isoformat()
+    return stats
+
+def _get_content_hash_items():
+    """
+    Returns the content-hash lookup, building it from file_metadata on first use so
+    loading the index doesn't have to decode every record. Caller must hold a lock.
+    """
+    global _content_hash_items
+    with _content_hash_lock:
+        if _content_hash_items is None:
+            items = {}
+            for position, metadata in enumerate(file_metadata):
+                content_hash = metadata.get('content_hash')
+                if content_hash and not metadata.get('deleted'):
+                    items.setdefault(content_hash, set()).add(position)
+            _content_hash_items = items
+        return _content_hash_items
+
+def _content_hash_position(content_hash):
+    """The oldest live item with this content hash, or None. Caller must hold a lock."""
+    item_ids = _get_content_hash_items().get(content_hash)
+    return min(item_ids) if item_ids else None
+
+def _index_content_hash(content_hash, item_id):
+    """Caller must hold the write lock"""
+    if content_hash and _content_hash_items is not None:
+        _content_hash_items.setdefault(content_hash, set()).add(item_id)
+
+def _unindex_content_hash(content_hash, item_id):
+    """Caller must hold the write lock. Other items with the same content stay findable."""
+    if not content_hash or _content_hash_items is None:
+        return
+    item_ids = _content_hash_items.get(content_hash)
+    if item_ids is not None:
+        item_ids.discard(item_id)
+        if not item_ids:
+            del _content_hash_items[content_hash]
+
+def find_by_content_hash(content_hash):
+    """Returns the metadata of the indexed item with this content hash, or None"""
+    with _index_lock.read_lock():
+        return _find_by_content_hash(content_hash)
+
+def _find_by_content_hash(content_hash):
+    position = _content_hash_position(content_hash)
+    if position is None or position >= len(file_metadata):
+        return None
+    return file_metadata[position]
+
+def merge_duplicate(content_hash, extra_metadata: dict = None):
+    """
+    Records a re-upload of already indexed content on the existing item instead of
+    adding a second vector. Returns the merged metadata, or None if the hash is unknown.
+    """
+    duplicate = {'added_at': datetime.now().isoformat()}
+    if extra_metadata:
+        duplicate.update(extra_metadata)
+    
+    with _index_lock.write_lock():
+        position = _content_hash_position(content_hash)
+        if position is None or position >= len(file_metadata):
+            return None
+        metadata = dict(file_metadata[position])
+        metadata['duplicates'] = metadata.get('duplicates', []) + [duplicate]
+        lsn = _log({"op": "set_metadata", "item_id": position, "metadata": metadata})
+        _apply_metadata(position, metadata)
+    
+    _commit(lsn)
+    return metadata
+
+def _apply_metadata(item_id, metadata):
+    """Replaces the metadata of an item without touching its vector. Caller must hold the write lock."""
+    file_metadata[item_id] = metadata
+    metadata_columns.set(item_id, metadata)
+    _filter_selectors.clear()
+
+def get_metadata_stats():
+    """Live item counts per file type and model, from incrementally maintained counters"""
+    with _index_lock.read_lock():
+        return {
+            "total_items": metadata_columns.num_live,
+            "file_types": metadata_columns.counts("file_type"),
+            "models_used": metadata_columns.counts("model_used")
+        }
+
+def get_recent_items(n=20):
+    """Metadata of the n most recently added live items, newest first"""
+    with _index_lock.read_lock():
+        return [_get_item(item_id) for item_id in metadata_columns.recent(n)]
+
+def get_source_paths():
+    """Item ids of live items by the path they were bulk indexed from (metadata 'source_path')"""
+    with _index_lock.read_lock():
+        return {metadata['source_path']: item_id for item_id, metadata in enumerate(file_metadata)
+                if metadata.get('source_path') and not metadata.get('deleted')}
+
+def get_item(item_id):
+    """Returns the metadata of a live item, or None"""
+    with _index_lock.read_lock():
+        return _get_item(item_id)
+
+def _get_item(item_id):
+    if item_id < 0 or item_id >= len(file_metadata):
+        return None
+    metadata = file_metadata[item_id]
+    if metadata.get('deleted'):
+        return None
+    return {'item_id': item_id, **metadata}
+
+def _mark_dead(item_id):
+    """Marks the current vectors of an item dead. Caller must hold the write lock."""
+    global _dead_count, _live_selector
+    positions = np.flatnonzero((_position_ids == item_id) & _live_mask)
+    _live_mask[positions] = False
+    _dead_count += len(positions)
+    _live_selector = None
+    _filter_selectors.clear()
+
+def delete_item(item_id):
+    """
+    Deletes an item: its vector is tombstoned right away and removed from the index by
+    the next compaction. Returns the deleted item's metadata, or None if there is no such item.
+    """
+    with _index_lock.write_lock():
+        metadata = _get_item(item_id)
+        if metadata is None:
+            return None
+        
+        tombstone = {'item_id': item_id, 'deleted': True, 'deleted_at': datetime.now().isoformat()}
+        lsn = _log({"op": "delete", "item_id": item_id, "metadata": tombstone})
+        _apply_delete(item_id, tombstone)
+    
+    print(f"🗑️  Deleted item {item_id} ({metadata.get('filename', 'unknown')})")
+    _commit(lsn)
+    _maybe_compact()
+    return metadata
+
+def _apply_delete(item_id, tombstone):
+    """Caller must hold the write lock"""
+    current = file_metadata[item_id]
+    _mark_dead(item_id)
+    file_metadata[item_id] = tombstone
+    metadata_columns.set(item_id, tombstone)
+    
+    _unindex_content_hash(current.get('content_hash'), item_id)
+
+def update_item(item_id, embedding, extra_metadata: dict = None):
+    """
+    Replaces an item's vector in place: the new vector is stored under the same id and the
+    old one is tombstoned. embedding may also be one row per segment, with the time ranges
+    in extra_metadata['segments']. extra_metadata is merged into the item's metadata.
+    Returns the updated metadata, or None if there is no such item.
+    """
+    vectors = np.atleast_2d(np.asarray(embedding, dtype=np.float32))
+    if vectors.shape[1] != EMBEDDING_DIM:
+        print(f"❌ Embedding dimension mismatch. Expected {EMBEDDING_DIM}, got {vectors.shape[1]}")
+        return None
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    
+    vectors = np.ascontiguousarray(vectors / norms, dtype=np.float32)
+    
+    with _index_lock.write_lock():
+        current = _get_item(item_id)
+        if current is None:
+            return None
+        
+        metadata = dict(file_metadata[item_id])
+        if len(vectors) == 1:
+            # Segment time ranges of the vectors being replaced
+            metadata.pop('segments', None)
+        if extra_metadata:
+            metadata.update(extra_metadata)
+        metadata['item_id'] = item_id
+        metadata['updated_at'] = datetime.now().isoformat()
+        
+        lsn = _log({"op": "update", "item_id": item_id, "metadata": metadata}, vectors)
+        _apply_update(item_id, vectors, metadata)
+    
+    print(f"✅ Re-embedded item {item_id} ({metadata.get('filename', 'unknown')})")
+    _commit(lsn)
+    _maybe_compact()
+    return {'item_id': item_id, **metadata}
+
+def _apply_update(item_id, vectors, metadata):
+    """Caller must hold the write lock"""
+    global _position_ids, _position_segments, _segment_vectors, _live_mask, _live_selector
+    current = file_metadata[item_id]
+    segments = _segment_numbers([len(vectors)])
+    
+    _ensure_writable_index()
+    _mark_dead(item_id)
+    faiss_index.add_with_ids(vectors, np.full(len(vectors), item_id, dtype=np.int64))
+    _position_ids = np.concatenate([_position_ids, np.full(len(vectors), item_id, dtype=np.int64)])
+    _position_segments = np.concatenate([_position_segments, segments])
+    _segment_vectors += int(np.count_nonzero(segments >= 0))
+    _live_mask = np.concatenate([_live_mask, np.ones(len(vectors), dtype=bool)])
+    _live_selector = None
+    _filter_selectors.clear()
+    file_metadata[item_id] = metadata
+    metadata_columns.set(item_id, metadata)
+    
+    old_hash, new_hash = current.get('content_hash'), metadata.get('content_hash')
+    if old_hash != new_hash:
+        _unindex_content_hash(old_hash, item_id)
+        _index_content_hash(new_hash, item_id)
 
 def load_index():
-    """Load the FAISS index and metadata from disk"""
-    global faiss_index, file_paths, file_metadata
+    """
+    Load the FAISS index and metadata from disk, as their writer if no other process is.
+    Raises IndexLockedError if bulk_index.py owns them.
+    """
+    acquire_index_lock()
+    with _index_lock.write_lock():
+        return _load_index_locked()
+
+def _load_legacy_metadata():
+    """Reads the old pickled metadata format into an in-memory metadata list"""
+    with open(LEGACY_METADATA_FILE, 'rb') as f:
+        metadata = pickle.load(f)
+    
+    records = metadata_store.MmapMetadataList()
+    for record in metadata.get('file_metadata', []):
+        records.append(record)
     
+    print(f"📅 Last updated: {metadata.get('last_updated', 'Unknown')} (legacy format, converted on next save)")
+    return records
+
+def _load_tombstones(path):
+    """Marks the dead vectors listed in a tombstone file. Caller must hold the write lock."""
+    global _dead_count
+    if not os.path.exists(path):
+        return
+    dead = np.load(path)
+    dead = dead[dead < len(_live_mask)]
+    _live_mask[dead] = False
+    _dead_count = int(len(_live_mask) - _live_mask.sum())
+
+def _load_segments(path):
+    """Restores which stored vectors cover audio segments. Caller must hold the write lock."""
+    global _position_segments, _segment_vectors
+    if not path or not os.path.exists(path):
+        return
+    segments = np.load(path).astype(np.int32)
+    if len(segments) != len(_position_ids):
+        print(f"⚠️  {path} does not match the index, ignoring it")
+        return
+    _position_segments = segments
+    _segment_vectors = int(np.count_nonzero(segments >= 0))
+
+def _load_columns(path):
+    """Loads the metadata columns saved with a snapshot, or builds them from the records. Caller must hold the write lock."""
+    global metadata_columns
+    if path and os.path.exists(path):
+        try:
+            metadata_columns = metadata_store.MetadataColumns.load(path)
+            if len(metadata_columns) == len(file_metadata):
+                return
+            print(f"⚠️  {path} does not match the metadata, rebuilding it")
+        except ValueError as e:
+            print(f"⚠️  {e}, rebuilding the metadata columns")
+    metadata_columns = metadata_store.MetadataColumns.from_records(file_metadata)
+
+def _load_index_locked():
+    global faiss_index, file_metadata, metadata_columns, _content_hash_items, _index_is_mapped, _wal, _checkpoint_lsn
+    global _loaded_checkpoint, _applied_lsn
+    
+    loaded = False
+    # Before reading anything, so a writer that exits meanwhile can't append records we miss
+    writer = _acquire_writer_lock()
     try:
-        if os.path.exists(INDEX_FILE) and os.path.exists(METADATA_FILE):
-            # Load FAISS index
-            faiss_index = faiss.read_index(INDEX_FILE)
-            
-            # Load metadata
-            with open(METADATA_FILE, 'rb') as f:
-                metadata = pickle.load(f)
+        checkpoint = _read_checkpoint()
+        faiss_index = None
+        file_metadata = metadata_store.MmapMetadataList()
+        metadata_columns = metadata_store.MetadataColumns()
+        _content_hash_items = None
+        _index_is_mapped = False
+        _checkpoint_lsn = 0
+        _loaded_checkpoint = checkpoint
+        
+        if checkpoint is not None:
+            # Map the FAISS index and metadata rather than copying them into the heap
+            faiss_index, _index_is_mapped = index_factory.read_index(checkpoint["index_file"], mmap=MMAP_INDEX)
+            file_metadata = metadata_store.load_metadata(checkpoint["metadata_file"])
+            _reset_positions(faiss_index)
+            _load_tombstones(checkpoint["tombstone_file"])
+            _load_segments(checkpoint.get("segments_file"))
+            _load_columns(checkpoint.get("columns_file"))
+            _checkpoint_lsn = checkpoint["lsn"]
             
-            file_paths = metadata.get('file_paths', [])
-            file_metadata = metadata.get('file_metadata', [])
+            print(f"📂 Loaded index with {get_index_size()} items (memory-mapped: {_index_is_mapped}, tombstones: {_dead_count})")
+            print(f"📅 Last updated: {checkpoint.get('saved_at', 'Unknown')}")
+            loaded = True
+        elif os.path.exists(INDEX_FILE) and os.path.exists(METADATA_FILE):
+            # Saved before checkpoints existed
+            faiss_index, _index_is_mapped = index_factory.read_index(INDEX_FILE, mmap=MMAP_INDEX)
+            file_metadata = metadata_store.load_metadata(METADATA_FILE)
+            _reset_positions(faiss_index)
+            _load_tombstones(TOMBSTONE_FILE)
+            _load_columns(None)
             
-            print(f"📂 Loaded index with {faiss_index.ntotal} items")
-            print(f"📅 Last updated: {metadata.get('last_updated', 'Unknown')}")
+            print(f"📂 Loaded index with {get_index_size()} items (memory-mapped: {_index_is_mapped}, tombstones: {_dead_count})")
+            loaded = True
+        elif os.path.exists(INDEX_FILE) and os.path.exists(LEGACY_METADATA_FILE):
+            faiss_index, _index_is_mapped = index_factory.read_index(INDEX_FILE, mmap=MMAP_INDEX)
+            file_metadata = _load_legacy_metadata()
+            _reset_positions(faiss_index)
+            _load_columns(None)
             
-            return True
+            print(f"📂 Loaded index with {faiss_index.ntotal} items (memory-mapped: {_index_is_mapped})")
+            loaded = True
         else:
+            _reset_positions(None)
             print("📁 No existing index found, will create new one")
-            return False
     except Exception as e:
         print(f"❌ Error loading index: {e}")
         return False
+    
+    _applied_lsn = _checkpoint_lsn
+    if writer and _wal is None:
+        _wal = WriteAheadLog(WAL_FILE, start_lsn=_checkpoint_lsn)
+    # A gap means a checkpoint landed while we loaded; _follow_loop reloads it
+    replayed = _replay_wal() or 0
+    return loaded or replayed > 0
 
-def add_embedding(file_path: str, embedding, file_type: str = "unknown", extra_metadata: dict = None):
+def _replay_wal():
     """
-    Enhanced version with richer metadata support
+    Re-applies logged changes newer than _applied_lsn. Returns how many, or None if the log
+    no longer continues from there (a follower fell behind a checkpoint). Caller must hold
+    the write lock.
     """
-    initialize_faiss_index()
+    global _applied_lsn
+    replayed = 0
+    records = _wal.replay(after_lsn=_applied_lsn) if _wal is not None else read_log(WAL_FILE, after_lsn=_applied_lsn)
+    for lsn, record, vectors in records:
+        if lsn != _applied_lsn + 1 and _wal is None:
+            return None
+        _applied_lsn = lsn
+        try:
+            op = record["op"]
+            if op == "add":
+                _apply_add(np.asarray(record["ids"], dtype=np.int64), vectors, record["metadata"], record.get("vector_counts"))
+            elif op == "delete":
+                _apply_delete(record["item_id"], record["metadata"])
+            elif op == "update":
+                _apply_update(record["item_id"], vectors, record["metadata"])
+            elif op == "set_metadata":
+                _apply_metadata(record["item_id"], record["metadata"])
+            replayed += 1
+        except Exception as e:
+            print(f"❌ Could not replay log record {lsn}: {e}")
+    
+    if replayed:
+        print(f"🔁 Replayed {replayed} logged changes (Total: {get_index_size()})")
+        _checkpoint_event.set()
+    return replayed
+
+def add_embeddings(paths, matrix, types, metadata_list=None, persist=True, vector_counts=None, return_ids=False):
+    """
+    Adds many embeddings in one FAISS call.
+    matrix is an (n, EMBEDDING_DIM) array, types is one file type per row (or a single
+    string for all rows) and metadata_list holds optional extra metadata per row.
+    With vector_counts, file i has vector_counts[i] consecutive rows, one per segment,
+    and its metadata_list entry carries their time ranges as 'segments'.
+    The batch is written to the log as one record. With persist=True this waits for it
+    to be fsynced; otherwise the caller makes it durable later with flush_log().
+    Returns True on success, or with return_ids the new item ids (None on failure).
+    """
+    failed = None if return_ids else False
     
     try:
-        # Convert embedding to numpy array if it isn't already
-        if isinstance(embedding, list):
-            embedding = np.array(embedding, dtype=np.float32)
-        elif isinstance(embedding, np.ndarray):
-            embedding = embedding.astype(np.float32)
-        else:
-            print(f"❌ Invalid embedding type: {type(embedding)}")
-            return False
+        matrix = np.asarray(matrix, dtype=np.float32)
+        if matrix.ndim == 1:
+            matrix = matrix.reshape(1, -1)
         
-        # Ensure correct shape
-        embedding = embedding.reshape(1, -1)
+        if vector_counts is not None and all(count == 1 for count in vector_counts):
+            vector_counts = None
+        expected_rows = len(paths) if vector_counts is None else sum(vector_counts)
+        if vector_counts is not None and len(vector_counts) != len(paths):
+            print(f"❌ Got {len(vector_counts)} vector counts for {len(paths)} files")
+            return failed
+        if matrix.shape[0] != expected_rows:
+            print(f"❌ Got {matrix.shape[0]} embeddings for {len(paths)} files")
+            return failed
+        if matrix.shape[0] == 0:
+            return [] if return_ids else True
         
         # Verify dimension
-        if embedding.shape[1] != EMBEDDING_DIM:
-            print(f"❌ Embedding dimension mismatch. Expected {EMBEDDING_DIM}, got {embedding.shape[1]}")
-            return False
+        if matrix.shape[1] != EMBEDDING_DIM:
+            print(f"❌ Embedding dimension mismatch. Expected {EMBEDDING_DIM}, got {matrix.shape[1]}")
+            return failed
         
-        # Normalize embedding for cosine similarity
-        norm = np.linalg.norm(embedding)
-        if norm > 0:
-            embedding = embedding / norm
-        
-        # Add to FAISS index
-        faiss_index.add(embedding)
-        
-        # Enhanced metadata
-        metadata = {
-            'file_path': file_path,
-            'file_type': file_type,
-            'filename': os.path.basename(file_path),
-            'added_at': datetime.now().isoformat(),
-            'file_size': os.path.getsize(file_path) if os.path.exists(file_path) else 0
-        }
+        if isinstance(types, str):
+            types = [types] * len(paths)
+        if metadata_list is None:
+            metadata_list = [None] * len(paths)
         
-        # Add extra metadata if provided
-        if extra_metadata:
-            metadata.update(extra_metadata)
+        # Normalize every row for cosine similarity in one pass
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        matrix = np.ascontiguousarray(matrix / norms)
         
-        # Store metadata
-        file_paths.append(file_path)
-        file_metadata.append(metadata)
+        # Build all metadata before taking the write lock
+        added_at = datetime.now().isoformat()
+        new_metadata = []
+        for file_path, file_type, extra_metadata in zip(paths, types, metadata_list):
+            # Enhanced metadata
+            metadata = {
+                'file_path': file_path,
+                'file_type': file_type,
+                'filename': os.path.basename(file_path),
+                'added_at': added_at,
+                'file_size': os.path.getsize(file_path) if os.path.exists(file_path) else 0
+            }
+            
+            # Add extra metadata if provided
+            if extra_metadata:
+                metadata.update(extra_metadata)
+            
+            new_metadata.append(metadata)
+        
+        # Vectors and metadata are logged and published together under the write lock
+        with _index_lock.write_lock():
+            ids = np.arange(len(file_metadata), len(file_metadata) + len(paths), dtype=np.int64)
+            for item_id, metadata in zip(ids, new_metadata):
+                metadata['item_id'] = int(item_id)
+            record = {"op": "add", "ids": ids.tolist(), "metadata": new_metadata}
+            if vector_counts is not None:
+                record["vector_counts"] = [int(count) for count in vector_counts]
+            lsn = _log(record, matrix)
+            _apply_add(ids, matrix, new_metadata, vector_counts)
+            
+            total = get_index_size()
+            migrate = index_factory.needs_migration(faiss_index, _live_vector_count())
         
-        print(f"✅ Added {os.path.basename(file_path)} to index (Total: {faiss_index.ntotal})")
+        print(f"✅ Added {len(paths)} items to index (Total: {total})")
+        _commit(lsn, durable=persist)
         
-        # Save every 5 additions for real-time scenarios
-        if faiss_index.ntotal % 5 == 0:
+        if migrate and _migrate_index():
+            # Checkpoint the rebuilt index instead of migrating again after a restart
             save_index()
         
-        return True
+        return ids.tolist() if return_ids else True
         
     except Exception as e:
-        print(f"❌ Error adding embedding: {e}")
+        print(f"❌ Error adding embeddings: {e}")
         import traceback
         traceback.print_exc()
+        return failed
+
+def _segment_numbers(vector_counts):
+    """Per-vector segment numbers for items stored as vector_counts vectors each: 0..n-1, or -1 for a single vector"""
+    return np.concatenate([
+        np.arange(count, dtype=np.int32) if count > 1 else np.full(1, -1, dtype=np.int32)
+        for count in vector_counts
+    ])
+
+def _apply_add(ids, matrix, new_metadata, vector_counts=None):
+    """Caller must hold the write lock"""
+    global _position_ids, _position_segments, _segment_vectors, _live_mask, _live_selector
+    if vector_counts is None:
+        vector_ids = ids
+        segments = np.full(len(ids), -1, dtype=np.int32)
+    else:
+        vector_ids = np.repeat(ids, vector_counts)
+        segments = _segment_numbers(vector_counts)
+    
+    _ensure_writable_index()
+    faiss_index.add_with_ids(np.ascontiguousarray(matrix, dtype=np.float32), vector_ids)
+    _position_ids = np.concatenate([_position_ids, vector_ids])
+    _position_segments = np.concatenate([_position_segments, segments])
+    _segment_vectors += int(np.count_nonzero(segments >= 0))
+    _live_mask = np.concatenate([_live_mask, np.ones(len(vector_ids), dtype=bool)])
+    _live_selector = None
+    _filter_selectors.clear()
+    
+    for metadata in new_metadata:
+        _index_content_hash(metadata.get('content_hash'), len(file_metadata))
+        file_metadata.append(metadata)
+        metadata_columns.append(metadata)
+
+def _rebuild_index(index_type=None):
+    """
+    Rebuilds the index without its dead vectors, converting it to index_type if given.
+    The rebuild works on a copy outside the write lock so searches continue on the old
+    index; the new one is swapped in atomically. Returns True if it was installed.
+    """
+    global faiss_index, _index_is_mapped, _position_ids, _position_segments, _segment_vectors, _live_mask, _dead_count, _live_selector
+    
+    with _rebuild_lock:
+        with _index_lock.read_lock():
+            if faiss_index is None:
+                return False
+            old_index = faiss_index
+            old_total = old_index.ntotal
+            live_snapshot = _live_mask.copy()
+            snapshot = faiss.deserialize_index(faiss.serialize_index(old_index))
+            index_type = index_type or index_factory.get_index_type(old_index)
+        
+        rebuilt = index_factory.rebuild(snapshot, live_snapshot, index_type)
+        del snapshot
+        
+        with _index_lock.write_lock():
+            if faiss_index is not old_index:
+                print("⚠️  Index changed during rebuild, discarding rebuilt index")
+                return False
+            # Kept vectors that were deleted or replaced while we were rebuilding
+            live = _live_mask[:old_total][live_snapshot]
+            segments = _position_segments[:old_total][live_snapshot]
+            # Catch up on rows added while we were rebuilding
+            if faiss_index.ntotal > old_total:
+                tail = np.arange(old_total, faiss_index.ntotal)
+                rebuilt.add_with_ids(index_factory.reconstruct_positions(faiss_index, tail), _position_ids[tail])
+                live = np.concatenate([live, _live_mask[tail]])
+                segments = np.concatenate([segments, _position_segments[tail]])
+            faiss_index = rebuilt
+            _position_ids = index_factory.get_ids(rebuilt)
+            _position_segments = segments
+            _segment_vectors = int(np.count_nonzero(segments >= 0))
+            _live_mask = live
+            _dead_count = int(len(live) - live.sum())
+            _live_selector = None
+            _filter_selectors.clear()
+            _index_is_mapped = False
+        
+        return True
+
+def _migrate_index():
+    """Rebuilds the flat index as index_factory.INDEX_TYPE once it is large enough"""
+    if not index_factory.needs_migration(faiss_index, _live_vector_count()):
+        return False
+    
+    print(f"🔁 Migrating FAISS index with {_live_vector_count()} vectors from flat to {index_factory.INDEX_TYPE}...")
+    if not _rebuild_index(index_factory.INDEX_TYPE):
+        return False
+    print(f"✅ Migrated FAISS index to {index_factory.INDEX_TYPE}")
+    return True
+
+def compact_index():
+    """Rebuilds the index without tombstoned vectors and saves it"""
+    removed = _dead_count
+    if removed == 0:
+        return False
+    
+    print(f"🧹 Compacting FAISS index ({removed} tombstones)...")
+    if not _rebuild_index():
+        return False
+    save_index()
+    print(f"✅ Compacted FAISS index (Total: {get_index_size()})")
+    return True
+
+def _maybe_compact():
+    """Starts a background compaction once the tombstone thresholds are crossed"""
+    global _compaction_thread
+    if faiss_index is None or _dead_count < COMPACTION_MIN_TOMBSTONES:
+        return
+    if _dead_count < COMPACTION_TOMBSTONE_RATIO * faiss_index.ntotal:
+        return
+    with _compaction_lock:
+        if _compaction_thread is not None and _compaction_thread.is_alive():
+            return
+        _compaction_thread = threading.Thread(target=compact_index, name="index-compaction", daemon=True)
+        _compaction_thread.start()
+
+def add_embedding(file_path: str, embedding, file_type: str = "unknown", extra_metadata: dict = None):
+    """
+    Enhanced version with richer metadata support.
+    embedding may also be one row per segment, with the time ranges in extra_metadata['segments'].
+    """
+    # Convert embedding to numpy array if it isn't already
+    if isinstance(embedding, list):
+        embedding = np.array(embedding, dtype=np.float32)
+    elif isinstance(embedding, np.ndarray):
+        embedding = embedding.astype(np.float32)
+    else:
+        print(f"❌ Invalid embedding type: {type(embedding)}")
         return False
+    
+    matrix = np.atleast_2d(embedding)
+    success = add_embeddings([file_path], matrix, [file_type], [extra_metadata], persist=True, vector_counts=[len(matrix)])
+    
+    if success:
+        print(f"✅ Added {os.path.basename(file_path)} to index")
+    
+    return success
 
 
-def search_similar(embedding, num_results: int = 5):
+def search_similar(embedding, num_results: int = 5, nprobe: int = None, ef_search: int = None, filters=None):
     """
     Searches for similar embeddings in the database using FAISS.
+    nprobe (IVF) and ef_search (HNSW) override the index defaults for this query.
+    filters (see metadata_store.normalize_filters) restricts the search to matching items.
     Returns list of dictionaries with file info and similarity scores.
     """
     print(f"🔍 Searching for {num_results} similar items...")
     
-    if faiss_index is None or faiss_index.ntotal == 0:
-        print("📭 FAISS index is not initialized or is empty.")
-        return []
+    if isinstance(embedding, list):
+        embedding = np.array(embedding, dtype=np.float32)
     
+    results = search_similar_batch(np.asarray(embedding).reshape(1, -1), num_results,
+                                   nprobe=nprobe, ef_search=ef_search, filters=filters)
+    return results[0]
+
+def _collapse_hits(row_scores, row_positions, num_results):
+    """
+    Groups one query's vector hits (best first) by item: item id -> (best score, best segment
+    hits), for the first num_results items. Caller must hold a lock.
+    """
+    items = OrderedDict()
+    for score, position in zip(row_scores, row_positions):
+        if position == -1:
+            continue
+        item_id = int(_position_ids[position])
+        hit = items.get(item_id)
+        if hit is None:
+            if len(items) == num_results:
+                continue
+            hit = items[item_id] = (float(score), [])
+        segment = int(_position_segments[position])
+        if segment >= 0 and len(hit[1]) < SEGMENT_HITS_PER_ITEM:
+            hit[1].append((segment, float(score)))
+    return items
+
+def _segment_hits(metadata, hits):
+    """Time ranges of an item's best-matching segments"""
+    bounds = metadata.get('segments') or []
+    return [{'start': bounds[segment][0], 'end': bounds[segment][1], 'score': score}
+            for segment, score in hits if segment < len(bounds)]
+
+def search_similar_batch(embeddings, num_results: int = 5, nprobe: int = None, ef_search: int = None, filters=None):
+    """
+    Searches many query embeddings with a single multi-query FAISS call.
+    With filters, only matching items are searched and each row still gets
+    min(num_results, matching items) results.
+    Hits on segmented audio are collapsed into one result per item, ranked by its best
+    segment, with the best-matching time ranges under 'segments'.
+    Returns one result list (as in search_similar) per query row.
+    """
     try:
-        # Convert and normalize embedding
-        if isinstance(embedding, list):
-            embedding = np.array(embedding, dtype=np.float32)
-        elif isinstance(embedding, np.ndarray):
-            embedding = embedding.astype(np.float32)
-        
-        embedding = embedding.reshape(1, -1)
+        # Convert and normalize embeddings
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        if embeddings.ndim == 1:
+            embeddings = embeddings.reshape(1, -1)
         
         # Normalize for cosine similarity
-        norm = np.linalg.norm(embedding)
-        if norm > 0:
-            embedding = embedding / norm
-        
-        # Search
-        scores, indices = faiss_index.search(embedding, min(num_results, faiss_index.ntotal))
-        
-        # Format results
-        results = []
-        for i, (score, idx) in enumerate(zip(scores[0], indices[0])):
-            if idx != -1 and idx < len(file_paths):  # Valid result
-                result = {
-                    'rank': i + 1,
-                    'file_path': file_paths[idx],
-                    'filename': os.path.basename(file_paths[idx]),
-                    'similarity_score': float(score),
-                    'file_type': file_metadata[idx].get('file_type', 'unknown') if idx < len(file_metadata) else 'unknown'
-                }
-                results.append(result)
-        
-        print(f"✅ Found {len(results)} similar items")
-        return results
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        embeddings = embeddings / norms
+        filters = metadata_store.normalize_filters(filters)
+        
+        # Many searches can hold the read lock at once; FAISS releases the GIL while searching
+        with _index_lock.read_lock():
+            num_live = _live_vector_count()
+            if faiss_index is None or num_live == 0:
+                print("📭 FAISS index is not initialized or is empty.")
+                return [[] for _ in range(len(embeddings))]
+            
+            if filters:
+                mask, count, selector = _get_filter_selector(filters)
+            else:
+                count = num_live
+            
+            # Several vectors can belong to one item, so fetch more and widen the search
+            # until every row has num_results distinct items (or the index runs out)
+            k = min(num_results * SEGMENT_SEARCH_OVERFETCH if _segment_vectors else num_results, count)
+            while True:
+                # Search storage positions directly so dead (and filtered out) vectors can be
+                # skipped by position, then map positions to stable item ids
+                if filters:
+                    scores, positions = index_factory.filtered_search(
+                        index_factory.inner_index(faiss_index), embeddings, k, mask,
+                        count=count, selector=selector, nprobe=nprobe, ef_search=ef_search
+                    )
+                else:
+                    scores, positions = index_factory.search(
+                        index_factory.inner_index(faiss_index), embeddings, k,
+                        nprobe=nprobe, ef_search=ef_search, selector=_get_live_selector()
+                    )
+                hits = [_collapse_hits(row_scores, row_positions, num_results)
+                        for row_scores, row_positions in zip(scores, positions)]
+                if not _segment_vectors or k >= count or all(len(row_hits) >= num_results for row_hits in hits):
+                    break
+                k = min(k * 2, count)
+            
+            # Format results
+            all_results = []
+            for row_hits in hits:
+                results = []
+                for i, (idx, (score, segment_hits)) in enumerate(row_hits.items()):
+                    if idx < len(file_metadata):  # Valid result
+                        metadata = file_metadata[idx]
+                        result = {
+                            'rank': i + 1,
+                            'item_id': idx,
+                            'file_path': metadata['file_path'],
+                            'filename': os.path.basename(metadata['file_path']),
+                            'similarity_score': score,
+                            'file_type': metadata.get('file_type', 'unknown')
+                        }
+                        if segment_hits:
+                            result['segments'] = _segment_hits(metadata, segment_hits)
+                        results.append(result)
+                all_results.append(results)
+        
+        print(f"✅ Found {sum(len(results) for results in all_results)} similar items for {len(all_results)} queries")
+        return all_results
         
     except Exception as e:
         print(f"❌ Error during FAISS search: {e}")
-        return []
+        return [[] for _ in range(len(embeddings))]
 
 def reset_index():
-    """Reset the index (clear all data)"""
-    global faiss_index, file_paths, file_metadata
-    faiss_index = None
-    file_paths = []
-    file_metadata = []
-    
-    # Remove saved files
-    for file in [INDEX_FILE, METADATA_FILE]:
-        if os.path.exists(file):
-            os.remove(file)
+    """Reset the index (clear all data). Raises ReadOnlyIndexError outside the index writer."""
+    global faiss_index, file_metadata, metadata_columns, _content_hash_items, _index_is_mapped, _checkpoint_lsn
+    with _save_lock, _index_lock.write_lock():
+        if _wal is None:
+            raise ReadOnlyIndexError(f"This process only reads the index; process {_lock_owner(WRITER_LOCK_FILE)} writes it")
+        faiss_index = None
+        file_metadata = metadata_store.MmapMetadataList()
+        metadata_columns = metadata_store.MetadataColumns()
+        _content_hash_items = None
+        _index_is_mapped = False
+        _reset_positions(None)
+        
+        # Remove saved files
+        checkpoint = _read_checkpoint()
+        files = [INDEX_FILE, METADATA_FILE, LEGACY_METADATA_FILE, TOMBSTONE_FILE, COLUMNS_FILE, SEGMENTS_FILE, CHECKPOINT_FILE]
+        if checkpoint:
+            files += [checkpoint[key] for key in SNAPSHOT_FILE_KEYS if checkpoint.get(key)]
+        for file in files:
+            if os.path.exists(file):
+                os.remove(file)
+        _wal.reset()
+        _checkpoint_lsn = 0
     
     print("🗑️  Index has been reset")
 
-# Load existing index on module import
-load_index()
+# Load existing index on module import. Spawned worker processes (see audio_decode)
+# re-import the server's main module and must not open or checkpoint the index.
+if multiprocessing.current_process().name == "MainProcess":
+    try:
+        load_index()
+    except IndexLockedError as e:
+        # Raised rather than SystemExit: gunicorn stops when a worker fails to boot with an
+        # exception, but keeps respawning workers that exit
+        print(f"❌ {e}")
+        raise
+    if _wal is not None:
+        _start_checkpointer()
+    else:
+        print(f"👀 Process {_lock_owner(WRITER_LOCK_FILE)} writes the index; this process follows it read-only")
+        _start_follower()
+    atexit.register(flush_log)
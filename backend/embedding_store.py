@@ -0,0 +1,86 @@
+import hashlib
+import os
+import threading
+import numpy as np
+
+# Content-addressed embedding store: one .npy per (model, file hash) so byte-identical
+# uploads never go through CLIP/CLAP twice, even across restarts
+EMBEDDING_STORE_FOLDER = "embedding_store"
+HASH_CHUNK_SIZE = 1024 * 1024
+
+_stats_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0, "stored": 0}
+
+def hash_stream(stream):
+    """SHA-256 of a file-like object (e.g. a Flask upload), rewinding it afterwards"""
+    sha = hashlib.sha256()
+    stream.seek(0)
+    while True:
+        chunk = stream.read(HASH_CHUNK_SIZE)
+        if not chunk:
+            break
+        sha.update(chunk)
+    stream.seek(0)
+    return sha.hexdigest()
+
+def hash_file(file_path):
+    """SHA-256 of a file on disk"""
+    with open(file_path, 'rb') as f:
+        return hash_stream(f)
+
+def _model_key(model_used):
+    """Namespaces stored vectors by the concrete model that produced them"""
+    import models
+    if model_used == "CLAP_SEGMENTS":
+        # Per-window vectors of audio (see embeddings.get_audio_segment_embeddings), only valid for one window layout
+        import audio_decode
+        return (f"{_model_key('CLAP')}-segments-{audio_decode.SEGMENT_SECONDS:g}s"
+                f"-{audio_decode.SEGMENT_HOP_SECONDS:g}s-min{audio_decode.LONG_AUDIO_MIN_SECONDS:g}s")
+    clap_backend = models.get_clap_backend() if model_used == "CLAP" else None
+    if clap_backend is not None:
+        return f"clap-{clap_backend.lower()}"
+    if model_used == "CLIP":
+        # int8 weights give slightly different vectors; fp32 ONNX matches PyTorch
+        return "clip-vit-base-patch32-int8" if models.INFERENCE_BACKEND == "onnx_int8" else "clip-vit-base-patch32"
+    return model_used.lower()
+
+def _store_path(content_hash, model_used):
+    return os.path.join(EMBEDDING_STORE_FOLDER, _model_key(model_used), content_hash[:2], f"{content_hash}.npy")
+
+def get(content_hash, model_used):
+    """Returns the stored embedding for this content and model, or None"""
+    path = _store_path(content_hash, model_used)
+    try:
+        embedding = np.load(path) if os.path.exists(path) else None
+    except Exception as e:
+        print(f"⚠️  Ignoring unreadable stored embedding {path}: {e}")
+        embedding = None
+
+    with _stats_lock:
+        _stats["hits" if embedding is not None else "misses"] += 1
+    return embedding
+
+def put(content_hash, model_used, embedding):
+    """Stores an embedding under its content hash (atomic write)"""
+    if embedding is None:
+        return
+    path = _store_path(content_hash, model_used)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'wb') as f:
+            np.save(f, np.asarray(embedding, dtype=np.float32))
+        os.replace(temp_path, path)
+        with _stats_lock:
+            _stats["stored"] += 1
+    except Exception as e:
+        print(f"⚠️  Could not store embedding for {content_hash}: {e}")
+
+def get_stats():
+    """Returns hit/miss counters for the embedding store"""
+    with _stats_lock:
+        lookups = _stats["hits"] + _stats["misses"]
+        return {
+            **_stats,
+            "hit_rate": round(_stats["hits"] / lookups, 4) if lookups else 0.0
+        }
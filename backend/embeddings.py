@@ -1,34 +1,61 @@
+import os
+import tempfile
 import numpy as np
-import torch
-from PIL import Image
-import librosa
+from concurrent.futures import ThreadPoolExecutor
+from cache import LRUCache
+import models
+import audio_decode
+import image_decode
+
+# Batched image encoding settings
+IMAGE_BATCH_SIZE = 16
+IMAGE_DECODE_WORKERS = 4
+
+# Batched audio encoding settings
+AUDIO_BATCH_SIZE = 8
+AUDIO_SEGMENT_BATCH_SIZE = 16  # Windows of a long file per CLAP call
+
+# Sample rate laion-clap expects for in-memory waveforms
+CLAP_SAMPLE_RATE = 48000
+
+# Query text embedding cache
+TEXT_EMBEDDING_CACHE_SIZE = 2048
+TEXT_EMBEDDING_CACHE_TTL = 3600  # Seconds, None to keep entries until evicted
+TEXT_EMBEDDING_CACHE = LRUCache(TEXT_EMBEDDING_CACHE_SIZE, TEXT_EMBEDDING_CACHE_TTL)
+_text_cache_generation = None
 
 def load_audio(file_path, target_sr=22050):
-    """Enhanced audio loading with proper resampling and normalization"""
-    waveform, sr = librosa.load(file_path, sr=None)
-    if sr != target_sr:
-        waveform = librosa.resample(waveform, orig_sr=sr, target_sr=target_sr)
-        sr = target_sr
-    max_abs_value = np.max(np.abs(waveform))
-    if max_abs_value > 0:
-        waveform = waveform / max_abs_value
-    return waveform, sr
+    """Enhanced audio loading: decodes straight to target_sr and peak-normalizes"""
+    return audio_decode.decode_audio(file_path, target_sr, normalize=True), target_sr
+
+def _describe(source):
+    """Printable name of an image / audio source: a path, bytes or a file-like object"""
+    if isinstance(source, (bytes, bytearray)):
+        return f"<{len(source)} bytes in memory>"
+    if isinstance(source, (str, os.PathLike)):
+        return str(source)
+    return getattr(source, "filename", None) or getattr(source, "name", None) or "<stream>"
+
+def _read_source(source):
+    """Bytes of an in-memory or file-like source"""
+    if isinstance(source, (bytes, bytearray)):
+        return bytes(source)
+    source.seek(0)
+    return source.read()
 
 def get_image_embedding(image_path):
-    """Generates a single image embedding using CLIP"""
-    from models import CLIP_MODEL, CLIP_PROCESSOR
-    
-    print(f"🖼️  Generating embedding for image: {image_path}")
+    """Generates a single image embedding using CLIP. image_path may also be bytes or a file-like object."""
+    print(f"🖼️  Generating embedding for image: {_describe(image_path)}")
     
+    CLIP_MODEL, CLIP_PROCESSOR = models.get_clip()
     if CLIP_PROCESSOR is None or CLIP_MODEL is None:
         print("❌ CLIP models not loaded.")
-        import models
-        models.load_models()
-        if CLIP_PROCESSOR is None or CLIP_MODEL is None:
-            return None
+        return None
+    # Imported on first use so importing this module (and app) doesn't load torch
+    import torch
     
     try:
-        image = Image.open(image_path).convert("RGB")
+        image = image_decode.open_image(image_path)
         inputs = CLIP_PROCESSOR(images=image, return_tensors="pt")
         
         with torch.no_grad():
@@ -41,82 +68,359 @@ def get_image_embedding(image_path):
         return embedding
         
     except Exception as e:
-        print(f"❌ Error generating image embedding for {image_path}: {e}")
+        print(f"❌ Error generating image embedding for {_describe(image_path)}: {e}")
         import traceback
         traceback.print_exc()
         return None
 
-def get_audio_embedding(audio_path):
-    """Generates audio embedding using CLAP (CLIP-compatible)"""
+def _load_image(image_path):
+    """Decodes an image to RGB (reduced for CLIP, see image_decode), returning None if the file can't be read"""
+    try:
+        return image_decode.open_image(image_path)
+    except Exception as e:
+        print(f"❌ Error decoding image {_describe(image_path)}: {e}")
+        return None
+
+def get_image_embeddings(image_paths, batch_size=IMAGE_BATCH_SIZE, num_workers=IMAGE_DECODE_WORKERS):
+    """
+    Generates image embeddings for many files using batched CLIP forward passes.
+    Entries may be paths, bytes or file-like objects.
+    Images are decoded on a thread pool while the previous batch runs through CLIP.
+    Returns a list aligned with image_paths, with None for files that failed.
+    """
+    embeddings = [None] * len(image_paths)
+    if not image_paths:
+        return embeddings
+    
+    print(f"🖼️  Generating embeddings for {len(image_paths)} images (batch size {batch_size})")
+    
+    CLIP_MODEL, CLIP_PROCESSOR = models.get_clip()
+    if CLIP_PROCESSOR is None or CLIP_MODEL is None:
+        print("❌ CLIP models not loaded.")
+        return embeddings
+    import torch
+    
+    batch_starts = list(range(0, len(image_paths), batch_size))
+    
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        # Decode the next batch while the current one is being encoded
+        pending = [pool.submit(_load_image, path) for path in image_paths[:batch_size]]
+        
+        for n, start in enumerate(batch_starts):
+            images = [future.result() for future in pending]
+            if n + 1 < len(batch_starts):
+                next_start = batch_starts[n + 1]
+                pending = [pool.submit(_load_image, path) for path in image_paths[next_start:next_start + batch_size]]
+            
+            valid = [i for i, image in enumerate(images) if image is not None]
+            if not valid:
+                continue
+            
+            try:
+                inputs = CLIP_PROCESSOR(images=[images[i] for i in valid], return_tensors="pt")
+                
+                with torch.no_grad():
+                    image_features = CLIP_MODEL.get_image_features(pixel_values=inputs.pixel_values)
+                    image_features = image_features / image_features.norm(dim=-1, keepdim=True)
+                
+                batch_embeddings = image_features.cpu().numpy()
+                for row, i in enumerate(valid):
+                    embeddings[start + i] = batch_embeddings[row]
+                    
+            except Exception as e:
+                print(f"❌ Error generating image embeddings for batch starting at {start}: {e}")
+                import traceback
+                traceback.print_exc()
+    
+    generated = sum(1 for embedding in embeddings if embedding is not None)
+    print(f"✅ Generated {generated}/{len(image_paths)} image embeddings")
+    
+    return embeddings
+
+def _clap_embed_files(audio_paths):
+    """Runs a list of audio files through whichever CLAP backend is loaded in one call"""
     from models import CLAP_MODEL
     
-    print(f"🎵 Generating CLAP embedding for audio: {audio_path}")
+    # Check which CLAP implementation we're using
+    if hasattr(CLAP_MODEL, 'get_audio_embeddings'):
+        # msclap implementation
+        return CLAP_MODEL.get_audio_embeddings(audio_paths)
+        
+    elif hasattr(CLAP_MODEL, 'get_audio_embedding_from_filelist'):
+        # laion-clap implementation
+        return CLAP_MODEL.get_audio_embedding_from_filelist(audio_paths, use_tensor=False)
     
-    if CLAP_MODEL is None:
+    raise ValueError("Unknown CLAP model implementation")
+
+def _clap_takes_waveforms():
+    """laion-clap can embed decoded waveforms; msclap only takes file paths"""
+    from models import CLAP_MODEL
+    return hasattr(CLAP_MODEL, 'get_audio_embedding_from_data')
+
+def _clap_embed_waveforms(waveforms):
+    """Runs CLAP_SAMPLE_RATE waveforms through laion-clap in one call"""
+    from models import CLAP_MODEL
+    # get_audio_embedding_from_filelist rounds waveforms through int16; do the same so
+    # these vectors match the ones already stored for the file-based path
+    waveforms = [((np.clip(waveform, -1.0, 1.0) * 32767.0).astype(np.int16) / 32767.0).astype(np.float32)
+                 for waveform in waveforms]
+    return CLAP_MODEL.get_audio_embedding_from_data(x=waveforms, use_tensor=False)
+
+def _to_clip_space(embedding):
+    """Flattens a CLAP embedding, fits it to 512 dimensions and normalizes it"""
+    # Convert to numpy if needed
+    if hasattr(embedding, "detach"):
+        embedding = embedding.detach().cpu().numpy()
+    
+    embedding = np.asarray(embedding, dtype=np.float32).flatten()
+    
+    # Ensure 512 dimensions to match CLIP
+    expected_dim = 512
+    if embedding.shape[0] != expected_dim:
+        if embedding.shape[0] > expected_dim:
+            embedding = embedding[:expected_dim]
+        else:
+            padded = np.zeros(expected_dim, dtype=np.float32)
+            padded[:embedding.shape[0]] = embedding
+            embedding = padded
+    
+    # Normalize for cosine similarity
+    norm = np.linalg.norm(embedding)
+    if norm > 0:
+        embedding = embedding / norm
+    
+    return embedding
+
+def _clap_embed_bytes(data, suffix=""):
+    """
+    Embeds one in-memory audio file. laion-clap takes decoded waveforms, so formats
+    librosa can read from memory never touch the disk; msclap only takes paths, so for it
+    (and for formats that need a path to decode) the data is spilled to a temp file.
+    """
+    if _clap_takes_waveforms():
+        try:
+            return _clap_embed_waveforms([audio_decode.decode_audio(data, CLAP_SAMPLE_RATE)])[0]
+        except Exception as e:
+            print(f"⚠️  Could not decode audio in memory ({e}), using a temp file")
+    
+    temp_file = tempfile.NamedTemporaryFile(suffix=suffix, delete=False)
+    try:
+        with temp_file:
+            temp_file.write(data)
+        return _clap_embed_files([temp_file.name])[0]
+    finally:
+        os.remove(temp_file.name)
+
+def get_audio_embedding(audio_path, suffix=None):
+    """
+    Generates audio embedding using CLAP (CLIP-compatible).
+    audio_path may also be bytes or a file-like object; suffix (e.g. ".mp3") names its
+    format if it has to be spilled to a temp file.
+    """
+    print(f"🎵 Generating CLAP embedding for audio: {_describe(audio_path)}")
+    
+    if models.get_clap() is None:
         print("❌ CLAP model not loaded")
         return None
     
     try:
-        # Check which CLAP implementation we're using
-        if hasattr(CLAP_MODEL, 'get_audio_embeddings'):
-            # msclap implementation
-            audio_embeddings = CLAP_MODEL.get_audio_embeddings([audio_path])
-            embedding = audio_embeddings[0]
-            
-        elif hasattr(CLAP_MODEL, 'get_audio_embedding_from_filelist'):
-            # laion-clap implementation
-            audio_embeddings = CLAP_MODEL.get_audio_embedding_from_filelist([audio_path], use_tensor=False)
-            embedding = audio_embeddings[0]
-            
-        else:
-            print("❌ Unknown CLAP model implementation")
-            return None
-        
-        # Convert to numpy if needed
-        if isinstance(embedding, torch.Tensor):
-            embedding = embedding.cpu().numpy()
-        
-        embedding = embedding.flatten()
-        
-        # Ensure 512 dimensions to match CLIP
-        expected_dim = 512
-        if embedding.shape[0] != expected_dim:
-            if embedding.shape[0] > expected_dim:
-                embedding = embedding[:expected_dim]
+        if isinstance(audio_path, (str, os.PathLike)):
+            if _clap_takes_waveforms():
+                waveform = audio_decode.decode_many([audio_path], CLAP_SAMPLE_RATE)[0]
+                if waveform is None:
+                    return None
+                audio_embedding = _clap_embed_waveforms([waveform])[0]
             else:
-                padded = np.zeros(expected_dim, dtype=np.float32)
-                padded[:embedding.shape[0]] = embedding
-                embedding = padded
-        
-        # Normalize for cosine similarity
-        norm = np.linalg.norm(embedding)
-        if norm > 0:
-            embedding = embedding / norm
+                audio_embedding = _clap_embed_files([audio_path])[0]
+        else:
+            if suffix is None:
+                suffix = os.path.splitext(_describe(audio_path))[1]
+            audio_embedding = _clap_embed_bytes(_read_source(audio_path), suffix)
+        embedding = _to_clip_space(audio_embedding)
         
         print(f"✅ Generated CLAP audio embedding with shape: {embedding.shape}")
         return embedding
         
     except Exception as e:
-        print(f"❌ Error generating CLAP audio embedding for {audio_path}: {e}")
+        print(f"❌ Error generating CLAP audio embedding for {_describe(audio_path)}: {e}")
         import traceback
         traceback.print_exc()
         return None
 
+def get_audio_embeddings(audio_paths, batch_size=AUDIO_BATCH_SIZE):
+    """
+    Generates CLAP embeddings for many audio files, sending batch_size files per backend call.
+    Backends that take waveforms get them from audio_decode (parallel decode, waveform cache);
+    files that won't decode are skipped. For path-based backends a failed batch is retried
+    one file at a time.
+    Returns a list aligned with audio_paths, with None for files that failed.
+    """
+    embeddings = [None] * len(audio_paths)
+    if not audio_paths:
+        return embeddings
+    
+    print(f"🎵 Generating CLAP embeddings for {len(audio_paths)} audio files (batch size {batch_size})")
+    
+    if models.get_clap() is None:
+        print("❌ CLAP model not loaded")
+        return embeddings
+    
+    takes_waveforms = _clap_takes_waveforms()
+    for start in range(0, len(audio_paths), batch_size):
+        batch_paths = audio_paths[start:start + batch_size]
+        
+        if takes_waveforms:
+            waveforms = audio_decode.decode_many(batch_paths, CLAP_SAMPLE_RATE)
+            valid = [offset for offset, waveform in enumerate(waveforms) if waveform is not None]
+            try:
+                if valid:
+                    batch_embeddings = _clap_embed_waveforms([waveforms[offset] for offset in valid])
+                    for offset, embedding in zip(valid, batch_embeddings):
+                        embeddings[start + offset] = _to_clip_space(embedding)
+            except Exception as e:
+                print(f"❌ CLAP batch starting at {start} failed: {e}")
+            continue
+        
+        try:
+            batch_embeddings = _clap_embed_files(batch_paths)
+            if len(batch_embeddings) != len(batch_paths):
+                raise ValueError(f"CLAP returned {len(batch_embeddings)} embeddings for {len(batch_paths)} files")
+            
+            for offset, embedding in enumerate(batch_embeddings):
+                embeddings[start + offset] = _to_clip_space(embedding)
+                
+        except Exception as e:
+            print(f"⚠️  CLAP batch starting at {start} failed ({e}), falling back to per-file embedding")
+            for offset, audio_path in enumerate(batch_paths):
+                embeddings[start + offset] = get_audio_embedding(audio_path)
+    
+    generated = sum(1 for embedding in embeddings if embedding is not None)
+    print(f"✅ Generated {generated}/{len(audio_paths)} CLAP audio embeddings")
+    
+    return embeddings
+
+def _clap_embed_segments(waveforms):
+    """Runs decoded windows through CLAP; msclap only takes paths, so they go through temp .wav files"""
+    if _clap_takes_waveforms():
+        return _clap_embed_waveforms(waveforms)
+    
+    from scipy.io import wavfile
+    temp_paths = []
+    try:
+        for waveform in waveforms:
+            with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as temp_file:
+                temp_paths.append(temp_file.name)
+                wavfile.write(temp_file, CLAP_SAMPLE_RATE, waveform)
+        return _clap_embed_files(temp_paths)
+    finally:
+        for temp_path in temp_paths:
+            os.remove(temp_path)
+
+def _embed_long_audio(audio_path, duration, batch_size):
+    """One CLAP vector per audio_decode window of a long file, as an (n, 512) array"""
+    vectors = []
+    batch = []
+    for waveform in audio_decode.iter_segments(audio_path, CLAP_SAMPLE_RATE, duration):
+        batch.append(waveform)
+        if len(batch) == batch_size:
+            vectors.extend(_to_clip_space(embedding) for embedding in _clap_embed_segments(batch))
+            batch = []
+    if batch:
+        vectors.extend(_to_clip_space(embedding) for embedding in _clap_embed_segments(batch))
+    return np.stack(vectors) if vectors else None
+
+def get_audio_segment_embeddings(audio_paths, batch_size=AUDIO_BATCH_SIZE, segment_batch_size=AUDIO_SEGMENT_BATCH_SIZE):
+    """
+    Generates CLAP embeddings for indexing: files of at least audio_decode.LONG_AUDIO_MIN_SECONDS
+    are streamed in overlapping windows and get one vector per window (see
+    audio_decode.iter_segments and segment_bounds), shorter files one whole-file vector.
+    Returns a list aligned with audio_paths of (n, 512) arrays, with None for files that failed.
+    """
+    embeddings = [None] * len(audio_paths)
+    durations = [audio_decode.get_duration(path) for path in audio_paths]
+    long_files = [i for i, duration in enumerate(durations) if audio_decode.is_long_audio(duration)]
+    short_files = [i for i, duration in enumerate(durations) if not audio_decode.is_long_audio(duration)]
+    
+    for i, embedding in zip(short_files, get_audio_embeddings([audio_paths[i] for i in short_files], batch_size)):
+        if embedding is not None:
+            embeddings[i] = embedding.reshape(1, -1)
+    
+    if long_files and models.get_clap() is None:
+        print("❌ CLAP model not loaded")
+        return embeddings
+    
+    for i in long_files:
+        print(f"🎵 Generating CLAP segment embeddings for {durations[i]:.0f}s of audio: {audio_paths[i]}")
+        try:
+            embeddings[i] = _embed_long_audio(audio_paths[i], durations[i], segment_batch_size)
+            if embeddings[i] is not None:
+                print(f"✅ Generated {len(embeddings[i])} segment embeddings")
+        except Exception as e:
+            print(f"❌ Error generating CLAP segment embeddings for {audio_paths[i]}: {e}")
+    
+    return embeddings
+
+def _normalize_query_text(text):
+    """Cache key for a text query: CLIP lowercases and ignores repeated whitespace"""
+    return " ".join(text.split()).lower()
+
+def _sync_text_cache():
+    """Clears the text embedding cache if CLIP was reloaded since it was filled"""
+    global _text_cache_generation
+    if _text_cache_generation != models.MODEL_GENERATIONS["clip"]:
+        TEXT_EMBEDDING_CACHE.clear()
+        _text_cache_generation = models.MODEL_GENERATIONS["clip"]
+
+def get_text_cache_stats():
+    """Returns hit/miss counters for the query text embedding cache"""
+    return TEXT_EMBEDDING_CACHE.stats()
+
 def get_text_embedding(text):
-    """Generates a text embedding using CLIP text encoder"""
-    from models import CLIP_MODEL, CLIP_PROCESSOR
+    """Generates a text embedding using CLIP text encoder, served from the LRU cache when possible"""
+    return get_text_embeddings([text])[0]
+
+def get_text_embeddings(texts):
+    """
+    Generates text embeddings for many queries in one CLIP forward pass.
+    Cached queries are served from the LRU cache and only the rest go through CLIP.
+    Returns a list aligned with texts, with None for queries that failed.
+    """
+    _sync_text_cache()
+    cache_keys = [_normalize_query_text(text) for text in texts]
+    embeddings = [TEXT_EMBEDDING_CACHE.get(cache_key) for cache_key in cache_keys]
+    
+    # Encode each distinct uncached query once
+    missing = {}
+    for i, embedding in enumerate(embeddings):
+        if embedding is None:
+            missing.setdefault(cache_keys[i], texts[i])
     
-    print(f"📝 Generating embedding for text: '{text[:50]}...'")
+    if missing:
+        computed = dict(zip(missing.keys(), _compute_text_embeddings(list(missing.values()))))
+        for cache_key, embedding in computed.items():
+            if embedding is not None:
+                embedding.setflags(write=False)
+                TEXT_EMBEDDING_CACHE.put(cache_key, embedding)
+        embeddings = [embedding if embedding is not None else computed.get(cache_key)
+                      for embedding, cache_key in zip(embeddings, cache_keys)]
     
+    return embeddings
+
+def _compute_text_embeddings(texts):
+    """Runs the CLIP text encoder over a batch of queries"""
+    if len(texts) == 1:
+        print(f"📝 Generating embedding for text: '{texts[0][:50]}...'")
+    else:
+        print(f"📝 Generating embeddings for {len(texts)} texts")
+    
+    CLIP_MODEL, CLIP_PROCESSOR = models.get_clip()
     if CLIP_PROCESSOR is None or CLIP_MODEL is None:
         print("❌ CLIP models not loaded.")
-        import models
-        models.load_models()
-        if CLIP_PROCESSOR is None or CLIP_MODEL is None:
-            return None
+        return [None] * len(texts)
+    import torch
     
     try:
-        inputs = CLIP_PROCESSOR(text=[text], return_tensors="pt", padding=True, truncation=True)
+        inputs = CLIP_PROCESSOR(text=list(texts), return_tensors="pt", padding=True, truncation=True)
         
         with torch.no_grad():
             text_features = CLIP_MODEL.get_text_features(
@@ -125,16 +429,16 @@ def get_text_embedding(text):
             )
             text_features = text_features / text_features.norm(dim=-1, keepdim=True)
         
-        embedding = text_features.squeeze().cpu().numpy()
-        print(f"✅ Generated text embedding with shape: {embedding.shape}")
+        embeddings = list(text_features.cpu().numpy())
+        print(f"✅ Generated {len(embeddings)} text embeddings with shape: {embeddings[0].shape}")
         
-        return embedding
+        return embeddings
         
     except Exception as e:
-        print(f"❌ Error generating text embedding for '{text}': {e}")
+        print(f"❌ Error generating text embeddings for {texts}: {e}")
         import traceback
         traceback.print_exc()
-        return None
+        return [None] * len(texts)
 
 def verify_embedding_compatibility():
     """Verify that all embedding types produce compatible vectors"""
@@ -0,0 +1,85 @@
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+
+# Image decoding for CLIP. CLIP only ever sees a CLIP_INPUT_SIZE center crop, so images
+# are decoded straight to about that size instead of at full resolution: JPEGs through
+# draft(), which has libjpeg scale the DCT by 1/2, 1/4 or 1/8 while decoding (never below
+# the requested size), and every image is then resized in C so its shorter side is
+# CLIP_INPUT_SIZE, which is CLIP's own first preprocessing step. A 20-megapixel photo
+# is decoded at 1/8 scale and the processor has almost nothing left to do.
+FAST_IMAGE_DECODE = True
+CLIP_INPUT_SIZE = 224
+# Resizes first shrink by an integer factor with box filtering when the image is more
+# than this many times the target size, then finish with bicubic (see PIL Image.resize)
+RESIZE_REDUCING_GAP = 3.0
+
+# Thumbnails saved next to each indexed image at ingest: the CLIP-sized copy as a JPEG.
+# Re-embedding reads the thumbnail instead of the original (the fast path would reduce
+# the original to the same pixels), and /static/<file>?thumbnail=1 serves it for previews.
+SAVE_THUMBNAILS = True
+THUMBNAIL_SUFFIX = ".thumb.jpg"
+THUMBNAIL_QUALITY = 90
+THUMBNAIL_WORKERS = 4
+
+def reduce_for_clip(image, size=CLIP_INPUT_SIZE):
+    """Resizes an image so its shorter side is size, rounding the longer side like CLIPProcessor. Smaller images are left alone."""
+    width, height = image.size
+    short_side, long_side = min(width, height), max(width, height)
+    if short_side <= size:
+        return image
+    long_side = int(size * long_side / short_side)
+    new_size = (size, long_side) if width <= height else (long_side, size)
+    return image.resize(new_size, Image.BICUBIC, reducing_gap=RESIZE_REDUCING_GAP)
+
+def _decode(image, fast):
+    if fast:
+        # No-op for formats other than JPEG
+        image.draft("RGB", (CLIP_INPUT_SIZE, CLIP_INPUT_SIZE))
+    image = image.convert("RGB")
+    return reduce_for_clip(image) if fast else image
+
+def open_image(source, fast=None):
+    """
+    Opens an image from a path, bytes or a file-like object (e.g. a Flask upload) as RGB.
+    With the fast path it comes back already reduced for CLIP.
+    """
+    fast = FAST_IMAGE_DECODE if fast is None else fast
+    if isinstance(source, (bytes, bytearray)):
+        source = io.BytesIO(source)
+    elif hasattr(source, "seek"):
+        source.seek(0)
+    return _decode(Image.open(source), fast)
+
+def thumbnail_path(image_path):
+    """Where the thumbnail of an image file is kept: next to it, with THUMBNAIL_SUFFIX"""
+    return os.path.splitext(image_path)[0] + THUMBNAIL_SUFFIX
+
+def save_thumbnail(image_path):
+    """Writes the CLIP-sized copy of an image file next to it. Returns its path, or None if the image can't be read."""
+    path = thumbnail_path(image_path)
+    try:
+        with Image.open(image_path) as original:
+            # Keep the EXIF block so viewers still apply the camera orientation
+            exif = original.info.get("exif")
+            image = _decode(original, fast=True)
+        temp_path = f"{path}.tmp"
+        image.save(temp_path, "JPEG", quality=THUMBNAIL_QUALITY, **({"exif": exif} if exif else {}))
+        os.replace(temp_path, path)
+        return path
+    except Exception as e:
+        print(f"⚠️  Could not save a thumbnail for {image_path}: {e}")
+        return None
+
+def save_thumbnails(image_paths, num_workers=THUMBNAIL_WORKERS):
+    """Saves thumbnails for many images on a thread pool. Returns their paths, with None for failures."""
+    if len(image_paths) <= 1:
+        return [save_thumbnail(path) for path in image_paths]
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        return list(pool.map(save_thumbnail, image_paths))
+
+def remove_thumbnail(image_path):
+    path = thumbnail_path(image_path)
+    if os.path.exists(path):
+        os.remove(path)
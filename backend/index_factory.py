@@ -0,0 +1,271 @@
+import faiss
+import os
+import numpy as np
+
+# ANN index used once a collection crosses MIGRATION_THRESHOLD items.
+# One of "flat", "hnsw", "ivf_flat" or "ivf_pq". Small collections always
+# stay on an exact IndexFlatIP, which is faster than any ANN index at that size.
+INDEX_TYPE = "hnsw"
+MIGRATION_THRESHOLD = 10000
+
+# HNSW settings
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 80
+DEFAULT_EF_SEARCH = 64
+
+# IVF settings (nlist is derived from the collection size at training time)
+DEFAULT_NPROBE = 16
+IVF_PQ_M = 64  # Sub-quantizers, must divide the embedding dimension
+IVF_PQ_NBITS = 8
+
+INDEX_TYPES = ("flat", "hnsw", "ivf_flat", "ivf_pq")
+
+# Filtered searches matching at most this many vectors of an ANN index are answered exactly
+# from the stored vectors; graph and inverted-list searches can come up short on them
+FILTER_EXACT_SEARCH_MAX = 4096
+
+def _choose_nlist(num_vectors):
+    """Picks an IVF list count of about 4*sqrt(n), keeping ~39 training points per list"""
+    nlist = int(4 * np.sqrt(num_vectors))
+    return max(1, min(nlist, num_vectors // 39))
+
+def create_index(dim, index_type="flat", num_training_vectors=0):
+    """Creates an empty inner-product index of the given type"""
+    if index_type == "flat":
+        return faiss.IndexFlatIP(dim)
+
+    if index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dim, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        index.hnsw.efSearch = DEFAULT_EF_SEARCH
+        return index
+
+    if index_type in ("ivf_flat", "ivf_pq"):
+        nlist = _choose_nlist(num_training_vectors)
+        quantizer = faiss.IndexFlatIP(dim)
+        if index_type == "ivf_flat":
+            index = faiss.IndexIVFFlat(quantizer, dim, nlist, faiss.METRIC_INNER_PRODUCT)
+        else:
+            index = faiss.IndexIVFPQ(quantizer, dim, nlist, IVF_PQ_M, IVF_PQ_NBITS, faiss.METRIC_INNER_PRODUCT)
+        index.nprobe = min(DEFAULT_NPROBE, nlist)
+        # Lets vectors be reconstructed by position for compaction and migration
+        index.make_direct_map()
+        return index
+
+    raise ValueError(f"Unknown index type: {index_type}. Expected one of {INDEX_TYPES}")
+
+def create_id_index(dim, index_type="flat"):
+    """Creates an empty index that stores a stable 64-bit id per vector"""
+    return faiss.IndexIDMap2(create_index(dim, index_type))
+
+def build_index(vectors, index_type, ids=None):
+    """
+    Creates an index of the given type, trains it on the vectors and adds them.
+    With ids the index is wrapped in an IndexIDMap2 and each vector keeps its id.
+    """
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    index = create_index(vectors.shape[1], index_type, num_training_vectors=vectors.shape[0])
+    if not index.is_trained:
+        index.train(vectors)
+    if ids is None:
+        index.add(vectors)
+        return index
+    index = faiss.IndexIDMap2(index)
+    index.add_with_ids(vectors, np.asarray(ids, dtype=np.int64))
+    return index
+
+def has_ids(index):
+    """True for indexes wrapped in an IndexIDMap / IndexIDMap2"""
+    return isinstance(faiss.downcast_index(index), (faiss.IndexIDMap, faiss.IndexIDMap2))
+
+def inner_index(index):
+    """The index that holds the vectors; search it directly to get storage positions"""
+    index = faiss.downcast_index(index)
+    if isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+        return faiss.downcast_index(index.index)
+    return index
+
+def get_ids(index):
+    """The stable id of every stored vector, by storage position"""
+    if has_ids(index):
+        return faiss.vector_to_array(faiss.downcast_index(index).id_map).astype(np.int64)
+    return np.arange(index.ntotal, dtype=np.int64)
+
+def reconstruct_positions(index, positions):
+    """Reads stored vectors back by storage position"""
+    inner = inner_index(index)
+    positions = np.asarray(positions, dtype=np.int64)
+    if len(positions) == 0:
+        return np.zeros((0, inner.d), dtype=np.float32)
+    if isinstance(inner, faiss.IndexIVF) and inner.direct_map.type == faiss.DirectMap.NoMap:
+        inner.make_direct_map()
+    return inner.reconstruct_batch(positions)
+
+def rebuild(index, live_mask=None, index_type=None):
+    """
+    Builds an id-mapped copy of index without the vectors whose live_mask entry is False,
+    converting it to index_type if given. Ids are preserved; storage positions are compacted.
+    """
+    ids = get_ids(index)
+    live_mask = np.ones(index.ntotal, dtype=bool) if live_mask is None else np.asarray(live_mask, dtype=bool)
+    index_type = index_type or get_index_type(index)
+    keep = np.flatnonzero(live_mask)
+    
+    if has_ids(index) and index_type == "flat" and get_index_type(index) == "flat":
+        # Flat storage supports remove_ids directly, as long as no live vector shares an id with a dead one
+        dead_ids = ids[~live_mask]
+        if not np.isin(dead_ids, ids[keep]).any():
+            compacted = faiss.deserialize_index(faiss.serialize_index(index))
+            compacted.remove_ids(faiss.IDSelectorBatch(dead_ids))
+            return compacted
+    
+    if len(keep) == 0:
+        # Nothing to train an ANN index on; start over exact
+        return create_id_index(index.d, "flat")
+    
+    vectors = reconstruct_positions(index, keep)
+    if index_type in ("ivf_flat", "ivf_pq") and index_type == get_index_type(index):
+        # Reuse the trained centroids and codebooks instead of retraining. Copied through
+        # serialization, as a clone of a memory-mapped index can't be reset.
+        rebuilt = faiss.deserialize_index(faiss.serialize_index(inner_index(index)))
+        rebuilt.reset()
+        rebuilt = faiss.IndexIDMap2(rebuilt)
+        rebuilt.add_with_ids(vectors, ids[keep])
+        return rebuilt
+    return build_index(vectors, index_type, ids=ids[keep])
+
+def live_selector(live_mask):
+    """IDSelector over storage positions that skips vectors whose mask entry is False"""
+    bits = np.packbits(np.asarray(live_mask, dtype=bool), bitorder="little")
+    selector = faiss.IDSelectorBitmap(len(live_mask), faiss.swig_ptr(bits))
+    selector.referenced_objects = [bits]  # The selector only holds a pointer to the bitmap
+    return selector
+
+def get_index_type(index):
+    """Returns the factory name of an index instance"""
+    if index is None:
+        return None
+    index = inner_index(index)
+    if isinstance(index, faiss.IndexHNSW):
+        return "hnsw"
+    if isinstance(index, faiss.IndexIVFPQ):
+        return "ivf_pq"
+    if isinstance(index, faiss.IndexIVF):
+        return "ivf_flat"
+    if isinstance(index, faiss.IndexFlat):
+        return "flat"
+    return type(index).__name__
+
+def needs_migration(index, num_live=None):
+    """True when a flat index has crossed the threshold for the configured ANN type"""
+    return (
+        index is not None
+        and INDEX_TYPE != "flat"
+        and get_index_type(index) == "flat"
+        and (index.ntotal if num_live is None else num_live) >= MIGRATION_THRESHOLD
+    )
+
+def maybe_migrate(index):
+    """Rebuilds a flat index as INDEX_TYPE once it is large enough, otherwise returns it unchanged"""
+    if not needs_migration(index):
+        return index
+
+    print(f"🔁 Migrating FAISS index with {index.ntotal} items from flat to {INDEX_TYPE}...")
+    vectors = index.reconstruct_n(0, index.ntotal)
+    migrated = build_index(vectors, INDEX_TYPE)
+    print(f"✅ Migrated FAISS index to {INDEX_TYPE}")
+    return migrated
+
+def make_search_params(index, nprobe=None, ef_search=None, selector=None):
+    """
+    Builds per-query FAISS search parameters for the tunables that apply to this index.
+    selector restricts the search to the vectors it accepts.
+    """
+    index = inner_index(index)
+    index_type = get_index_type(index)
+
+    if index_type == "hnsw" and (ef_search is not None or selector is not None):
+        ef_search = index.hnsw.efSearch if ef_search is None else ef_search
+        return faiss.SearchParametersHNSW(efSearch=int(ef_search), sel=selector)
+
+    if index_type in ("ivf_flat", "ivf_pq") and (nprobe is not None or selector is not None):
+        nprobe = index.nprobe if nprobe is None else nprobe
+        return faiss.SearchParametersIVF(nprobe=int(nprobe), sel=selector)
+
+    if selector is not None:
+        return faiss.SearchParameters(sel=selector)
+
+    return None
+
+def search(index, queries, k, nprobe=None, ef_search=None, selector=None):
+    """Runs index.search with optional per-query nprobe / efSearch overrides and an IDSelector"""
+    queries = np.ascontiguousarray(queries, dtype=np.float32)
+    params = make_search_params(index, nprobe=nprobe, ef_search=ef_search, selector=selector)
+    if params is None:
+        return index.search(queries, k)
+    return index.search(queries, k, params=params)
+
+def _exact_subset_search(index, queries, k, positions):
+    """Exact inner-product top-k over the stored vectors at the given positions"""
+    vectors = reconstruct_positions(index, positions)
+    scores = queries @ vectors.T
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    top_scores = np.take_along_axis(scores, top, axis=1)
+    order = np.argsort(-top_scores, axis=1, kind="stable")
+    return (np.take_along_axis(top_scores, order, axis=1).astype(np.float32),
+            positions[np.take_along_axis(top, order, axis=1)])
+
+def filtered_search(index, queries, k, mask, count=None, selector=None, nprobe=None, ef_search=None):
+    """
+    Searches only the vectors whose mask entry (by storage position) is True and returns
+    min(k, count) results per row. Small subsets of an ANN index are searched exactly from the
+    stored vectors, and rows the ANN search leaves short are redone exactly, so selective
+    filters never come back with fewer than k results.
+    """
+    queries = np.ascontiguousarray(queries, dtype=np.float32)
+    count = int(np.count_nonzero(mask)) if count is None else count
+    k = min(k, count)
+    if k <= 0:
+        return np.zeros((len(queries), 0), dtype=np.float32), np.zeros((len(queries), 0), dtype=np.int64)
+    
+    if get_index_type(index) != "flat" and count <= FILTER_EXACT_SEARCH_MAX:
+        return _exact_subset_search(index, queries, k, np.flatnonzero(mask))
+    
+    selector = live_selector(mask) if selector is None else selector
+    scores, positions = search(index, queries, k, nprobe=nprobe, ef_search=ef_search, selector=selector)
+    short = (positions == -1).any(axis=1)
+    if short.any():
+        scores[short], positions[short] = _exact_subset_search(index, queries[short], k, np.flatnonzero(mask))
+    return scores, positions
+
+def read_index(path, mmap=False):
+    """
+    Reads an index file, memory-mapped when requested and supported by the index type.
+    Returns (index, is_mapped). A mapped index must not be modified; copy it with
+    faiss.deserialize_index(faiss.serialize_index(index)) first.
+    """
+    if mmap:
+        # IO_FLAG_MMAP_IFC maps flat vector storage too; older FAISS builds only have IO_FLAG_MMAP
+        mmap_flag = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP)
+        try:
+            return faiss.read_index(path, mmap_flag | faiss.IO_FLAG_READ_ONLY), True
+        except Exception as e:
+            print(f"⚠️  Could not memory-map {path} ({e}), reading it into memory")
+    return faiss.read_index(path), False
+
+def write_index(index, path):
+    """Writes an index through a temp file and rename, so processes mapping the old file are unaffected"""
+    temp_path = f"{path}.tmp"
+    faiss.write_index(index, temp_path)
+    with open(temp_path, "rb") as f:
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+def write_serialized_index(data, path):
+    """Like write_index, for an index already serialized with faiss.serialize_index (same file format)"""
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "wb") as f:
+        f.write(memoryview(data))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
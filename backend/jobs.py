@@ -0,0 +1,67 @@
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+# Background ingestion jobs run on a small fixed pool so a burst of uploads
+# can't start more embedding work than the CPU can serve
+INGEST_WORKERS = 2
+MAX_PENDING_JOBS = 32
+
+_executor = ThreadPoolExecutor(max_workers=INGEST_WORKERS, thread_name_prefix="ingest")
+_lock = threading.Lock()
+_cancel_events = {}  # job_id -> threading.Event, for queued and running jobs
+
+class JobQueueFull(Exception):
+    """Raised when MAX_PENDING_JOBS jobs are already queued or running"""
+
+def submit_job(job_id, fn, *args, **kwargs):
+    """Queues fn(*args, **kwargs) on the ingest pool under job_id"""
+    with _lock:
+        if len(_cancel_events) >= MAX_PENDING_JOBS:
+            raise JobQueueFull(f"{len(_cancel_events)} ingestion jobs already pending")
+        _cancel_events[job_id] = threading.Event()
+
+    return _executor.submit(_run_job, job_id, fn, args, kwargs)
+
+def _run_job(job_id, fn, args, kwargs):
+    try:
+        return fn(*args, **kwargs)
+    except Exception as e:
+        print(f"❌ Ingestion job {job_id} failed: {e}")
+        traceback.print_exc()
+        raise
+    finally:
+        with _lock:
+            _cancel_events.pop(job_id, None)
+
+def cancel_job(job_id):
+    """Asks a queued or running job to stop. Returns False if the job isn't pending"""
+    with _lock:
+        event = _cancel_events.get(job_id)
+    if event is None:
+        return False
+    event.set()
+    return True
+
+def cancel_all():
+    """Asks every pending job to stop"""
+    with _lock:
+        events = list(_cancel_events.values())
+    for event in events:
+        event.set()
+
+def is_cancelled(job_id):
+    """True once cancel_job has been called for a pending job"""
+    with _lock:
+        event = _cancel_events.get(job_id)
+    return event is not None and event.is_set()
+
+def get_job_stats():
+    """Returns the pool size and number of pending jobs"""
+    with _lock:
+        pending = len(_cancel_events)
+    return {
+        "workers": INGEST_WORKERS,
+        "pending_jobs": pending,
+        "max_pending_jobs": MAX_PENDING_JOBS
+    }
@@ -0,0 +1,370 @@
+import json
+import mmap
+import os
+from datetime import datetime
+import numpy as np
+
+# Memory-mappable metadata format, in a single file so it can be replaced atomically:
+#   8-byte magic | uint64 record count n | int64 offsets[n + 1] | JSON records, one per line
+# Loading maps the file instead of unpickling everything, so records are only decoded
+# when read and every worker process shares the same page-cache copy.
+MAGIC = b"MSEMETA1"
+HEADER_SIZE = 16
+
+def _encode(record):
+    return json.dumps(record, ensure_ascii=False, separators=(",", ":")).encode("utf-8") + b"\n"
+
+class MmapMetadataList:
+    """
+    List-like view over a mapped metadata file. Records read from the file are decoded
+    on access; appended or replaced records live in memory until the next write.
+    """
+
+    def __init__(self, path=None):
+        self._mmap = None
+        self._offsets = np.zeros(1, dtype=np.int64)
+        self._data_start = 0
+        self._overrides = {}  # position -> record replaced since load
+        self._appended = []
+
+        if path is not None:
+            with open(path, "rb") as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            if self._mmap[:8] != MAGIC:
+                raise ValueError(f"{path} is not a metadata store file")
+            count = int(np.frombuffer(self._mmap, dtype=np.uint64, count=1, offset=8)[0])
+            self._offsets = np.frombuffer(self._mmap, dtype=np.int64, count=count + 1, offset=HEADER_SIZE)
+            self._data_start = HEADER_SIZE + 8 * (count + 1)
+
+    @property
+    def _base_len(self):
+        return len(self._offsets) - 1
+
+    def __len__(self):
+        return self._base_len + len(self._appended)
+
+    def _position(self, index):
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError("metadata index out of range")
+        return index
+
+    def raw_record(self, index):
+        """Encoded bytes of a record, without decoding it when it is unchanged on disk"""
+        index = self._position(index)
+        if index < self._base_len and index not in self._overrides:
+            return self._read(index)
+        return _encode(self[index])
+
+    def _read(self, index):
+        start = self._data_start + int(self._offsets[index])
+        end = self._data_start + int(self._offsets[index + 1])
+        return self._mmap[start:end]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        index = self._position(index)
+        if index >= self._base_len:
+            return self._appended[index - self._base_len]
+        if index in self._overrides:
+            return self._overrides[index]
+        return json.loads(self._read(index))
+
+    def __setitem__(self, index, record):
+        index = self._position(index)
+        if index >= self._base_len:
+            self._appended[index - self._base_len] = record
+        else:
+            self._overrides[index] = record
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def append(self, record):
+        self._appended.append(record)
+
+    def snapshot(self):
+        """
+        Copy that later changes to this list don't affect, for writing it out without
+        holding a lock. The mapped file is shared; only the in-memory changes are copied.
+        """
+        copy = MmapMetadataList()
+        copy._mmap, copy._offsets, copy._data_start = self._mmap, self._offsets, self._data_start
+        copy._overrides = dict(self._overrides)
+        copy._appended = list(self._appended)
+        return copy
+
+def write_metadata(path, records):
+    """Writes records in the mapped format via a temp file and rename, so readers of the old file keep working"""
+    count = len(records)
+    offsets = np.empty(count + 1, dtype=np.int64)
+    offsets[0] = 0
+
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "wb") as f:
+        # Records go after the header, which is filled in once the offsets are known
+        f.write(b"\0" * (HEADER_SIZE + offsets.nbytes))
+        for i in range(count):
+            if isinstance(records, MmapMetadataList):
+                data = records.raw_record(i)
+            else:
+                data = _encode(records[i])
+            f.write(data)
+            offsets[i + 1] = offsets[i] + len(data)
+
+        f.seek(0)
+        f.write(MAGIC)
+        f.write(np.array([count], dtype=np.uint64).tobytes())
+        f.write(offsets.tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(temp_path, path)
+
+def load_metadata(path):
+    """Maps a metadata file written by write_metadata"""
+    return MmapMetadataList(path)
+
+def write_columns(path, arrays):
+    """Writes MetadataColumns.snapshot() arrays via a temp file and rename"""
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "wb") as f:
+        np.savez(f, **arrays)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+# Fields kept as columns next to the JSON records, so stats, recency listings and filters
+# never have to decode every record. Categorical values are stored as small integer codes.
+CATEGORICAL_COLUMNS = ("file_type", "model_used", "batch_id")
+UNKNOWN_VALUE = "unknown"
+
+# Search filters: a value or list of values per categorical column, plus an added_at
+# range (added_after inclusive, added_before exclusive) given as ISO timestamps
+FILTER_FIELDS = CATEGORICAL_COLUMNS + ("added_after", "added_before")
+
+def _timestamp(value):
+    """added_at as epoch seconds; records without a parseable time sort first"""
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except (TypeError, ValueError):
+        return 0.0
+
+def normalize_filters(filters):
+    """
+    Validates a filter dict such as {"file_type": ["audio"], "added_after": "2024-01-01"} and
+    returns it as a hashable tuple of (field, value) pairs, or None for no filters.
+    Raises ValueError for unknown fields or unparseable timestamps.
+    """
+    if not filters:
+        return None
+    if isinstance(filters, tuple):
+        return filters  # Already normalized
+    if not isinstance(filters, dict):
+        raise ValueError("filters must be an object")
+    
+    normalized = []
+    for field, value in filters.items():
+        if field in CATEGORICAL_COLUMNS:
+            values = value if isinstance(value, (list, tuple)) else [value]
+            if not values:
+                raise ValueError(f"{field} filter needs at least one value")
+            normalized.append((field, tuple(sorted(str(v) for v in values))))
+        elif field in ("added_after", "added_before"):
+            try:
+                normalized.append((field, datetime.fromisoformat(str(value)).timestamp()))
+            except ValueError:
+                raise ValueError(f"{field} must be an ISO timestamp, got {value!r}")
+        else:
+            raise ValueError(f"Unknown filter field: {field}. Expected one of {FILTER_FIELDS}")
+    return tuple(sorted(normalized))
+
+def record_matches(record, filters):
+    """True if a metadata record passes normalized filters"""
+    for field, value in filters or ():
+        if field == "added_after":
+            if _timestamp(record.get("added_at")) < value:
+                return False
+        elif field == "added_before":
+            if _timestamp(record.get("added_at")) >= value:
+                return False
+        else:
+            record_value = record.get(field)
+            if (UNKNOWN_VALUE if record_value is None else str(record_value)) not in value:
+                return False
+    return True
+
+class MetadataColumns:
+    """
+    Columnar view of the metadata, by item id: a code per categorical field, added_at as
+    epoch seconds and a live flag. Per-value live counts are maintained incrementally and
+    item ids ordered by added_at are cached, so stats and "most recent" listings don't
+    depend on the number of items. Not thread-safe; the caller holds the index lock.
+    """
+
+    def __init__(self):
+        self._size = 0
+        self._codes = {name: np.zeros(0, dtype=np.int32) for name in CATEGORICAL_COLUMNS}
+        self._added_at = np.zeros(0, dtype=np.float64)
+        self._live = np.zeros(0, dtype=bool)
+        self._values = {name: [] for name in CATEGORICAL_COLUMNS}  # code -> value
+        self._value_codes = {name: {} for name in CATEGORICAL_COLUMNS}  # value -> code
+        self._counts = {name: np.zeros(0, dtype=np.int64) for name in CATEGORICAL_COLUMNS}
+        self._num_live = 0
+        self._order = np.zeros(0, dtype=np.int64)  # Item ids sorted by added_at
+        self._order_len = 0
+        self._order_valid = True
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def num_live(self):
+        return self._num_live
+
+    def _grow(self, size):
+        """Grows the columns geometrically so appends stay amortized O(1)"""
+        capacity = len(self._live)
+        if size <= capacity:
+            return
+        capacity = max(size, 2 * capacity, 1024)
+        for name in CATEGORICAL_COLUMNS:
+            self._codes[name] = np.resize(self._codes[name], capacity)
+        self._added_at = np.resize(self._added_at, capacity)
+        self._live = np.resize(self._live, capacity)
+        self._live[self._size:] = False
+
+    def _code(self, name, value):
+        value = UNKNOWN_VALUE if value is None else str(value)
+        code = self._value_codes[name].get(value)
+        if code is None:
+            code = len(self._values[name])
+            self._values[name].append(value)
+            self._value_codes[name][value] = code
+            self._counts[name] = np.append(self._counts[name], np.int64(0))
+        return code
+
+    def _count(self, item_id, delta):
+        for name in CATEGORICAL_COLUMNS:
+            self._counts[name][self._codes[name][item_id]] += delta
+        self._num_live += delta
+
+    def append(self, record):
+        """Adds the columns of the record for the next item id"""
+        item_id = self._size
+        self._grow(item_id + 1)
+        self._size += 1
+        for name in CATEGORICAL_COLUMNS:
+            self._codes[name][item_id] = self._code(name, record.get(name))
+        added_at = _timestamp(record.get("added_at"))
+        self._added_at[item_id] = added_at
+        self._live[item_id] = not record.get("deleted")
+        if self._live[item_id]:
+            self._count(item_id, 1)
+        
+        if self._order_valid:
+            if self._order_len and self._added_at[self._order[self._order_len - 1]] > added_at:
+                self._order_valid = False
+            else:
+                if self._order_len == len(self._order):
+                    self._order = np.resize(self._order, max(1024, 2 * len(self._order)))
+                self._order[self._order_len] = item_id
+                self._order_len += 1
+
+    def set(self, item_id, record):
+        """Replaces the columns of an existing item (update, duplicate merge or delete)"""
+        if self._live[item_id]:
+            self._count(item_id, -1)
+        if record.get("deleted"):
+            self._live[item_id] = False
+            return
+        for name in CATEGORICAL_COLUMNS:
+            self._codes[name][item_id] = self._code(name, record.get(name))
+        added_at = _timestamp(record.get("added_at"))
+        if added_at != self._added_at[item_id]:
+            self._added_at[item_id] = added_at
+            self._order_valid = False
+        self._live[item_id] = True
+        self._count(item_id, 1)
+
+    def counts(self, name):
+        """Live items per value of a categorical column"""
+        return {
+            value: int(count)
+            for value, count in zip(self._values[name], self._counts[name])
+            if count > 0
+        }
+
+    def mask(self, filters):
+        """Boolean array by item id: live items that pass normalized filters"""
+        mask = self._live[:self._size].copy()
+        for field, value in filters or ():
+            if field == "added_after":
+                mask &= self._added_at[:self._size] >= value
+            elif field == "added_before":
+                mask &= self._added_at[:self._size] < value
+            else:
+                codes = [self._value_codes[field][v] for v in value if v in self._value_codes[field]]
+                mask &= np.isin(self._codes[field][:self._size], codes)
+        return mask
+
+    def recent(self, n):
+        """Ids of the n most recently added live items, newest first"""
+        if not self._order_valid:
+            self._order = np.argsort(self._added_at[:self._size], kind="stable").astype(np.int64)
+            self._order_len = self._size
+            self._order_valid = True
+        ids = []
+        for position in range(self._order_len - 1, -1, -1):
+            if len(ids) >= n:
+                break
+            item_id = int(self._order[position])
+            if self._live[item_id]:
+                ids.append(item_id)
+        return ids
+
+    def save(self, path):
+        """Writes the columns via a temp file and rename"""
+        write_columns(path, self.snapshot())
+
+    def snapshot(self):
+        """Copies of the arrays save writes, for writing them out with write_columns without holding a lock"""
+        arrays = {f"codes_{name}": self._codes[name][:self._size].copy() for name in CATEGORICAL_COLUMNS}
+        arrays["added_at"] = self._added_at[:self._size].copy()
+        arrays["live"] = self._live[:self._size].copy()
+        arrays["values"] = np.array(json.dumps(self._values))
+        return arrays
+
+    @classmethod
+    def load(cls, path):
+        """Reads columns written by save"""
+        columns = cls()
+        with np.load(path, allow_pickle=False) as data:
+            missing = [name for name in CATEGORICAL_COLUMNS if f"codes_{name}" not in data.files]
+            if missing:
+                raise ValueError(f"{path} has no column for {', '.join(missing)}")
+            values = json.loads(str(data["values"]))
+            columns._size = len(data["live"])
+            for name in CATEGORICAL_COLUMNS:
+                columns._codes[name] = data[f"codes_{name}"].astype(np.int32)
+                columns._values[name] = list(values.get(name, []))
+                columns._value_codes[name] = {value: code for code, value in enumerate(columns._values[name])}
+                columns._counts[name] = np.bincount(
+                    columns._codes[name][data["live"]], minlength=len(columns._values[name])
+                ).astype(np.int64)
+            columns._added_at = data["added_at"].astype(np.float64)
+            columns._live = data["live"].astype(bool)
+        columns._num_live = int(columns._live.sum())
+        columns._order_valid = False
+        return columns
+
+    @classmethod
+    def from_records(cls, records):
+        """Builds the columns by decoding every record, for stores saved without them"""
+        columns = cls()
+        for record in records:
+            columns.append(record)
+        return columns
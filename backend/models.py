@@ -1,71 +1,179 @@
-import torch
-from transformers import CLIPProcessor, CLIPModel
+import importlib.util
+import threading
+import time
 
-# Global model variables
+# Global model variables, filled in on first use (see get_clip / get_clap)
 CLIP_MODEL = None
 CLIP_PROCESSOR = None
 CLAP_MODEL = None
 
-def load_models():
-    """Loads the CLIP and CLAP models"""
-    global CLIP_MODEL, CLIP_PROCESSOR, CLAP_MODEL
-    
-    print("Loading CLIP and CLAP models...")
+# Bumped every time a model is (re)loaded so caches of its outputs can be invalidated
+MODEL_GENERATIONS = {"clip": 0, "clap": 0}
+
+CLIP_MODEL_NAME = "openai/clip-vit-base-patch32"
+
+# CLIP inference backend: "torch" (fp32 PyTorch), "onnx" (ONNX Runtime, fp32) or
+# "onnx_int8" (ONNX Runtime with dynamically quantized int8 weights). The ONNX models are
+# exported and checked against PyTorch on first use (see onnx_backend.py); if that fails
+# CLIP falls back to PyTorch. CLAP always runs on PyTorch.
+INFERENCE_BACKEND = "torch"
+INFERENCE_BACKENDS = ("torch", "onnx", "onnx_int8")
+CLIP_BACKEND = None  # Backend actually serving CLIP
+
+# Models are loaded lazily, each the first time it is needed. Models listed here are
+# also loaded by start_warm_up() on a background thread at server start, so the first
+# query doesn't pay for it; a worker that only serves text search can use ("clip",).
+WARM_UP_MODELS = ("clip", "clap")
+
+# After a failed load, callers get None instead of retrying until this many seconds pass
+MODEL_RETRY_SECONDS = 60
+
+MODEL_NAMES = ("clip", "clap")
+_model_locks = {name: threading.Lock() for name in MODEL_NAMES}
+_model_states = {
+    name: {"state": "not_loaded", "error": None, "load_seconds": None, "failed_at": None}
+    for name in MODEL_NAMES
+}
+_warm_up_thread = None
+
+def _load_clip():
+    global CLIP_MODEL, CLIP_PROCESSOR, CLIP_BACKEND
+    from transformers import CLIPProcessor, CLIPModel
 
-    # Load CLIP models
+    if INFERENCE_BACKEND not in INFERENCE_BACKENDS:
+        raise ValueError(f"Unknown inference backend: {INFERENCE_BACKEND}. Expected one of {INFERENCE_BACKENDS}")
+
+    print(f"Loading CLIP model ({INFERENCE_BACKEND})...")
+    processor = CLIPProcessor.from_pretrained(CLIP_MODEL_NAME)
+    model, backend = None, "torch"
+    if INFERENCE_BACKEND != "torch":
+        try:
+            import onnx_backend
+            model = onnx_backend.load_clip(CLIP_MODEL_NAME, quantize=INFERENCE_BACKEND == "onnx_int8")
+            backend = INFERENCE_BACKEND
+        except Exception as e:
+            print(f"⚠️  ONNX backend unavailable ({e}), using PyTorch for CLIP")
+    if model is None:
+        model = CLIPModel.from_pretrained(CLIP_MODEL_NAME)
+    CLIP_MODEL, CLIP_PROCESSOR, CLIP_BACKEND = model, processor, backend
+    print("✅ CLIP models loaded successfully.")
+
+def _load_clap():
+    global CLAP_MODEL
+    import torch
+
+    print("Loading CLAP model...")
+
+    # Try msclap first (Microsoft CLAP implementation)
     try:
-        print("Loading CLIP model...")
-        CLIP_MODEL = CLIPModel.from_pretrained("openai/clip-vit-base-patch32")
-        CLIP_PROCESSOR = CLIPProcessor.from_pretrained("openai/clip-vit-base-patch32")
-        print("✅ CLIP models loaded successfully.")
-        
-    except Exception as e:
-        print(f"❌ Error loading CLIP models: {e}")
-        CLIP_MODEL = None
-        CLIP_PROCESSOR = None
-
-    # Load CLAP model
+        from msclap import CLAP
+        CLAP_MODEL = CLAP(version='2023', use_cuda=torch.cuda.is_available())
+        print("✅ CLAP model (msclap) loaded successfully.")
+        return
+    except ImportError:
+        print("msclap not available, trying laion-clap...")
+
+    # Fallback to laion-clap
     try:
-        print("Loading CLAP model...")
-        
-        # Try msclap first (Microsoft CLAP implementation)
+        import laion_clap
+    except ImportError:
+        print("Please install: pip install msclap")
+        raise ImportError("Neither msclap nor laion-clap is available")
+    model = laion_clap.CLAP_Module(enable_fusion=False)
+    model.load_ckpt()  # Load pre-trained weights
+    CLAP_MODEL = model
+    print("✅ CLAP model (laion-clap) loaded successfully.")
+
+_loaders = {"clip": _load_clip, "clap": _load_clap}
+
+def _is_loaded(name):
+    if name == "clip":
+        return CLIP_MODEL is not None and CLIP_PROCESSOR is not None
+    return CLAP_MODEL is not None
+
+def ensure_loaded(name, force=False):
+    """
+    Loads one model ("clip" or "clap") if it isn't loaded yet. Thread-safe: concurrent
+    callers wait for a single load. Returns True if the model is available.
+    """
+    state = _model_states[name]
+    if _is_loaded(name) and not force:
+        return True
+
+    with _model_locks[name]:
+        if _is_loaded(name) and not force:
+            return True
+        if not force and state["failed_at"] is not None and time.time() - state["failed_at"] < MODEL_RETRY_SECONDS:
+            return False
+
+        state["state"] = "loading"
+        start = time.time()
         try:
-            from msclap import CLAP
-            CLAP_MODEL = CLAP(version='2023', use_cuda=torch.cuda.is_available())
-            print("✅ CLAP model (msclap) loaded successfully.")
-            
-        except ImportError:
-            print("msclap not available, trying laion-clap...")
-            
-            # Fallback to laion-clap
-            try:
-                import laion_clap
-                CLAP_MODEL = laion_clap.CLAP_Module(enable_fusion=False)
-                CLAP_MODEL.load_ckpt()  # Load pre-trained weights
-                print("✅ CLAP model (laion-clap) loaded successfully.")
-                
-            except ImportError:
-                print("❌ Neither msclap nor laion-clap is available.")
-                print("Please install: pip install msclap")
-                CLAP_MODEL = None
-                
-    except Exception as e:
-        print(f"❌ Error loading CLAP model: {e}")
-        CLAP_MODEL = None
+            _loaders[name]()
+        except Exception as e:
+            print(f"❌ Error loading {name.upper()} model: {e}")
+            state.update(state="failed", error=str(e), failed_at=time.time())
+            return False
+
+        state.update(state="ready", error=None, failed_at=None, load_seconds=round(time.time() - start, 2))
+        MODEL_GENERATIONS[name] += 1
+        return True
+
+def get_clip():
+    """Returns (CLIP_MODEL, CLIP_PROCESSOR), loading them on first use; (None, None) if unavailable"""
+    if not ensure_loaded("clip"):
+        return None, None
+    return CLIP_MODEL, CLIP_PROCESSOR
+
+def get_clap():
+    """Returns CLAP_MODEL, loading it on first use; None if unavailable"""
+    if not ensure_loaded("clap"):
+        return None
+    return CLAP_MODEL
 
+def get_clap_backend():
+    """Class name of the CLAP implementation in use, or the one that would be loaded, without loading it"""
+    if CLAP_MODEL is not None:
+        return type(CLAP_MODEL).__name__
+    if importlib.util.find_spec("msclap") is not None:
+        return "CLAP"
+    if importlib.util.find_spec("laion_clap") is not None:
+        return "CLAP_Module"
+    return None
+
+def load_models():
+    """(Re)loads the CLIP and CLAP models"""
+    print("Loading CLIP and CLAP models...")
+    for name in MODEL_NAMES:
+        ensure_loaded(name, force=True)
     print("Model loading process completed.")
     print(f"Final status - CLIP_MODEL loaded: {CLIP_MODEL is not None}")
     print(f"Final status - CLIP_PROCESSOR loaded: {CLIP_PROCESSOR is not None}")
     print(f"Final status - CLAP_MODEL loaded: {CLAP_MODEL is not None}")
 
+def start_warm_up(names=None):
+    """Loads the WARM_UP_MODELS (or names) on a background thread"""
+    global _warm_up_thread
+    names = WARM_UP_MODELS if names is None else names
+    if not names or (_warm_up_thread is not None and _warm_up_thread.is_alive()):
+        return
+
+    def warm_up():
+        for name in names:
+            ensure_loaded(name)
+
+    print(f"🔥 Warming up models in the background: {', '.join(names)}")
+    _warm_up_thread = threading.Thread(target=warm_up, name="model-warm-up", daemon=True)
+    _warm_up_thread.start()
+
 def get_model_status():
     """Returns the current status of loaded models"""
     return {
-        "clip_loaded": CLIP_MODEL is not None and CLIP_PROCESSOR is not None,
-        "clap_loaded": CLAP_MODEL is not None,
-        "clap_type": type(CLAP_MODEL).__name__ if CLAP_MODEL else None
+        "clip_loaded": _is_loaded("clip"),
+        "clap_loaded": _is_loaded("clap"),
+        "clap_type": type(CLAP_MODEL).__name__ if CLAP_MODEL else None,
+        "inference_backend": {"configured": INFERENCE_BACKEND, "clip": CLIP_BACKEND},
+        "states": {name: dict(state) for name, state in _model_states.items()},
+        "ready": all(_model_states[name]["state"] == "ready" for name in WARM_UP_MODELS),
+        "warm_up_models": list(WARM_UP_MODELS)
     }
-
-# Load models when module is imported
-print("models.py: Initializing models...")
-load_models()
@@ -1,24 +1,70 @@
 import os
 import pickle
+import re
+import atexit
+import threading
+import time
+import heapq
 import faiss
 import numpy as np
+import index_factory
+import metadata_store
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from rwlock import RWLock
 
 INDEX_FOLDER = "faiss_indexes"
 os.makedirs(INDEX_FOLDER, exist_ok=True)
 
 EMBEDDING_DIM = 512
 
+# Same rule as the frontend; also keeps names from escaping INDEX_FOLDER
+DB_NAME_PATTERN = re.compile(r"^[a-zA-Z_][a-zA-Z0-9_]{2,32}$")
+
+# Resident registry: databases stay loaded between requests, least recently used
+# ones are flushed and dropped once their estimated size exceeds the budget
+DB_CACHE_MEMORY_BUDGET_MB = 512
+
+# Write-behind policy: a database is written back once this many additions are
+# pending, or when the oldest pending addition is this many seconds old
+DB_FLUSH_EVERY_N_ADDITIONS = 50
+DB_FLUSH_INTERVAL_SECONDS = 10.0
+
+# Threads for federated search; FAISS releases the GIL, so databases are searched in parallel
+FEDERATED_SEARCH_WORKERS = 8
+
+# Filtered searches cache this many filters' masks per loaded database
+FILTER_SELECTOR_CACHE_SIZE = 32
+_search_executor = ThreadPoolExecutor(max_workers=FEDERATED_SEARCH_WORKERS, thread_name_prefix="fanout")
+
+_registry = OrderedDict()  # db_name -> DatabaseHandle, least recently used first
+_registry_lock = threading.Lock()
+_releasing = {}  # db_name -> handle that left the registry and is still being written out
+_loading = {}  # db_name -> Event set once a cold load outside _registry_lock has finished
+_registry_stats = {"hits": 0, "misses": 0, "evictions": 0, "reloads": 0, "flushes": 0}
+_flusher = None
+
 def _index_paths(db_name):
     idx = os.path.join(INDEX_FOLDER, f"{db_name}.index")
     meta = os.path.join(INDEX_FOLDER, f"{db_name}_metadata.pkl")
     return idx, meta
 
+def is_valid_db_name(db_name):
+    return isinstance(db_name, str) and DB_NAME_PATTERN.match(db_name) is not None
+
+def database_exists(db_name):
+    if not is_valid_db_name(db_name):
+        return False
+    return all(os.path.exists(path) for path in _index_paths(db_name))
+
 def create_database(db_name):
+    if not is_valid_db_name(db_name):
+        return False, "Invalid database name. Use 3-32 letters, numbers or _, starting with a letter or _"
     idx_path, meta_path = _index_paths(db_name)
     if os.path.exists(idx_path) or os.path.exists(meta_path):
         return False, "Database already exists"
-    index = faiss.IndexFlatIP(EMBEDDING_DIM)
+    index = index_factory.create_index(EMBEDDING_DIM, "flat")
     faiss.write_index(index, idx_path)
     metadata = {'file_paths': [], 'file_metadata': [], 'last_updated': datetime.now().isoformat()}
     with open(meta_path, 'wb') as f:
@@ -34,74 +80,457 @@ def list_databases():
             db_names.append(fname.replace(".index", ""))
     return db_names
 
-def load_faiss(db_name):
+def load_faiss(db_name, writable=False):
+    """Loads a database; read-only callers get a memory-mapped index instead of a heap copy"""
     idx_path, meta_path = _index_paths(db_name)
     if not os.path.exists(idx_path) or not os.path.exists(meta_path):
         return None, None, "Database not found"
-    index = faiss.read_index(idx_path)
+    index, _ = index_factory.read_index(idx_path, mmap=not writable)
     with open(meta_path, "rb") as f:
         meta = pickle.load(f)
     return index, meta, None
 
-def save_faiss(db_name, index, meta):
+def save_faiss(db_name, index, meta, on_replace=None):
+    """
+    Writes a database through temp files and renames. on_replace(signature) is called with
+    the new files' _file_signature under _registry_lock, together with the renames, so
+    get_handle never mistakes our own write for an external change.
+    """
     idx_path, meta_path = _index_paths(db_name)
-    faiss.write_index(index, idx_path)
-    with open(meta_path, "wb") as f:
+    temp_idx_path, temp_meta_path = f"{idx_path}.tmp", f"{meta_path}.tmp"
+    faiss.write_index(index, temp_idx_path)
+    with open(temp_idx_path, "rb") as f:
+        os.fsync(f.fileno())
+    with open(temp_meta_path, "wb") as f:
         pickle.dump(meta, f)
+        f.flush()
+        os.fsync(f.fileno())
+    # Renames keep mtime and size
+    signature = tuple((st.st_mtime_ns, st.st_size) for st in map(os.stat, (temp_idx_path, temp_meta_path)))
+    with _registry_lock:
+        os.replace(temp_idx_path, idx_path)
+        os.replace(temp_meta_path, meta_path)
+        if on_replace is not None:
+            on_replace(signature)
 
-def add_embedding_to_db(db_name, file_path, embedding, file_type):
-    index, meta, err = load_faiss(db_name)
-    if err:
-        return False, err
-    emb = np.array(embedding, dtype=np.float32).reshape(1, -1)
-    norm = np.linalg.norm(emb)
-    if norm != 0:
-        emb = emb / norm
-    index.add(emb)
-    meta['file_paths'].append(file_path)
-    meta['file_metadata'].append({
+def _file_signature(db_name):
+    """(mtime_ns, size) of both database files, or None if either is missing"""
+    try:
+        return tuple((st.st_mtime_ns, st.st_size) for st in map(os.stat, _index_paths(db_name)))
+    except FileNotFoundError:
+        return None
+
+def _estimate_index_bytes(index):
+    """Rough resident size of an index, used for the registry memory budget"""
+    ntotal = index.ntotal
+    index_type = index_factory.get_index_type(index)
+    if index_type == "ivf_pq":
+        return ntotal * (index_factory.IVF_PQ_M + 8)
+    vector_bytes = ntotal * index.d * 4
+    if index_type == "hnsw":
+        # Level-0 links take 2*M neighbour ids per vector
+        vector_bytes += ntotal * index_factory.HNSW_M * 2 * 4
+    return vector_bytes
+
+class DatabaseHandle:
+    """
+    A loaded database. Searches hold lock.read_lock(), additions hold lock.write_lock().
+    The index starts memory-mapped and is copied into memory on the first addition.
+    """
+
+    def __init__(self, db_name, index, meta, is_mapped):
+        self.db_name = db_name
+        self.index = index
+        self.meta = meta
+        self.is_mapped = is_mapped
+        self.lock = RWLock()
+        self.flush_lock = threading.Lock()
+        self.signature = _file_signature(db_name)
+        self.unsaved_additions = 0
+        self.last_flush_time = time.time()
+        self.evicted = False
+        self.released = threading.Event()  # Set once the handle has left the registry and been flushed
+        self.columns = metadata_store.MetadataColumns.from_records(meta['file_metadata'])
+        # (mask, count, selector) per normalized filter, like database._filter_selectors.
+        # Filled by concurrent searches, so it has its own lock; cleared by every addition.
+        self.filter_selectors = OrderedDict()
+        self.filter_lock = threading.Lock()
+
+    def memory_bytes(self):
+        return _estimate_index_bytes(self.index)
+
+    def filter_selector(self, filters):
+        """Mask, match count and IDSelector for items passing normalized filters. Caller holds a lock."""
+        with self.filter_lock:
+            cached = self.filter_selectors.get(filters)
+            if cached is None:
+                mask = self.columns.mask(filters)
+                cached = (mask, int(mask.sum()), index_factory.live_selector(mask))
+                self.filter_selectors[filters] = cached
+                while len(self.filter_selectors) > FILTER_SELECTOR_CACHE_SIZE:
+                    self.filter_selectors.popitem(last=False)
+            else:
+                self.filter_selectors.move_to_end(filters)
+            return cached
+
+    def ensure_writable(self):
+        """Caller must hold the write lock"""
+        if self.is_mapped:
+            self.index = faiss.deserialize_index(faiss.serialize_index(self.index))
+            self.is_mapped = False
+
+    def needs_flush(self):
+        return self.unsaved_additions > 0 and (
+            self.unsaved_additions >= DB_FLUSH_EVERY_N_ADDITIONS
+            or time.time() - self.last_flush_time >= DB_FLUSH_INTERVAL_SECONDS
+        )
+
+    def flush(self):
+        """Writes pending additions to disk. Searches keep running, additions wait."""
+        with self.flush_lock, self.lock.read_lock():
+            if self.unsaved_additions == 0:
+                return
+            save_faiss(self.db_name, self.index, self.meta, on_replace=self._replaced)
+            self.unsaved_additions = 0
+            self.last_flush_time = time.time()
+
+    def _replaced(self, signature):
+        """Called by save_faiss under _registry_lock"""
+        self.signature = signature
+        _registry_stats["flushes"] += 1
+
+def _load_handle(db_name):
+    if not is_valid_db_name(db_name):
+        return None
+    idx_path, meta_path = _index_paths(db_name)
+    if not os.path.exists(idx_path) or not os.path.exists(meta_path):
+        return None
+    index, is_mapped = index_factory.read_index(idx_path, mmap=True)
+    with open(meta_path, "rb") as f:
+        meta = pickle.load(f)
+    return DatabaseHandle(db_name, index, meta, is_mapped)
+
+def _evict_over_budget(keep):
+    """
+    Takes least recently used handles out of the registry until it fits the budget and
+    returns them for _release_handle. Caller holds _registry_lock.
+    """
+    budget = DB_CACHE_MEMORY_BUDGET_MB * 1024 * 1024
+    total = sum(handle.memory_bytes() for handle in _registry.values())
+    evicted = []
+    for db_name in list(_registry):
+        if total <= budget:
+            break
+        if db_name == keep:
+            continue
+        handle = _retire(db_name)
+        total -= handle.memory_bytes()
+        _registry_stats["evictions"] += 1
+        evicted.append(handle)
+    return evicted
+
+def _retire(db_name):
+    """Takes a handle out of the registry; it is not loaded again until _release_handle is done. Caller holds _registry_lock."""
+    handle = _registry.pop(db_name)
+    _releasing[db_name] = handle
+    return handle
+
+def _release_handle(handle, flush=True):
+    """
+    Flushes a retired handle; writers still holding it will retry. Called without
+    _registry_lock, so a slow write doesn't hold up lookups of other databases.
+    """
+    try:
+        with handle.lock.write_lock():
+            handle.evicted = True
+        with handle.flush_lock:
+            if flush and handle.unsaved_additions:
+                save_faiss(handle.db_name, handle.index, handle.meta)
+                handle.unsaved_additions = 0
+    finally:
+        with _registry_lock:
+            if _releasing.get(handle.db_name) is handle:
+                del _releasing[handle.db_name]
+        handle.released.set()
+
+def get_handle(db_name):
+    """Returns the resident handle for a database, loading it on first use or after it changed on disk"""
+    reloading = False
+    while True:
+        retired, flush, loaded = None, True, None
+        with _registry_lock:
+            pending = _releasing.get(db_name)
+            loading = _loading.get(db_name)
+            handle = _registry.get(db_name)
+            if pending is not None or loading is not None:
+                pass
+            elif handle is None:
+                _registry_stats["reloads" if reloading else "misses"] += 1
+                # Claim the load; the files are read without the lock so other databases stay available
+                loaded = _loading[db_name] = threading.Event()
+            else:
+                signature = _file_signature(db_name)
+                if signature == handle.signature:
+                    _registry.move_to_end(db_name)
+                    _registry_stats["hits"] += 1
+                    return handle
+                if signature is not None and handle.unsaved_additions:
+                    # Our pending writes win; the next flush overwrites the external change
+                    print(f"⚠️  Database '{db_name}' changed on disk while it had unsaved additions, keeping the in-memory copy")
+                    _registry.move_to_end(db_name)
+                    return handle
+                if signature is None:
+                    # Files were removed behind our back
+                    flush = False
+                else:
+                    print(f"🔄 Database '{db_name}' changed on disk, reloading")
+                    reloading = True
+                retired = _retire(db_name)
+        
+        if pending is not None:
+            # An evicted copy is still being written; read the files once it is done
+            pending.released.wait()
+            continue
+        if loading is not None:
+            # Another thread is reading this database; use its handle once published
+            loading.wait()
+            continue
+        if loaded is not None:
+            handle, evicted = None, []
+            try:
+                handle = _load_handle(db_name)
+            finally:
+                with _registry_lock:
+                    del _loading[db_name]
+                    if handle is not None:
+                        _registry[db_name] = handle
+                        evicted = _evict_over_budget(keep=db_name)
+                loaded.set()
+            for old in evicted:
+                _release_handle(old)
+            return handle
+        if retired is not None:
+            _release_handle(retired, flush)
+            if not flush:
+                return None
+            continue
+
+def _flush_loop():
+    while True:
+        time.sleep(DB_FLUSH_INTERVAL_SECONDS)
+        with _registry_lock:
+            handles = list(_registry.values())
+        for handle in handles:
+            try:
+                if handle.needs_flush():
+                    handle.flush()
+            except Exception as e:
+                print(f"❌ Error flushing database '{handle.db_name}': {e}")
+
+def _ensure_flusher():
+    global _flusher
+    with _registry_lock:
+        if _flusher is None or not _flusher.is_alive():
+            _flusher = threading.Thread(target=_flush_loop, name="db-flusher", daemon=True)
+            _flusher.start()
+
+def flush_all():
+    """Writes every database with pending additions to disk"""
+    with _registry_lock:
+        handles = list(_registry.values())
+    for handle in handles:
+        try:
+            handle.flush()
+        except Exception as e:
+            print(f"❌ Error flushing database '{handle.db_name}': {e}")
+
+atexit.register(flush_all)
+
+def get_registry_stats():
+    """Describes the resident databases and the cache counters"""
+    with _registry_lock:
+        loaded = {
+            name: {
+                "ntotal": handle.index.ntotal,
+                "memory_bytes": handle.memory_bytes(),
+                "memory_mapped": handle.is_mapped,
+                "unsaved_additions": handle.unsaved_additions
+            }
+            for name, handle in _registry.items()
+        }
+        stats = dict(_registry_stats)
+    stats["loaded_databases"] = loaded
+    stats["memory_bytes"] = sum(info["memory_bytes"] for info in loaded.values())
+    stats["memory_budget_bytes"] = DB_CACHE_MEMORY_BUDGET_MB * 1024 * 1024
+    return stats
+
+def add_embedding_to_db(db_name, file_path, embedding, file_type, extra_metadata=None):
+    metadata = {
         'file_path': file_path,
         'file_type': file_type,
         'filename': os.path.basename(file_path),
         'added_at': datetime.now().isoformat()
-    })
-    meta['last_updated'] = datetime.now().isoformat()
-    save_faiss(db_name, index, meta)
-    return True, "Added"
-
-def search_in_db(db_name, embedding, num_results=5):
-    index, meta, err = load_faiss(db_name)
-    if err:
-        return []
+    }
+    if extra_metadata:
+        metadata.update(extra_metadata)
+    
     emb = np.array(embedding, dtype=np.float32).reshape(1, -1)
     norm = np.linalg.norm(emb)
     if norm != 0:
         emb = emb / norm
-    scores, indices = index.search(emb, min(num_results, index.ntotal))
+
+    while True:
+        handle = get_handle(db_name)
+        if handle is None:
+            return False, "Database not found"
+        with handle.lock.write_lock():
+            if handle.evicted:
+                # Evicted or reloaded between lookup and lock, use the current handle
+                continue
+            handle.ensure_writable()
+            handle.index.add(emb)
+            handle.index = index_factory.maybe_migrate(handle.index)
+            handle.meta['file_paths'].append(file_path)
+            handle.meta['file_metadata'].append(metadata)
+            handle.columns.append(metadata)
+            handle.filter_selectors.clear()
+            handle.meta['last_updated'] = metadata['added_at']
+            handle.unsaved_additions += 1
+            ntotal = handle.index.ntotal
+        break
+
+    if handle.needs_flush():
+        handle.flush()
+    with _registry_lock:
+        # The database just grew, so the registry may no longer fit the budget
+        evicted = _evict_over_budget(keep=db_name)
+    for old in evicted:
+        _release_handle(old)
+    _ensure_flusher()
+    print(f"✅ Added {os.path.basename(file_path)} to database '{db_name}' (Total: {ntotal})")
+    return True, "Added"
+
+def search_in_db(db_name, embedding, num_results=5, nprobe=None, ef_search=None):
+    emb = np.asarray(embedding, dtype=np.float32).reshape(1, -1)
+    return search_in_db_batch(db_name, emb, num_results, nprobe=nprobe, ef_search=ef_search)[0]
+
+def search_in_db_batch(db_name, embeddings, num_results=5, nprobe=None, ef_search=None, filters=None):
+    """
+    Searches many query rows against one database with a single FAISS call, one result list per row.
+    filters (see metadata_store.normalize_filters) restricts the search to matching items.
+    """
+    embs = np.asarray(embeddings, dtype=np.float32)
+    if embs.ndim == 1:
+        embs = embs.reshape(1, -1)
+    handle = get_handle(db_name)
+    if handle is None:
+        return [[] for _ in range(len(embs))]
+    norms = np.linalg.norm(embs, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    embs = embs / norms
+    with handle.lock.read_lock():
+        index, meta = handle.index, handle.meta
+        k = min(num_results, index.ntotal)
+        if k <= 0:
+            return [[] for _ in range(len(embs))]
+        filters = metadata_store.normalize_filters(filters)
+        if filters:
+            mask, count, selector = handle.filter_selector(filters)
+            scores, indices = index_factory.filtered_search(
+                index, embs, k, mask, count=count, selector=selector, nprobe=nprobe, ef_search=ef_search
+            )
+        else:
+            scores, indices = index_factory.search(index, embs, k, nprobe=nprobe, ef_search=ef_search)
+        all_results = []
+        for row_scores, row_indices in zip(scores, indices):
+            results = []
+            for i, (score, idx) in enumerate(zip(row_scores, row_indices)):
+                if idx != -1 and idx < len(meta['file_paths']):
+                    meta_info = meta['file_metadata'][idx]
+                    results.append({
+                        'rank': i+1,
+                        'file_path': meta_info['file_path'],
+                        'filename': meta_info['filename'],
+                        'similarity_score': float(score),
+                        'file_type': meta_info.get('file_type', 'unknown'),
+                        'db_name': db_name
+                    })
+            all_results.append(results)
+    return all_results
+
+def _timed_search(db_name, emb, num_results, search_params):
+    start = time.perf_counter()
+    results = search_in_db_batch(db_name, emb, num_results, **search_params)[0]
+    return results, (time.perf_counter() - start) * 1000
+
+def federated_search(db_names, embedding, num_results=5, nprobe=None, ef_search=None, filters=None):
+    """
+    Searches several databases in parallel and merges their top-k into one global ranking.
+    Returns (results, per_db) where per_db maps db_name to its latency and hit count, or an error.
+    """
+    emb = np.asarray(embedding, dtype=np.float32).reshape(1, -1)
+    search_params = {"nprobe": nprobe, "ef_search": ef_search, "filters": filters}
+    futures = {
+        db_name: _search_executor.submit(_timed_search, db_name, emb, num_results, search_params)
+        for db_name in dict.fromkeys(db_names)
+    }
+    
+    per_db = {}
+    ranked_lists = []
+    for db_name, future in futures.items():
+        try:
+            results, latency_ms = future.result()
+            per_db[db_name] = {"latency_ms": round(latency_ms, 2), "num_results": len(results)}
+            ranked_lists.append(results)
+        except Exception as e:
+            print(f"❌ Federated search failed on '{db_name}': {e}")
+            per_db[db_name] = {"error": str(e)}
+    
+    # Each list is already sorted by score, so a k-way heap merge yields the global top-k
+    merged = heapq.merge(*ranked_lists, key=lambda r: -r['similarity_score'])
     results = []
-    for i, (score, idx) in enumerate(zip(scores[0], indices[0])):
-        if idx != -1 and idx < len(meta['file_paths']):
-            meta_info = meta['file_metadata'][idx]
-            results.append({
-                'rank': i+1,
-                'file_path': meta_info['file_path'],
-                'filename': meta_info['filename'],
-                'similarity_score': float(score),
-                'file_type': meta_info.get('file_type', 'unknown')
-            })
-    return results
+    for rank, result in enumerate(merged, start=1):
+        if rank > num_results:
+            break
+        results.append({**result, 'rank': rank})
+    return results, per_db
 
 def db_info(db_name):
-    idx_path, meta_path = _index_paths(db_name)
     try:
-        index, meta, err = load_faiss(db_name)
-        if err: return None
-        return {
-            "db_name": db_name,
-            "ntotal": index.ntotal,
-            "last_updated": meta["last_updated"],
-            "num_files": len(meta["file_paths"]),
-            "types": list(set([m.get("file_type") for m in meta['file_metadata']]))
-        }
+        handle = get_handle(db_name)
+        if handle is None: return None
+        with handle.lock.read_lock():
+            return {
+                "db_name": db_name,
+                "ntotal": handle.index.ntotal,
+                "index_type": index_factory.get_index_type(handle.index),
+                "last_updated": handle.meta["last_updated"],
+                "num_files": len(handle.meta["file_paths"]),
+                "types": list(set([m.get("file_type") for m in handle.meta['file_metadata']]))
+            }
     except Exception:
         return None
+
+def db_stats(db_name):
+    """db_info plus per-type and per-model counts and the registry state of one database"""
+    info = db_info(db_name)
+    if info is None:
+        return None
+    handle = get_handle(db_name)
+    if handle is None:
+        return None
+    file_types, models_used = {}, {}
+    with handle.lock.read_lock():
+        for m in handle.meta['file_metadata']:
+            file_type = m.get('file_type', 'unknown')
+            model_used = m.get('model_used', 'unknown')
+            file_types[file_type] = file_types.get(file_type, 0) + 1
+            models_used[model_used] = models_used.get(model_used, 0) + 1
+        info.update({
+            "file_types": file_types,
+            "models_used": models_used,
+            "memory_bytes": handle.memory_bytes(),
+            "memory_mapped": handle.is_mapped,
+            "unsaved_additions": handle.unsaved_additions
+        })
+    return info
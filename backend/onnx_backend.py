@@ -0,0 +1,262 @@
+import argparse
+import json
+import os
+import time
+import numpy as np
+from PIL import Image
+
+# ONNX Runtime inference for CLIP. The text and vision towers are exported once to
+# ONNX_MODEL_FOLDER (optionally with dynamic int8 weight quantization), checked against
+# the PyTorch embeddings, and then served by OnnxClipModel, a drop-in for CLIPModel's
+# get_image_features / get_text_features. Selected with models.INFERENCE_BACKEND.
+ONNX_MODEL_FOLDER = "onnx_models"
+ONNX_OPSET = 17
+ONNX_INTRA_OP_THREADS = None  # None lets ONNX Runtime use every core
+
+# An export is only used if every test embedding has at least this cosine similarity
+# with the PyTorch one. fp32 exports land around 0.9999, int8 ones around 0.99.
+ONNX_PARITY_MIN_COSINE = 0.98
+PARITY_TEXTS = ["a dog barking", "a photo of a cat", "piano music", "ocean waves at sunset", "children playing"]
+PARITY_REPORT_FILE = "parity.json"
+
+ONNX_BENCHMARK_RUNS = 20
+
+def _model_folder(model_name):
+    return os.path.join(ONNX_MODEL_FOLDER, model_name.replace("/", "--"))
+
+def model_paths(model_name, quantize=False):
+    """Paths of the exported (vision, text) towers"""
+    suffix = ".int8.onnx" if quantize else ".onnx"
+    folder = _model_folder(model_name)
+    return os.path.join(folder, "vision" + suffix), os.path.join(folder, "text" + suffix)
+
+def export_clip(model, model_name):
+    """Exports the vision and text towers of a transformers CLIPModel to ONNX (fp32)"""
+    import torch
+
+    class VisionTower(torch.nn.Module):
+        def __init__(self, clip):
+            super().__init__()
+            self.clip = clip
+
+        def forward(self, pixel_values):
+            return self.clip.get_image_features(pixel_values=pixel_values)
+
+    class TextTower(torch.nn.Module):
+        def __init__(self, clip):
+            super().__init__()
+            self.clip = clip
+
+        def forward(self, input_ids, attention_mask):
+            return self.clip.get_text_features(input_ids=input_ids, attention_mask=attention_mask)
+
+    vision_path, text_path = model_paths(model_name)
+    os.makedirs(os.path.dirname(vision_path), exist_ok=True)
+    model.eval()
+    image_size = model.config.vision_config.image_size
+
+    print(f"📦 Exporting {model_name} to ONNX...")
+    with torch.no_grad():
+        temp_path = f"{vision_path}.tmp"
+        torch.onnx.export(
+            VisionTower(model), (torch.zeros(1, 3, image_size, image_size),), temp_path,
+            input_names=["pixel_values"], output_names=["features"],
+            dynamic_axes={"pixel_values": {0: "batch"}, "features": {0: "batch"}},
+            opset_version=ONNX_OPSET
+        )
+        os.replace(temp_path, vision_path)
+
+        temp_path = f"{text_path}.tmp"
+        dummy_text = torch.ones(1, 8, dtype=torch.long)
+        torch.onnx.export(
+            TextTower(model), (dummy_text, dummy_text), temp_path,
+            input_names=["input_ids", "attention_mask"], output_names=["features"],
+            dynamic_axes={"input_ids": {0: "batch", 1: "sequence"}, "attention_mask": {0: "batch", 1: "sequence"},
+                          "features": {0: "batch"}},
+            opset_version=ONNX_OPSET
+        )
+        os.replace(temp_path, text_path)
+    print(f"✅ Exported ONNX towers to {_model_folder(model_name)}")
+
+def quantize_clip(model_name):
+    """Writes int8 copies of the exported towers (dynamic quantization of the weights)"""
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    for fp32_path, int8_path in zip(model_paths(model_name), model_paths(model_name, quantize=True)):
+        temp_path = f"{int8_path}.tmp"
+        quantize_dynamic(fp32_path, temp_path, weight_type=QuantType.QInt8)
+        os.replace(temp_path, int8_path)
+    print("✅ Quantized ONNX towers to int8")
+
+def _create_session(path):
+    import onnxruntime as ort
+
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if ONNX_INTRA_OP_THREADS:
+        options.intra_op_num_threads = ONNX_INTRA_OP_THREADS
+    return ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+
+def _to_numpy(value, dtype):
+    if hasattr(value, "detach"):
+        value = value.detach().cpu().numpy()
+    return np.ascontiguousarray(value, dtype=dtype)
+
+class OnnxClipModel:
+    """
+    CLIP towers served by ONNX Runtime. get_image_features / get_text_features take the
+    same CLIPProcessor outputs as CLIPModel and return torch tensors, so callers don't
+    need to know which backend they are using.
+    """
+
+    def __init__(self, model_name, quantize=False):
+        self.model_name = model_name
+        self.quantize = quantize
+        vision_path, text_path = model_paths(model_name, quantize)
+        self.vision_session = _create_session(vision_path)
+        self.text_session = _create_session(text_path)
+
+    def get_image_features(self, pixel_values):
+        import torch
+        (features,) = self.vision_session.run(["features"], {"pixel_values": _to_numpy(pixel_values, np.float32)})
+        return torch.from_numpy(features)
+
+    def get_text_features(self, input_ids, attention_mask=None):
+        import torch
+        input_ids = _to_numpy(input_ids, np.int64)
+        attention_mask = np.ones_like(input_ids) if attention_mask is None else _to_numpy(attention_mask, np.int64)
+        (features,) = self.text_session.run(["features"], {"input_ids": input_ids, "attention_mask": attention_mask})
+        return torch.from_numpy(features)
+
+def _parity_images():
+    """Deterministic test images: a gradient and two noise patterns"""
+    rng = np.random.RandomState(0)
+    gradient = np.tile(np.linspace(0, 255, 224, dtype=np.uint8), (224, 1))
+    images = [Image.fromarray(np.stack([gradient, gradient.T, 255 - gradient], axis=-1))]
+    images += [Image.fromarray(rng.randint(0, 256, (224, 224, 3), dtype=np.uint8)) for _ in range(2)]
+    return images
+
+def _normalized(features):
+    features = _to_numpy(features, np.float32)
+    return features / np.linalg.norm(features, axis=1, keepdims=True)
+
+def check_parity(torch_model, onnx_model, processor, min_cosine=ONNX_PARITY_MIN_COSINE):
+    """Compares ONNX and PyTorch embeddings of PARITY_TEXTS and test images by cosine similarity"""
+    import torch
+
+    text_inputs = processor(text=PARITY_TEXTS, return_tensors="pt", padding=True, truncation=True)
+    image_inputs = processor(images=_parity_images(), return_tensors="pt")
+    with torch.no_grad():
+        torch_text = torch_model.get_text_features(input_ids=text_inputs.input_ids, attention_mask=text_inputs.attention_mask)
+        torch_image = torch_model.get_image_features(pixel_values=image_inputs.pixel_values)
+    onnx_text = onnx_model.get_text_features(input_ids=text_inputs.input_ids, attention_mask=text_inputs.attention_mask)
+    onnx_image = onnx_model.get_image_features(pixel_values=image_inputs.pixel_values)
+
+    text_cosine = float(np.min(np.sum(_normalized(torch_text) * _normalized(onnx_text), axis=1)))
+    image_cosine = float(np.min(np.sum(_normalized(torch_image) * _normalized(onnx_image), axis=1)))
+    return {
+        "quantized": onnx_model.quantize,
+        "text_min_cosine": round(text_cosine, 6),
+        "image_min_cosine": round(image_cosine, 6),
+        "min_cosine_required": min_cosine,
+        "passed": min(text_cosine, image_cosine) >= min_cosine
+    }
+
+def _mean_ms(fn, runs):
+    fn()  # Warm-up run
+    start = time.perf_counter()
+    for _ in range(runs):
+        fn()
+    return (time.perf_counter() - start) * 1000 / runs
+
+def compare_latency(torch_model, onnx_model, processor, runs=ONNX_BENCHMARK_RUNS):
+    """Mean single-query latency of the PyTorch and ONNX towers, in milliseconds"""
+    import torch
+
+    text_inputs = processor(text=PARITY_TEXTS[:1], return_tensors="pt", padding=True, truncation=True)
+    image_inputs = processor(images=_parity_images()[:1], return_tensors="pt")
+    report = {}
+    for tower, run_torch, run_onnx in (
+        ("text",
+         lambda: torch_model.get_text_features(input_ids=text_inputs.input_ids, attention_mask=text_inputs.attention_mask),
+         lambda: onnx_model.get_text_features(input_ids=text_inputs.input_ids, attention_mask=text_inputs.attention_mask)),
+        ("image",
+         lambda: torch_model.get_image_features(pixel_values=image_inputs.pixel_values),
+         lambda: onnx_model.get_image_features(pixel_values=image_inputs.pixel_values)),
+    ):
+        with torch.no_grad():
+            torch_ms = _mean_ms(run_torch, runs)
+        onnx_ms = _mean_ms(run_onnx, runs)
+        report[tower] = {
+            "torch_ms": round(torch_ms, 2),
+            "onnx_ms": round(onnx_ms, 2),
+            "speedup": round(torch_ms / onnx_ms, 2) if onnx_ms > 0 else None
+        }
+    return report
+
+def read_parity_report(model_name):
+    """The report written by the last export, or None"""
+    path = os.path.join(_model_folder(model_name), PARITY_REPORT_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def _write_parity_report(model_name, report):
+    path = os.path.join(_model_folder(model_name), PARITY_REPORT_FILE)
+    reports = read_parity_report(model_name) or {}
+    reports["int8" if report["quantized"] else "fp32"] = report
+    with open(f"{path}.tmp", 'w') as f:
+        json.dump(reports, f, indent=2)
+    os.replace(f"{path}.tmp", path)
+
+def build_clip(model_name, quantize=False, torch_model=None, processor=None, benchmark_runs=0):
+    """
+    Exports (and optionally quantizes) CLIP, then checks it against PyTorch, timing both
+    backends if benchmark_runs is set. Raises RuntimeError if the export fails the parity
+    check. Returns the report.
+    """
+    from transformers import CLIPModel, CLIPProcessor
+
+    torch_model = torch_model or CLIPModel.from_pretrained(model_name)
+    processor = processor or CLIPProcessor.from_pretrained(model_name)
+    if not all(os.path.exists(path) for path in model_paths(model_name)):
+        export_clip(torch_model, model_name)
+    if quantize:
+        quantize_clip(model_name)
+
+    onnx_model = OnnxClipModel(model_name, quantize)
+    report = check_parity(torch_model, onnx_model, processor)
+    if benchmark_runs:
+        report["latency"] = compare_latency(torch_model, onnx_model, processor, benchmark_runs)
+    _write_parity_report(model_name, report)
+
+    print(f"🔍 ONNX parity: text {report['text_min_cosine']}, image {report['image_min_cosine']} "
+          f"(required {report['min_cosine_required']})")
+    if not report["passed"]:
+        for path in model_paths(model_name, quantize):
+            if os.path.exists(path):
+                os.remove(path)
+        raise RuntimeError(f"ONNX export of {model_name} failed the parity check")
+    return report
+
+def load_clip(model_name, quantize=False):
+    """Returns an OnnxClipModel, exporting and checking it first if it hasn't been built yet"""
+    if not all(os.path.exists(path) for path in model_paths(model_name, quantize)):
+        build_clip(model_name, quantize)
+    return OnnxClipModel(model_name, quantize)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export CLIP to ONNX, check parity with PyTorch and compare latency")
+    parser.add_argument("--model", default="openai/clip-vit-base-patch32")
+    parser.add_argument("--quantize", action="store_true", help="also build and check the int8 model")
+    parser.add_argument("--runs", type=int, default=ONNX_BENCHMARK_RUNS, help="timed runs per tower")
+    args = parser.parse_args()
+
+    from transformers import CLIPModel, CLIPProcessor
+    torch_model = CLIPModel.from_pretrained(args.model)
+    processor = CLIPProcessor.from_pretrained(args.model)
+
+    for quantize in ([False, True] if args.quantize else [False]):
+        report = build_clip(args.model, quantize, torch_model, processor, benchmark_runs=args.runs)
+        print(json.dumps(report, indent=2))
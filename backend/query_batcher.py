@@ -0,0 +1,116 @@
+import queue
+import threading
+import time
+import traceback
+from concurrent.futures import Future
+
+import numpy as np
+
+# Cross-request micro-batching for search queries: concurrent requests are collected
+# for up to QUERY_BATCH_MAX_WAIT_MS (or until QUERY_BATCH_MAX_SIZE are waiting), embedded
+# in one model forward pass and searched with one multi-query FAISS call
+ENABLE_QUERY_BATCHING = True
+QUERY_BATCH_MAX_SIZE = 16
+QUERY_BATCH_MAX_WAIT_MS = 5
+
+class QueryBatcher:
+    """
+    Batches search queries across requests.
+    embed_many takes a list of payloads (texts, image paths, ...) and returns a list of
+    embeddings aligned with it, using None for payloads that failed.
+    search_many(matrix, num_results, **search_params) returns one result list per row;
+    it defaults to database.search_similar_batch.
+    """
+
+    def __init__(self, name, embed_many, search_many=None, max_batch_size=QUERY_BATCH_MAX_SIZE,
+                 max_wait_ms=QUERY_BATCH_MAX_WAIT_MS):
+        self.name = name
+        self.embed_many = embed_many
+        self.search_many = search_many
+        self.max_batch_size = max_batch_size
+        self.max_wait_seconds = max_wait_ms / 1000.0
+        self._queue = queue.Queue()
+        self._worker = None
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {"queries": 0, "batches": 0, "largest_batch": 0}
+
+    def search(self, payload, num_results=5, **search_params):
+        """
+        Embeds payload and searches the index, sharing the work with concurrent callers.
+        Returns (embedding, results); embedding is None if the payload couldn't be embedded.
+        """
+        if not ENABLE_QUERY_BATCHING:
+            return self._process([(payload, num_results, search_params, None)])[0]
+
+        self._ensure_worker()
+        future = Future()
+        self._queue.put((payload, num_results, search_params, future))
+        return future.result()
+
+    def get_stats(self):
+        """Returns query and batch counters"""
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["average_batch_size"] = round(stats["queries"] / stats["batches"], 2) if stats["batches"] else 0.0
+        stats["enabled"] = ENABLE_QUERY_BATCHING
+        return stats
+
+    def _ensure_worker(self):
+        with self._start_lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name=f"{self.name}-batcher", daemon=True)
+                self._worker.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait_seconds
+
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            try:
+                outcomes = self._process(batch)
+                for (_, _, _, future), outcome in zip(batch, outcomes):
+                    future.set_result(outcome)
+            except Exception as e:
+                traceback.print_exc()
+                for _, _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def _process(self, batch):
+        """Embeds and searches one batch of (payload, num_results, search_params, future) requests"""
+        search_many = self.search_many
+        if search_many is None:
+            from database import search_similar_batch as search_many
+
+        with self._stats_lock:
+            self._stats["queries"] += len(batch)
+            self._stats["batches"] += 1
+            self._stats["largest_batch"] = max(self._stats["largest_batch"], len(batch))
+
+        embeddings = self.embed_many([payload for payload, _, _, _ in batch])
+        outcomes = [(embedding, None) for embedding in embeddings]
+
+        # One FAISS call per distinct set of search parameters, at the largest k requested
+        groups = {}
+        for i, ((_, _, search_params, _), embedding) in enumerate(zip(batch, embeddings)):
+            if embedding is not None:
+                groups.setdefault(tuple(sorted(search_params.items())), []).append(i)
+
+        for params_key, members in groups.items():
+            k = max(batch[i][1] for i in members)
+            matrix = np.stack([np.asarray(embeddings[i], dtype=np.float32).reshape(-1) for i in members])
+            all_results = search_many(matrix, num_results=k, **dict(params_key))
+            for i, results in zip(members, all_results):
+                outcomes[i] = (embeddings[i], results[:batch[i][1]])
+
+        return outcomes
@@ -0,0 +1,207 @@
+import json
+import os
+import struct
+import threading
+import zlib
+import numpy as np
+
+# Write-ahead log for the main index. Every change is appended here before it is
+# acknowledged, so the index files only have to be rewritten at checkpoints.
+#
+# Record framing: uint32 payload length | uint32 crc32 | uint64 lsn | payload
+# Payload: uint32 header length | JSON header | float32 vector rows (optional)
+# A torn or corrupt tail (from a crash mid-append) is cut off when the log is opened.
+RECORD_HEADER = struct.Struct("<IIQ")
+PAYLOAD_HEADER = struct.Struct("<I")
+
+# Group commit: appends are written immediately and fsynced together by a background
+# thread, at most this long after the first unsynced append
+WAL_GROUP_COMMIT_MS = 5
+
+def fsync_directory(path):
+    """Makes renames inside a directory durable (no-op where directories can't be opened)"""
+    try:
+        fd = os.open(path or ".", os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def _encode(lsn, record, vectors):
+    header = json.dumps(record, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    payload = PAYLOAD_HEADER.pack(len(header)) + header
+    if vectors is not None:
+        payload += np.ascontiguousarray(vectors, dtype=np.float32).tobytes()
+    crc = zlib.crc32(struct.pack("<Q", lsn) + payload)
+    return RECORD_HEADER.pack(len(payload), crc, lsn) + payload
+
+def _decode(payload):
+    (header_len,) = PAYLOAD_HEADER.unpack_from(payload)
+    record = json.loads(payload[PAYLOAD_HEADER.size:PAYLOAD_HEADER.size + header_len])
+    vectors = None
+    raw = payload[PAYLOAD_HEADER.size + header_len:]
+    if raw:
+        vectors = np.frombuffer(raw, dtype=np.float32).reshape(-1, record["dim"])
+    return record, vectors
+
+def _scan(f):
+    """Yields (offset_after, lsn, payload) for every intact record from the current position"""
+    while True:
+        header = f.read(RECORD_HEADER.size)
+        if len(header) < RECORD_HEADER.size:
+            return
+        length, crc, lsn = RECORD_HEADER.unpack(header)
+        payload = f.read(length)
+        if len(payload) < length or zlib.crc32(struct.pack("<Q", lsn) + payload) != crc:
+            return
+        yield f.tell(), lsn, payload
+
+def read_log(path, after_lsn=0):
+    """
+    Yields (lsn, record, vectors) for every intact record with an LSN above after_lsn.
+    Never modifies the file, so processes that don't own the log can follow it; a record
+    still being appended just ends the scan until the next call.
+    """
+    if not os.path.exists(path):
+        return
+    with open(path, "rb") as f:
+        for _, lsn, payload in _scan(f):
+            if lsn > after_lsn:
+                record, vectors = _decode(payload)
+                yield lsn, record, vectors
+
+class WriteAheadLog:
+    """
+    Append-only, CRC-framed change log with group-committed fsyncs.
+    start_lsn is the LSN already covered by the last checkpoint, so numbering
+    continues from there after the log has been truncated.
+    """
+
+    def __init__(self, path, start_lsn=0, group_commit_ms=WAL_GROUP_COMMIT_MS):
+        self.path = path
+        self.group_commit_seconds = group_commit_ms / 1000.0
+        self._lock = threading.Lock()
+        self._synced = threading.Condition(threading.Lock())
+        self._last_lsn = start_lsn
+        self._synced_lsn = start_lsn
+        self._pending_sync = threading.Event()
+        self._stats = {"appends": 0, "fsyncs": 0, "truncated_tail_bytes": 0}
+        self._file = self._open()
+        self._syncer = threading.Thread(target=self._sync_loop, name="wal-sync", daemon=True)
+        self._syncer.start()
+
+    def _open(self):
+        """Opens the log for appending, cutting off a torn tail and finding the last LSN"""
+        good_end = 0
+        if os.path.exists(self.path):
+            with open(self.path, "rb") as f:
+                for offset, lsn, _ in _scan(f):
+                    good_end = offset
+                    self._last_lsn = max(self._last_lsn, lsn)
+                size = f.seek(0, os.SEEK_END)
+            if size > good_end:
+                print(f"⚠️  Discarding {size - good_end} bytes of incomplete log records in {self.path}")
+                self._stats["truncated_tail_bytes"] += size - good_end
+                with open(self.path, "r+b") as f:
+                    f.truncate(good_end)
+                    os.fsync(f.fileno())
+        self._synced_lsn = self._last_lsn
+        return open(self.path, "ab")
+
+    @property
+    def last_lsn(self):
+        return self._last_lsn
+
+    def append(self, record, vectors=None):
+        """
+        Appends one record and returns its LSN. The record reaches the OS right away;
+        call wait_durable(lsn) to block until it has been fsynced.
+        """
+        if vectors is not None:
+            record = {**record, "dim": int(np.asarray(vectors).shape[-1])}
+        with self._lock:
+            lsn = self._last_lsn + 1
+            self._file.write(_encode(lsn, record, vectors))
+            self._file.flush()
+            self._last_lsn = lsn
+            self._stats["appends"] += 1
+        self._pending_sync.set()
+        return lsn
+
+    def wait_durable(self, lsn):
+        """Blocks until every record up to lsn has been fsynced"""
+        with self._synced:
+            while self._synced_lsn < lsn:
+                self._pending_sync.set()
+                self._synced.wait()
+
+    def sync(self):
+        """fsyncs everything appended so far"""
+        with self._lock:
+            lsn = self._last_lsn
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._stats["fsyncs"] += 1
+        with self._synced:
+            self._synced_lsn = max(self._synced_lsn, lsn)
+            self._synced.notify_all()
+
+    def _sync_loop(self):
+        while True:
+            self._pending_sync.wait()
+            # Let concurrent appends pile up so one fsync covers all of them
+            threading.Event().wait(self.group_commit_seconds)
+            self._pending_sync.clear()
+            try:
+                self.sync()
+            except Exception as e:
+                print(f"❌ Error syncing write-ahead log: {e}")
+
+    def replay(self, after_lsn=0):
+        """Yields (lsn, record, vectors) for every intact record with an LSN above after_lsn"""
+        with self._lock:
+            self._file.flush()
+        yield from read_log(self.path, after_lsn)
+
+    def truncate_through(self, lsn):
+        """Drops records up to lsn once a checkpoint covers them, keeping any newer ones"""
+        with self._lock:
+            self._file.flush()
+            temp_path = f"{self.path}.tmp"
+            with open(self.path, "rb") as src, open(temp_path, "wb") as dst:
+                start = 0
+                for offset, record_lsn, _ in _scan(src):
+                    if record_lsn <= lsn:
+                        start = offset
+                src.seek(start)
+                dst.write(src.read())
+                dst.flush()
+                os.fsync(dst.fileno())
+            self._file.close()
+            os.replace(temp_path, self.path)
+            fsync_directory(os.path.dirname(self.path))
+            self._file = open(self.path, "ab")
+
+    def reset(self, start_lsn=0):
+        """Empties the log"""
+        with self._lock:
+            self._file.close()
+            self._file = open(self.path, "wb")
+            os.fsync(self._file.fileno())
+            self._last_lsn = start_lsn
+        with self._synced:
+            self._synced_lsn = start_lsn
+            self._synced.notify_all()
+
+    def get_stats(self):
+        """Returns append / fsync counters and the log size"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["last_lsn"] = self._last_lsn
+        stats["synced_lsn"] = self._synced_lsn
+        stats["size_bytes"] = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        return stats
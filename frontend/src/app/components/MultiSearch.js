@@ -309,7 +309,7 @@ export default function MultiSearch({ dbName }) {
                 <>
                   <CardMedia
                     component="img"
-                    image={`http://localhost:5001/static/${result.filename}`}
+                    image={`http://localhost:5001/static/${result.filename}?thumbnail=1`}
                     alt={formatFilename(result.filename)}
                     sx={{ height: { xs: 170, sm: 200 }, objectFit: "cover" }}
                   />
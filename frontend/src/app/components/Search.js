@@ -756,7 +756,7 @@ const Search = () => {
                 <>
                   <CardMedia
                     component="img"
-                    image={`http://localhost:5001/static/${result.filename}`}
+                    image={`http://localhost:5001/static/${result.filename}?thumbnail=1`}
                     alt={formatFilename(result.filename)}
                     sx={{
                       height: { xs: 180, sm: 200 },
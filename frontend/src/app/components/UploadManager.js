@@ -625,7 +625,7 @@ const UploadManager = ({ onUploadSuccess }) => {
                         >
                           {upload.type === "image" ? (
                             <img
-                              src={`${BACKEND_URL}${upload.file_url}`}
+                              src={`${BACKEND_URL}${upload.thumbnail_url || upload.file_url}`}
                               alt={upload.filename}
                               style={{
                                 width: "100%",